@@ -11,9 +11,14 @@ import rapidjson
 import urllib
 import zipfile
 import geopandas as gpd
+import fiona
+import itertools
+import queue
+import threading
 import shutil
 import glob
 import warnings
+from .cartoCopy import route_by_size, copy_to_carto
 warnings.simplefilter(action='ignore', category=UserWarning)
 
 
@@ -36,9 +41,26 @@ CARTO_TABLE = 'bio_007_world_database_on_protected_areas'
 # column of table that can be used as a unique ID (UID)
 UID_FIELD='wdpa_pid'
 
+# maximum number of characters of ids to send in a single "= ANY(ARRAY[...])" SQL query
+MAX_ID_BYTES = 100000
+
 # url from which the data is fetched
 URL = 'https://d1gam3xoknrgr2.cloudfront.net/current/WDPA_{}_Public.zip'
 
+# tolerance, in degrees, for topology-preserving simplification of geometries before upload
+# set to 0 to upload geometries unchanged
+SIMPLIFY_TOLERANCE = 0
+
+# geometries with more vertices than this are too large to send as GeoJSON inside SQL text,
+# so they are streamed to Carto through the COPY endpoint instead
+MAX_VERTICES = 10000
+
+# number of features to read from the geodatabase and process at a time
+BATCH_SIZE = 100
+
+# maximum number of batches read ahead of the upload stage
+QUEUE_SIZE = 4
+
 # column names and types for data table
 # column names should be lowercase
 # column types should be one of the following: geometry, text, numeric, timestamp
@@ -221,33 +243,46 @@ def fetch_data():
     
     return gdb
 
+def id_set_where(column, id_list):
+    '''
+    Generate WHERE clauses matching a column against sets of ids
+    INPUT   column: column name where you should search for these values (string)
+            id_list: list of column values to match (list of strings)
+    RETURN  generator of WHERE clauses of the form "column = ANY(ARRAY[...])" (strings)
+    '''
+    # create an empty list to store the quoted ids of the current chunk
+    literals = []
+    # number of characters of SQL text in the current chunk
+    size = 0
+    for id in id_list:
+        # quote the id and escape any quotes inside it
+        literal = "'{}'".format(str(id).replace("'", "''"))
+        # if adding this id would make the query too long, send the current chunk and start a new one
+        if literals and size + len(literal) > MAX_ID_BYTES:
+            yield '{} = ANY(ARRAY[{}])'.format(column, ','.join(literals))
+            literals = []
+            size = 0
+        literals.append(literal)
+        size += len(literal) + 1
+    # send the remaining ids
+    if literals:
+        yield '{} = ANY(ARRAY[{}])'.format(column, ','.join(literals))
+
 def delete_carto_entries(id_list):
     '''
     Delete entries in Carto table based on values in a specified column
     INPUT   id_list: list of column values for which you want to delete entries in table (list of strings)
     RETURN  number of ids deleted (number)
     '''
-    # generate empty variable to store WHERE clause of SQL query we will send
-    where = None
     # column: column name where you should search for these values 
     column = UID_FIELD
-    # go through each ID in the list to be deleted
-    for delete_id in id_list:
-        # if we already have values in the SQL query, add the new value with an OR before it
-        if where:
-            where += f" OR {column} = '{delete_id}'"
-        # if the SQL query is empty, create the start of the WHERE clause
-        else:
-            where = f"{column} = '{delete_id}'"
-        # if where statement is long or we are on the last id, delete rows
-        # the length of 15000 was chosen arbitrarily - all the IDs to be deleted could not be sent at once, but no
-        # testing was done to optimize this value
-        if len(where) > 15000 or delete_id == id_list[-1]:
-            cartosql.deleteRows(CARTO_TABLE, where=where, user=CARTO_USER,
-                                key=CARTO_KEY)
-            # after we have deleted a set of rows, start over with a blank WHERE clause for the SQL query so we don't
-            # try to delete rows we have already deleted
-            where = None
+    # match the ids as a set with one "= ANY(ARRAY[...])" clause per chunk, rather than chaining OR conditions,
+    # and delete the chunks concurrently
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        futures = [executor.submit(cartosql.deleteRows, CARTO_TABLE, where, user=CARTO_USER, key=CARTO_KEY)
+                   for where in id_set_where(column, id_list)]
+        for future in as_completed(futures):
+            future.result()
     
     return len(id_list)
 
@@ -353,100 +388,86 @@ def upload_to_carto(row):
         logging.error(insert_exception)
         raise insert_exception
 
+def read_batches(gdb, batches):
+    '''
+    Read the geodatabase in a single pass, putting fixed-size batches of features on a queue
+    INPUT   gdb: the file path to the geodatabase (string)
+            batches: bounded queue to put the batches on (queue); once the whole geodatabase has been read, None is put
+                    on the queue, or the exception raised if reading failed
+    '''
+    try:
+        # open the geodatabase once and iterate through its features
+        with fiona.open(gdb, driver='FileGDB', layer=0, encoding='utf-8') as src:
+            columns = list(src.schema['properties']) + ['geometry']
+            while True:
+                # read the next batch of features
+                features = list(itertools.islice(src, BATCH_SIZE))
+                if not features:
+                    break
+                # convert the features to a geopandas dataframe; this blocks if the upload stage is QUEUE_SIZE batches behind
+                batches.put(gpd.GeoDataFrame.from_features(features, crs=src.crs, columns=columns))
+    except Exception as e:
+        batches.put(e)
+    else:
+        batches.put(None)
+
+def prepare_batch(gdf):
+    '''
+    Clean a batch of features read from the geodatabase
+    INPUT   gdf: batch of features (geopandas dataframe)
+    RETURN  gdf: batch of features with cleaned ids and the legal_status_updated_at column (geopandas dataframe)
+    '''
+    # get rid of the \r\n in the wdpa_pid column 
+    gdf['WDPA_PID'] = [x.split('\r\n')[0] for x in gdf['WDPA_PID']]
+    # create a new column to store the status_yr column as timestamps
+    gdf.insert(19, "legal_status_updated_at", [None if x == 0 else datetime.datetime(x, 1, 1) for x in gdf['STATUS_YR']])
+    gdf["legal_status_updated_at"] = gdf["legal_status_updated_at"].astype(object)
+    return gdf
+
 def processData(gdb):
     '''
     Process, upload, and clean new data
     INPUT gdb: fetched geodatabase with new data (geodatabase)
     RETURN  all_ids: a list storing all the wdpa_pids in the current dataframe (list of strings)
     '''
-    # whether we have reached the last slice 
-    last_slice = False
-    # the index of the first row we want to import from the geodatabase
-    start = -500
-    # the number of rows we want to fetch and process each time 
-    step = 500
-    # the row after the last one we want to fetch and process
-    end = None
-    # create an empty list to store all the wdpa_pids 
-    all_ids = []
-
-    # deal with the large geometries first 
-    for i in range(0, 100000000):
-        # import a slice of the geopandas dataframe 
-        gdf = gpd.read_file(gdb, driver='FileGDB', layer = 0, encoding='utf-8', rows = slice(start, end))
-        if '555643543' in gdf['WDPA_PID'].to_list():
-            # isolate the large polygon
-            gdf_large = gdf.loc[gdf['WDPA_PID'] =='555643543']
-            # get rid of the \r\n in the wdpa_pid column 
-            gdf_large['WDPA_PID'] = [x.split('\r\n')[0] for x in gdf_large['WDPA_PID']]
-            # create a new column to store the status_yr column as timestamps
-            gdf_large.insert(19, "legal_status_updated_at", [None if x == 0 else datetime.datetime(x, 1, 1) for x in gdf_large['STATUS_YR']])
-            gdf_large["legal_status_updated_at"] = gdf_large["legal_status_updated_at"].astype(object)
-        
-            # first upload the polygon to carto
-            upload_to_carto(gdf_large.iloc[0])
-            logging.info('Large geometry upload completed!')
-            all_ids.append('555643543')
-            break
-        else:
-            end = start 
-            start -= step
-
-    # the index of the first row we want to import from the geodatabase
-    start = -100
-    # the number of rows we want to fetch and process each time 
-    step = 100
-    # the row after the last one we want to fetch and process
-    end = None    
-    for i in range(0, 100000000):
-        # import a slice of the geopandas dataframe 
-        gdf = gpd.read_file(gdb, driver='FileGDB', layer = 0, encoding='utf-8', rows = slice(start, end))
-        # get rid of the \r\n in the wdpa_pid column 
-        gdf['WDPA_PID'] = [x.split('\r\n')[0] for x in gdf['WDPA_PID']]
-        # create a new column to store the status_yr column as timestamps
-        gdf.insert(19, "legal_status_updated_at", [None if x == 0 else datetime.datetime(x, 1, 1) for x in gdf['STATUS_YR']])
-        gdf["legal_status_updated_at"] = gdf["legal_status_updated_at"].astype(object)
-        logging.info('Process {} rows starting from the {}th row as a geopandas dataframe.'.format(step, start))
-
-        # create an empty list to store the ids of large polygons
-        large_ids = []
-        with ThreadPoolExecutor(max_workers = 8) as executor:
-            futures = []
-            for index, row in gdf.iterrows():
-                # for each row in the geopandas dataframe, submit a task to the executor to upload it to carto 
-                if row['WDPA_PID'] not in all_ids: 
-                    if row['geometry'].length > 300:
-                        large_ids.append(row['WDPA_PID'])
-                    else: 
-                        futures.append(
-                            executor.submit(
-                                upload_to_carto, row)
-                                )
-
+    # create an empty set to store all the wdpa_pids 
+    all_ids = set()
+
+    # read the geodatabase in a separate thread, which stays at most QUEUE_SIZE batches ahead of the uploads
+    batches = queue.Queue(maxsize=QUEUE_SIZE)
+    reader = threading.Thread(target=read_batches, args=(gdb, batches), daemon=True)
+    reader.start()
+
+    with ThreadPoolExecutor(max_workers = 8) as executor:
+        while True:
+            # get the next batch of features from the reader
+            gdf = batches.get()
+            # stop when the whole geodatabase has been read
+            if gdf is None:
+                break
+            # raise any error encountered while reading the geodatabase
+            if isinstance(gdf, Exception):
+                raise gdf
+            gdf = prepare_batch(gdf)
+
+            # skip rows that have already been uploaded
+            gdf = gdf[~gdf['WDPA_PID'].isin(all_ids)]
+            # split the batch into geometries small enough to insert as GeoJSON and geometries too large for that
+            small_gdf, large_gdf = route_by_size(gdf, MAX_VERTICES, SIMPLIFY_TOLERANCE)
+
+            # submit a task to the executor to upload each small row to carto 
+            futures = [executor.submit(upload_to_carto, row) for index, row in small_gdf.iterrows()]
             for future in as_completed(futures):
-                all_ids.append(future.result())
-
-        for index, row in gdf.loc[gdf['WDPA_PID'].isin(large_ids)].iterrows():
-            logging.info('Processing large polygon of id {}'.format(row['WDPA_PID']))
-            upload_to_carto(row)
-            logging.info('Large polygon of id {} uploaded'.format(row['WDPA_PID']))
-            all_ids.append(row['WDPA_PID'])
-
-        # if the number of rows is equal to the size of the slice 
-        if gdf.shape[0] == step:
-            # move to the next slice
-            end = start 
-            start -= step
-
-        elif gdf.shape[0] == 0 and last_slice == False:
-            # we may have reached the last slice 
-            start = 0
-            last_slice = True
-        else:
-            # we've processed the whole dataframe 
-            break
+                all_ids.add(future.result())
+
+            # stream the large geometries to carto in one COPY request
+            if not large_gdf.empty:
+                logging.info('Copying {} large geometries'.format(len(large_gdf)))
+                copy_to_carto(large_gdf, CARTO_TABLE, CARTO_SCHEMA, session)
+                all_ids.update(large_gdf['WDPA_PID'])
+            logging.info('{} rows processed.'.format(len(all_ids)))
 
-    return(all_ids)
+    return list(all_ids)
 
 def updateResourceWatch(num_new):
     '''
@@ -480,16 +501,8 @@ def main():
         logging.info('Clearing Table')
         # if the table exists
         if cartosql.tableExists(CARTO_TABLE, user=CARTO_USER, key=CARTO_KEY):
-            with ThreadPoolExecutor(max_workers=10) as executor:
-                futures = []
-                for i in range(0, len(existing_ids), 500):
-                    # loop through the existing ids to remove all rows from the table in chunks of size 500 
-                    futures.append(
-                        executor.submit(delete_carto_entries, existing_ids[i: i + 500])
-                    )
-                # sum the numbers of rows deleted
-                for future in as_completed(futures):
-                    deleted_ids += future.result()
+            # delete the existing ids in chunks, sending the chunks concurrently
+            deleted_ids = delete_carto_entries(existing_ids)
 
             logging.info('{} rows of old records removed!'.format(deleted_ids))
             # note: we do not delete the entire table because this will cause the dataset visualization on Resource Watch
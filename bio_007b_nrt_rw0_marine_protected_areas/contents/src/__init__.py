@@ -18,6 +18,7 @@ import urllib
 import zipfile
 import pandas as pd
 import shutil
+from .cartoCopy import route_by_size, copy_to_carto
 
 # do you want to delete everything currently in the Carto table when you run this script?
 CLEAR_TABLE_FIRST = True
@@ -108,6 +109,14 @@ UID_FIELD='wdpa_pid'
 # url at which the data can be downloaded 
 SOURCE_URL = 'https://d1gam3xoknrgr2.cloudfront.net/current/WDPA_WDOECM_{}_Public_marine_shp.zip' #check
 
+# tolerance, in degrees, for topology-preserving simplification of geometries before upload
+# set to 0 to upload geometries unchanged
+SIMPLIFY_TOLERANCE = 0
+
+# geometries with more vertices than this are too large to send as GeoJSON inside SQL text,
+# so they are streamed to Carto through the COPY endpoint instead
+MAX_VERTICES = 10000
+
 # Resource Watch dataset API ID
 # Important! Before testing this script:
 # Please change this ID OR comment out the getLayerIDs(DATASET_ID) function in the script below
@@ -324,8 +333,14 @@ def processData(table, gdf, schema, session):
             session: request session to send requests to Carto
     RETURN  num_new: total number of rows of data sent to Carto table (integer)
     '''
-    # upload the gdf to Carto
-    gdf.apply(insert_carto, args=(table, schema, session,), axis = 1)
+    # split the data into geometries small enough to insert as GeoJSON and geometries too large for that
+    small_gdf, large_gdf = route_by_size(gdf, MAX_VERTICES, SIMPLIFY_TOLERANCE)
+    # upload the small geometries to Carto
+    small_gdf.apply(insert_carto, args=(table, schema, session,), axis = 1)
+    # stream the large geometries to Carto in one COPY request
+    if not large_gdf.empty:
+        logging.info('Copying {} large geometries to {}'.format(len(large_gdf), table))
+        copy_to_carto(large_gdf, table, schema, session)
 
     # add the number of rows uploaded to num_new
     #logging.info('{} of rows uploaded to {}'.format(len(gdf.index), table))
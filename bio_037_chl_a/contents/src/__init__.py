@@ -6,6 +6,7 @@ import datetime
 import logging
 import subprocess
 import eeUtil
+from .collectionCache import CollectionCache, getCollection
 import urllib.request
 from netCDF4 import Dataset
 import os
@@ -35,6 +36,9 @@ NODATA_VALUE = -32767.0
 # name of data directory in Docker container
 DATA_DIR = 'data'
 
+# name of directory in Docker container where the list of assets in the GEE collection is cached between runs
+CACHE_DIR = 'cache'
+
 # name of folder to store data in Google Cloud Storage
 GS_FOLDER = 'bio_037_chl_a'
 
@@ -365,6 +369,8 @@ def processNewData(existing_dates):
         assets = [getAssetName(date) for date in dates]
         # Upload new files (tifs) to GEE
         eeUtil.uploadAssets(tifs, assets, GS_FOLDER, new_datetimes) 
+        # Record the new assets in the cache of the collection's contents
+        getCollection(EE_COLLECTION, getDate, CACHE_DIR).add(assets)
 
         # Delete local files
         logging.info('Cleaning local files')
@@ -383,14 +389,9 @@ def checkCreateCollection(collection):
     INPUT   collection: GEE collection to check or create (string)
     RETURN  list of assets in collection (list of strings)
     '''
-    # if collection exists, return list of assets in collection
-    if eeUtil.exists(collection):
-        return eeUtil.ls(collection)
-    # if collection does not exist, create it and return an empty list (because no assets are in the collection)
-    else:
-        logging.info('{} does not exist, creating'.format(collection))
-        eeUtil.createFolder(collection, True, public=True)
-        return []
+    # read the list of assets from the cache of the collection's contents; the collection is only listed
+    # on GEE (or created, if it does not exist) when it has changed since the cache was saved
+    return getCollection(collection, getDate, CACHE_DIR).assets
 
 
 def deleteExcessAssets(dates, max_assets):
@@ -407,6 +408,8 @@ def deleteExcessAssets(dates, max_assets):
         # go through each date, starting with the oldest, and delete until we only have the max number of assets left
         for date in dates[:-max_assets]:
             eeUtil.removeAsset(getAssetName(date))
+        # Record the deleted assets in the cache of the collection's contents
+        getCollection(EE_COLLECTION, getDate, CACHE_DIR).remove([getAssetName(date) for date in dates[:-max_assets]])
 
 def get_most_recent_date(collection):
     '''
@@ -414,15 +417,10 @@ def get_most_recent_date(collection):
     INPUT   collection: GEE collection to check dates for (string)
     RETURN  most_recent_date: most recent date in GEE collection (datetime)
     '''
-    # get list of assets in collection
-    existing_assets = checkCreateCollection(collection)
-    # get a list of strings of dates in the collection
-    existing_dates = [getDate(a) for a in existing_assets]
-    # sort these dates oldest to newest
-    existing_dates.sort()
-    # get the most recent date (last in the list)
+    # get the most recent date in the collection from the cache of its contents
+    most_recent_date_str = getCollection(collection, getDate, CACHE_DIR).mostRecentDate()
     # get last 8 characters from most recent date in the format YYYYMMDD
-    most_recent_date_str = existing_dates[-1][-8:]
+    most_recent_date_str = most_recent_date_str[-8:]
     # turn the most recent date into a datetime in julian format
     most_recent_date = datetime.datetime.strptime(most_recent_date_str, DATE_FORMAT).date()
     return most_recent_date
@@ -526,6 +524,8 @@ def main():
     if CLEAR_COLLECTION_FIRST:
         if eeUtil.exists(EE_COLLECTION):
             eeUtil.removeAsset(EE_COLLECTION, recursive=True)
+            # Forget the saved list of assets, so that the collection is created again below
+            CollectionCache(EE_COLLECTION, cache_dir=CACHE_DIR).clear()
 
     # Check if collection exists, create it if it does not
     # If it exists return the list of assets currently in the collection
@@ -1,13 +1,211 @@
 import os
+import re
+import json
 import requests
 import pandas as pd
 import datetime
 import logging
 import sys
 from io import StringIO
+from string import ascii_lowercase
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 
+# url of the sheet with out-of-date datasets that have been investigated
+KNOWN_ERRORS_URL = 'https://raw.githubusercontent.com/resource-watch/nrt-scripts/master/check_if_nrt_datasets_current/outdated_nrt_scripts.csv'
+
+# url to get a dataset from the Resource Watch API
+RW_DATASET_URL = 'https://api.resourcewatch.org/v1/dataset/{}'
+
+# number of datasets to look up on the Resource Watch API at once
+FETCH_WORKERS = 16
+
+# number of seconds to wait for the Resource Watch API to respond
+TIMEOUT = 60
+
+# name of data directory in Docker container
+DATA_DIR = 'data'
+
+# file to write the status of every dataset to, for other tools to read
+REPORT_FILE = os.path.join(DATA_DIR, 'nrt_freshness_report.json')
+
+# number of days we allow to pass before we receive an error, based on the expected frequency of updates
+FREQUENCY_THRESHOLDS = {
+    'daily': 4,
+    'weekly': 10,
+    'monthly': 45,
+    'annual': 410,
+    'varies': 10,
+}
+
+# expected frequencies given as a number of days, weeks or months, such as '3 days'
+FREQUENCY_RE = re.compile(r'^(\d+)\s*(day|week|month)s$')
+
+# number of days in each of these periods, and how many days overdue we will let the update be
+# on the order of days or weeks, we will let the update be 3 days overdue
+# on the order of months, we will let the update be 30 days overdue
+PERIOD_THRESHOLDS = {
+    'day': (1, 3),
+    'week': (7, 3),
+    'month': (30, 30),
+}
+
+# for any other expected frequency, we will let the update be 1 day overdue
+DEFAULT_THRESHOLD = 1
+
+# exceptions to the rules above for datasets that update on a lag, keyed by the start of their WRI ID
+# an exception for 'soc.062' also applies to 'soc.062a', 'soc.062b' and so on
+DATASET_THRESHOLDS = {
+    # biodiversity hotspots
+    'bio.002': 30,
+    # chlorophyll updates on the 19th of each month with the previous month's data
+    'bio.037': 53,
+    # allow for longer delay for TROPOMI data because it is slow to upload
+    'cit.035': 45,
+    # the WACCM forecast often goes offline for a few days
+    'cit.038': 5,
+    # GTFS updates on the 1st of each month
+    'cit.041a': 32,
+    # on the 1st of each month, Arctic/Antarctic Sea Ice Extent updates for the 1st of the previous month
+    'cli.005a': 70,
+    'cli.005b': 70,
+    # within the first few days of each month, Snow Cover updates for the 1st of the previous month
+    'cli.021': 70,
+    # around the 15th of each month, Surface Temperature Change updates for the 15th of the PREVIOUS month
+    'cli.035': 70,
+    # SPEI
+    'cli.039': 60,
+    # sea level rise data set updates at ~4 month delay
+    'cli.040': 150,
+    # antarctic ice mass data set updates at 2-3 month delay
+    'cli.041': 120,
+    # greenland ice mass data set updates at 2-3 month delay
+    'cli.042': 120,
+    # arctic sea ice extent data set updates at 2-3 month delay
+    'cli.043': 450,
+    # carbon dioxide concentration data set updates at 2-3 month delay
+    'cli.045': 120,
+    # NDC ratification status probably would only update once a year, after COP
+    'cli.047': 400,
+    # Disaster events data set doesn't always have events that occur everyday
+    'dis.006': 15,
+    # Tsunamis
+    'dis.009': 20,
+    # Tropical Cyclones
+    'dis.015': 20,
+    # oil spills data set doesn't always have events that occur every 10 days
+    'ene.008': 20,
+    # Vegetation Health Index
+    'foo.024': 12,
+    # Vegetation Condition Index
+    'foo.051': 12,
+    # GLAD Deforestation Alerts
+    'for.003': 10,
+    # Fire Risk Index often goes offline for a few days
+    'for.012': 10,
+    # Internal Displacement doesn't always occur everyday
+    'soc.062': 10,
+    # flood data set doesn't always have events that occur every 10 days
+    'wat.040': 30,
+}
+
+# pooled session for requests to the Resource Watch API, shared by the threads looking up datasets
+session = requests.Session()
+adapter = requests.adapters.HTTPAdapter(pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS)
+session.mount('https://', adapter)
+
+def get_allowed_time(wri_id, expected_freq):
+    '''
+    Find how long we allow to pass after the last update of a dataset before we receive an error
+    INPUT   wri_id: WRI ID of the dataset, such as 'cli.005a.rw1.nrt' (string)
+            expected_freq: expected frequency of updates from the metadata sheet, such as 'daily' or '3 days' (string)
+    RETURN  allowed_time: time allowed since the last update (timedelta)
+    '''
+    # allow for exceptions to the rules when certain datasets update on a lag
+    # the first two parts of the WRI ID identify the dataset, such as 'soc.062c'; if there is no exception for it,
+    # use the exception for the group of datasets it belongs to, such as 'soc.062'
+    dataset_id = '.'.join(wri_id.split('.')[:2])
+    for key in (dataset_id, dataset_id.rstrip(ascii_lowercase)):
+        if key in DATASET_THRESHOLDS:
+            return datetime.timedelta(days=DATASET_THRESHOLDS[key])
+    # otherwise, set the threshold based on the expected frequency of updates
+    expected_freq = expected_freq.lower().strip()
+    if expected_freq in FREQUENCY_THRESHOLDS:
+        return datetime.timedelta(days=FREQUENCY_THRESHOLDS[expected_freq])
+    match = FREQUENCY_RE.match(expected_freq)
+    if match:
+        period_days, overdue_days = PERIOD_THRESHOLDS[match.group(2)]
+        return datetime.timedelta(days=int(match.group(1)) * period_days + overdue_days)
+    return datetime.timedelta(days=DEFAULT_THRESHOLD)
+
+def fetch_last_updated(api_id):
+    '''
+    Get the date a dataset was last updated from the Resource Watch API
+    INPUT   api_id: Resource Watch API ID of the dataset (string)
+    RETURN  date the dataset was last updated (datetime)
+    '''
+    r = session.get(RW_DATASET_URL.format(api_id), timeout=TIMEOUT)
+    r.raise_for_status()
+    return datetime.datetime.strptime(r.json()['data']['attributes']['dataLastUpdated'], '%Y-%m-%dT%H:%M:%S.%fZ')
+
+def check_dataset(dataset, today):
+    '''
+    Check if a dataset is up-to-date
+    INPUT   dataset: row of the metadata sheet for the dataset (pandas series)
+            today: time to measure the time since the last update from (datetime)
+    RETURN  status of the dataset (dictionary)
+    '''
+    status = {
+        'wri_id': dataset['New WRI_ID'],
+        'api_id': dataset['API_ID'],
+        'public_title': dataset['Public Title'],
+        'expected_frequency': dataset['Frequency of Updates'].lower(),
+    }
+    # set a threshold of how many days we want to allow to pass before we receive an error
+    allowed_time = get_allowed_time(dataset['New WRI_ID'], dataset['Frequency of Updates'])
+    status['allowed_days'] = allowed_time.days
+    # check when data set was last updated
+    try:
+        last_updated = fetch_last_updated(dataset['API_ID'])
+    except Exception as e:
+        status.update({'status': 'error', 'error': str(e)})
+        return status
+    # see how long it has been since its last update
+    time_since_update = today - last_updated
+    status.update({
+        'last_updated': last_updated.isoformat() + 'Z',
+        'days_since_update': round(time_since_update.total_seconds() / 86400, 2),
+        'days_overdue': round((time_since_update - allowed_time).total_seconds() / 86400, 2),
+        # check if the time since last update surpasses the time we allow for this type of data set
+        'status': 'outdated' if allowed_time < time_since_update else 'ok',
+    })
+    return status
+
+def check_datasets(nrt_df):
+    '''
+    Check if each dataset is up-to-date, looking up several datasets on the Resource Watch API at once
+    INPUT   nrt_df: rows of the metadata sheet for the datasets to check (pandas dataframe)
+    RETURN  status of each dataset, in the order of the metadata sheet (list of dictionaries)
+    '''
+    today = datetime.datetime.utcnow()
+    datasets = [dataset for idx, dataset in nrt_df.iterrows()]
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        return list(executor.map(lambda dataset: check_dataset(dataset, today), datasets))
+
+def write_report(report):
+    '''
+    Write the status of every dataset to REPORT_FILE as JSON, replacing the file only once it has been fully written
+    INPUT   report: status of each dataset (list of dictionaries)
+    '''
+    if not os.path.exists(DATA_DIR):
+        os.mkdir(DATA_DIR)
+    tmp = REPORT_FILE + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'checked': datetime.datetime.utcnow().isoformat() + 'Z', 'datasets': report}, f, indent=2)
+    os.replace(tmp, REPORT_FILE)
+    logging.info('Wrote status of {} datasets to {}'.format(len(report), REPORT_FILE))
+
 def main():
     # Get ‘Frequency of Updates’ column to determine how frequently we expect each dataset to update
     # get 'Update Strategy' column to determine which datasets are NRT
@@ -21,166 +219,40 @@ def main():
     nrt_df = full_nrt_df[~full_nrt_df['Update strategy'].str.contains('RT - GEE')]
 
     # pull in sheet with out-of-date datasets that have been investigated
-    known_errors_csv = 'https://raw.githubusercontent.com/resource-watch/nrt-scripts/master/check_if_nrt_datasets_current/outdated_nrt_scripts.csv'
-    sheet = requests.get(known_errors_csv)
+    sheet = requests.get(KNOWN_ERRORS_URL)
     error_tracking_df = pd.read_csv(StringIO(sheet.text), header=0)
+    # look up the explanation for each investigated dataset, if one has been added
+    known_reasons = dict(zip(error_tracking_df['WRI ID'], error_tracking_df['Known Reason?']))
 
-    # go through each NRT dataset and check if it is up-to-date
-    for idx, dataset in nrt_df.iterrows():
-        # get data from API for data set
-        api_call = requests.get('https://api.resourcewatch.org/v1/dataset/{}'.format(dataset['API_ID']))
-        r = api_call.json()
-        # check when data set was last updated
-        last_updated = datetime.datetime.strptime(r['data']['attributes']['dataLastUpdated'],
-                                                  '%Y-%m-%dT%H:%M:%S.%fZ')
-        # see how long it has been since its last update
-        today = datetime.datetime.utcnow()
-        time_since_update = today - last_updated
-        # check how frequently we expect this data set to update
-        expected_freq = dataset['Frequency of Updates']
-
-        '''set a threshold of how many days we want to allow to pass before we receive an error, based on its 
-        # expected frequency of updates'''
-        if expected_freq.lower().strip() == 'daily':
-            allowed_time = datetime.timedelta(days=4)
-        elif expected_freq.lower().strip() == 'weekly':
-            allowed_time = datetime.timedelta(days=10)
-        elif expected_freq.lower().strip() == 'monthly':
-            allowed_time = datetime.timedelta(days=45)
-        elif expected_freq.lower().strip() == 'annual':
-            allowed_time = datetime.timedelta(days=410)
-        elif expected_freq.lower().strip() == 'varies':
-            allowed_time = datetime.timedelta(days=10)
-        # if frequency on the order of days, we will let the update be 3 days overdue
-        elif 'days' in expected_freq.lower():
-            x = int(expected_freq.lower()[0:-5])
-            allowed_time = datetime.timedelta(days=x + 3)
-        # if on the order of weeks, we will let the update be 3 days overdue
-        elif 'weeks' in expected_freq.lower():
-            x = int(expected_freq.lower()[0:-6])
-            allowed_time = datetime.timedelta(days=x * 7 + 3)
-        # if on the order of months, we will let the update be 30 days overdue
-        elif 'months' in expected_freq.lower():
-            x = int(expected_freq.lower()[0:-7])
-            allowed_time = datetime.timedelta(days=x * 30 + 30)
-        # for any other scenario, we will let the update be 1 day overdue
-        else:
-            allowed_time = datetime.timedelta(days=1)
-
-        '''allow for exceptions to the rules when certain datasets update on a lag'''
-        # biodiversity hotspots
-        if 'bio.002' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=30)
-         # chlorophyll updates on the 19th of each month with the previous month's data
-        elif 'bio.037' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=53)
-        # allow for longer delay for TROPOMI data because it is slow to upload
-        elif 'cit.035' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=45)
-        # the WACCM forecast often goes offline for a few days
-        elif 'cit.038' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=5)
-        # GTFS updates on the 1st of each month
-        elif 'cit.041a' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=32)
-        # on the 1st of each month, Arctic/Antarctic Sea Ice Extent updates for the 1st of the previous month
-        elif 'cli.005a' in r['data']['attributes']['name'] or 'cli.005b' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=70)
-        # within the first few days of each month, Snow Cover updates for the 1st of the previous month
-        elif 'cli.021' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=70)
-        # around the 15th of each month, Surface Temperature Change updates for the 15th of the PREVIOUS month
-        elif 'cli.035' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=70)
-        # SPEI
-        elif 'cli.039' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=60)
-        # sea level rise data set updates at ~4 month delay
-        elif 'cli.040' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=150)
-        # antarctic ice mass data set updates at 2-3 month delay
-        elif 'cli.041' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=120)
-        # greenland ice mass data set updates at 2-3 month delay
-        elif 'cli.042' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=120)
-        # arctic sea ice extent data set updates at 2-3 month delay
-        elif 'cli.043' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=450)  
-        # carbon dioxide concentration data set updates at 2-3 month delay
-        elif 'cli.045' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=120)            
-        # NDC ratification status probably would only update once a year, after COP
-        elif 'cli.047' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=400)
-        # Disaster events data set doesn't always have events that occur everyday
-        elif 'dis.006' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=15)
-        # Tsunamis
-        elif 'dis.009' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=20)
-        # Tropical Cyclones
-        elif 'dis.015' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=20)
-        # oil spills data set doesn't always have events that occur every 10 days
-        elif 'ene.008' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=20)
-        # Vegetation Health Index
-        elif 'foo.024' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=12)
-        # Vegetation Condition Index
-        elif 'foo.051' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=12)
-        # GLAD Deforestation Alerts
-        elif 'for.003' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=10)
-        # Fire Risk Index often goes offline for a few days
-        elif 'for.012' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=10)
-        # Internal Displacement doesn't always occur everyday
-        elif 'soc.062' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=10)
-        # flood data set doesn't always have events that occur every 10 days
-        elif 'wat.040' in r['data']['attributes']['name']:
-            allowed_time = datetime.timedelta(days=30)
-        
-
-        '''check if the time since last update surpasses the time we allow for this type of data set'''
+    # check if each NRT dataset is up-to-date
+    report = check_datasets(nrt_df)
+
+    for status in report:
+        reason = known_reasons.get(status['wri_id'])
+        status['known_reason'] = reason if pd.notna(reason) else None
+        message = '{wri_id} {public_title}'.format(**status)
+        # if the dataset could not be found on the API, log an error
+        if status['status'] == 'error':
+            logging.error('(ERROR) {} - could not get last update from the API: {}'.format(message, status['error']))
         # if the dataset is out-of-date
-        if allowed_time < time_since_update:
-            # if this outdated dataset has already been added to the sheet of outdated datasets:
-            if dataset['New WRI_ID'] in error_tracking_df['WRI ID'].tolist():
-                # if no explanation has been added to the sheet, log an error
-                if pd.isna(error_tracking_df[error_tracking_df['WRI ID'] == dataset['New WRI_ID']][
-                               'Known Reason?'].tolist()[0]):
-                    logging.error(
-                        '(OUTDATED) {wri_id} {public_title} - expected update frequency: {exp_up}. It has been {days} days since the last update.'.format(
-                            wri_id=dataset['New WRI_ID'], public_title=dataset['Public Title'],
-                            exp_up=dataset['Frequency of Updates'].lower(),
-                            days=time_since_update.days))
-                # if the explanation is included, log info instead of error
-                else:
-                    logging.info(
-                        '(OUTDATED) {wri_id} {public_title} - expected update frequency: {exp_up}. It has been {days} days since the last update.'.format(
-                            wri_id=dataset['New WRI_ID'], public_title=dataset['Public Title'],
-                            exp_up=dataset['Frequency of Updates'].lower(),
-                            days=time_since_update.days))
-            # if the dataset has not been added to the sheet of outdated datasets:
+        elif status['status'] == 'outdated':
+            message = '(OUTDATED) {} - expected update frequency: {}. It has been {} days since the last update.'.format(
+                message, status['expected_frequency'], int(status['days_since_update']))
+            # if this outdated dataset has already been added to the sheet of outdated datasets with an explanation,
+            # log info instead of error
+            if status['known_reason']:
+                logging.info(message)
             else:
-                logging.error(
-                    '(OUTDATED) {wri_id} {public_title} - expected update frequency: {exp_up}. It has been {days} days since the last update.'.format(
-                        wri_id=dataset['New WRI_ID'], public_title=dataset['Public Title'],
-                        exp_up=dataset['Frequency of Updates'].lower(),
-                        days=time_since_update.days))
+                logging.error(message)
         # if the dataset is still up-to-date use logging.info to note that
         else:
-            logging.info('(OK) {wri_id} {public_title} up to date.'.format(wri_id=dataset['New WRI_ID'],
-                                                                           public_title=dataset['Public Title']))
+            logging.info('(OK) {} up to date.'.format(message))
             # if that data set was previously outdated, send an alert to go remove it from the sheet
-            if dataset['New WRI_ID'] in error_tracking_df['WRI ID'].tolist():
-                logging.error('{wri_id} {public_title} is now up to date.'.format(wri_id=dataset['New WRI_ID'],
-                                                                                  public_title=dataset[
-                                                                                      'Public Title']))
+            if status['wri_id'] in known_reasons:
+                logging.error('{} is now up to date.'.format(message))
+
+    # save the status of every dataset
+    write_report(report)
 
     # prepare bi-weekly reminder to check any data sets that have been investigated but are still outdated
     for idx, dataset in error_tracking_df.iterrows():
@@ -193,4 +265,4 @@ def main():
         days = time_since_checking.days
         # if it has been more than two weeks, log an error
         if days > 14:
-            logging.error('The status of {wri_id} has not been checked in {days} days.'.format(wri_id=dataset['WRI ID'],days=days))
\ No newline at end of file
+            logging.error('The status of {wri_id} has not been checked in {days} days.'.format(wri_id=dataset['WRI ID'],days=days))
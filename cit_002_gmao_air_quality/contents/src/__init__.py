@@ -2,20 +2,26 @@ from __future__ import unicode_literals
 
 import os
 import sys
-import urllib
 import datetime
 import logging
-import subprocess
 import eeUtil
-import urllib.request
 import requests
 from bs4 import BeautifulSoup
 import copy
 import numpy as np
 import ee
 import time
-from string import ascii_uppercase
 import json
+from .downloadManager import DownloadManager, DownloadError
+from .geeTaskScheduler import TaskScheduler
+from .geeUploadsUtils import ingestAssets
+from .collectionCache import CollectionCache, getCollection
+from google.cloud import storage
+import rasterio as rio
+from rasterio.enums import Resampling
+from rasterio.shutil import copy as rio_copy
+from netCDF4 import Dataset
+from concurrent.futures import ProcessPoolExecutor
 
 
 # url for historical air quality data
@@ -24,10 +30,6 @@ SOURCE_URL_HISTORICAL = 'https://portal.nccs.nasa.gov/datashare/gmao/geos-cf/v1/
 # url for forecast air quality data
 SOURCE_URL_FORECAST = 'https://portal.nccs.nasa.gov/datashare/gmao/geos-cf/v1/forecast/Y{start_year}/M{start_month}/D{start_day}/H12/GEOS-CF.v01.fcst.chm_tavg_1hr_g1440x721_v1.{start_year}{start_month}{start_day}_12z+{year}{month}{day}_{time}z.nc4'
 
-# subdataset to be converted to tif
-# should be of the format 'NETCDF:"filename.nc":variable'
-SDS_NAME = 'NETCDF:"{fname}":{var}'
-
 # list variables (as named in netcdf) that we want to pull
 VARS = ['NO2', 'O3', 'PM25_RH35_GCC']
 
@@ -50,9 +52,30 @@ METRIC_BY_COMPOUND = {
 # nodata value for netcdf
 NODATA_VALUE = 9.9999999E14
 
+# creation options for the cloud optimized GeoTIFFs we generate, and the overview levels to build for them
+COG_OPTIONS = {'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'deflate'}
+COG_OVERVIEWS = [2, 4]
+
+# number of processes to calculate daily metrics with (each process handles one variable and date at a time)
+COMPOSITE_WORKERS = os.cpu_count() or 1
+
 # name of data directory in Docker container
 DATA_DIR = 'data'
 
+# name of directory in Docker container where downloaded netcdfs and the lists of assets in the GEE collections are cached between runs
+CACHE_DIR = 'cache'
+# number of hourly files to download at once
+DOWNLOAD_WORKERS = 8
+# how long to keep files in the cache after they were last used, in seconds
+# the files for a date are removed once its assets have been uploaded, so only the files of a run that
+# failed are left behind, to be reused if the script is run again before the next daily run
+CACHE_MAX_AGE = 24 * 60 * 60
+
+# number of tifs to upload to Google Cloud Storage at once
+UPLOAD_WORKERS = 8
+# number of ingestion tasks to run on GEE at once
+MAX_TASKS = 20
+
 # name of collection in GEE where we will upload the final data
 COLLECTION = '/projects/resource-watch-gee/cit_002_gmao_air_quality'
 # generate name for dataset's parent folder on GEE which will be used to store
@@ -240,25 +263,6 @@ def getAssetName(date, period, var):
     collection = getCollectionName(period, var)
     return os.path.join(collection, FILENAME.format(period=period, metric=METRIC_BY_COMPOUND[var], var=var, date=date))
 
-def getTiffName(file, period, var):
-    '''
-    generate names for tif files that we are going to create from netcdf
-    INPUT   file: netcdf filename (string)
-            period: period to be used in tif name, historical or forecast(string)
-            var: variable to be used in tif name (string)
-    RETURN  name: file name to save tif file created from netcdf (string)
-    '''
-    # get year, month, day, and time from netcdf filename
-    year = file.split('/')[1][-18:-14]
-    month = file.split('/')[1][-14:-12]
-    day = file.split('/')[1][-12:-10]
-    time = file.split('/')[1][-9:-5]
-    # generate date string to be used in tif file name
-    date = year+'-'+month+'-'+day +'_'+time
-    # generate name for tif file
-    name = os.path.join(DATA_DIR, FILENAME.format(period=period, metric=METRIC_BY_COMPOUND[var], var=var, date=date))+'.tif'
-    return name
-
 def getDateTimeString(filename):
     '''
     get date from filename (last 10 characters of filename after removing extension)
@@ -275,6 +279,14 @@ def getDate_GEE(filename):
     '''
     return os.path.splitext(os.path.basename(filename))[0][-10:]
 
+def getCollectionCache(collection):
+    '''
+    get the cache of a GEE collection's contents, listing the collection only if it has changed since the last run
+    INPUT   collection: GEE collection to get the contents of (string)
+    RETURN  CollectionCache for the collection, with the names and dates of its assets (CollectionCache)
+    '''
+    return getCollection(collection, getDate_GEE, CACHE_DIR, public=False)
+
 def list_available_files(url, file_start=''):
     '''
     get the files available for a given day using a source url formatted with date
@@ -370,53 +382,27 @@ def getNewDatesForecast(existing_dates):
 
     return new_dates
 
-def convert(files, var, period):
-    '''
-    Convert netcdf files to tifs
-    INPUT   files: list of file names for netcdfs that have already been downloaded (list of strings)
-            var: variable which we are converting files for (string)
-            period: period we are converting data for, historical or forecast (string)
-    RETURN  tifs: list of file names for tifs that have been generated (list of strings)
-    '''
-    # make an empty list to store the names of tif files that we create
-    tifs = []
-    for f in files:
-        logging.info('Converting {} to tiff'.format(f))
-        # generate the subdatset name for current netcdf file for a particular variable
-        sds_path = SDS_NAME.format(fname=f, var=var)
-        # only one band available in each file, so we will pull band 1
-        band = 1
-        # generate a name to save the tif file we will translate the netcdf file into
-        tif = getTiffName(file=f, period=period, var=var)
-        # translate the netcdf into a tif
-        cmd = ['gdal_translate', '-b', str(band), '-q', '-a_nodata', str(NODATA_VALUE), '-a_srs', 'EPSG:4326', sds_path, tif]
-        subprocess.call(cmd)
-        # add the new tif files to the list of tifs
-        tifs.append(tif)
-
-    return tifs
-
 def fetch(date, first_date, unformatted_source_url, period):
     '''
     Fetch files by datestamp
-    INPUT   new_dates: list of dates we want to try to fetch, in the format YYYY-MM-DD (list of strings)
+    The hourly files are downloaded concurrently into the local cache (CACHE_DIR), so files that were already
+    downloaded in a previous run are not downloaded again.
+    INPUT   date: date we want to try to fetch, in the format YYYY-MM-DD (string)
+            first_date: date of the first forecast, in the format YYYY-MM-DD, used to build forecast urls (string)
             unformatted_source_url: url for air quality data (string)
             period: period for which we want to get the data, historical or forecast (string)
     RETURN  files: list of file names for netcdfs that have been downloaded (list of strings)
             files_by_date: dictionary of file names along with the date for which they were downloaded (dictionary of strings)
+            urls: list of urls the netcdfs were downloaded from (list of strings)
     '''
-    # make an empty list to store names of the files we downloaded
-    files = []
     # create a list of hours to pull (24 hours per day, on the half-hour)
     # starts after noon on previous day through noon of current day
     hours = ['1230', '1330', '1430', '1530', '1630', '1730', '1830', '1930', '2030', '2130', '2230', '2330',
              '0030', '0130', '0230', '0330', '0430', '0530', '0630', '0730', '0830', '0930', '1030', '1130']
     # create an empty dictionary to store downloaded file names as value and corresponding dates as key
     files_by_date = {}
-    # Loop over all hours of the new dates, check if there is data available, and download netcdfs
-    # make an empty list to store names of the files we downloaded
-    # this list will be used to insert values to the "files_by_date" dictionary
-    files_for_current_date = []
+    # make an empty list to store the url and file name of each file to download
+    downloads = []
     # loop through each hours we want to pull data for
     for hour in hours:
         # for the first half of the hours, get data from previous day
@@ -436,164 +422,250 @@ def fetch(date, first_date, unformatted_source_url, period):
             url = unformatted_source_url.format(start_year=int(first_date[:4]), start_month='{:02d}'.format(int(first_date[5:7])), start_day='{:02d}'.format(int(first_date[8:])),year=int(fetching_date[:4]), month='{:02d}'.format(int(fetching_date[5:7])), day='{:02d}'.format(int(fetching_date[8:])), time=hour)
         # Create a file name to store the netcdf in after download
         f = DATA_DIR+'/'+url.split('/')[-1]
-        # try to download the data
-        tries = 1
-        while tries <= 5:
-            try:
-                logging.info('Retrieving {}'.format(f))
-                # download files from url and put in specified file location (f)
-                urllib.request.urlretrieve(url, f)
-                # if successful, add the file to the list of files we have downloaded
-                files.append(f)
-                files_for_current_date.append(f)
-                break
-            # if unsuccessful, log that the file was not downloaded
-            except Exception as e:
-                logging.info('Unable to retrieve data from {}, trying again'.format(url))
-                tries += 1
-                time.sleep(30)
-                logging.info('try {}'.format(tries))
-        if tries == 6:
-            logging.error('Unable to retrieve data from {}'.format(url))
-            exit()
+        # add the url and file name to the list of files to download
+        downloads.append((url, f))
+
+    # download all the hours at once, reusing any files already in the local cache
+    logging.info('Retrieving {} files for {}'.format(len(downloads), date))
+    try:
+        files = DownloadManager(CACHE_DIR, workers=DOWNLOAD_WORKERS).fetchAll(downloads)
+    except DownloadError as e:
+        logging.error(e)
+        exit()
+    files_for_current_date = list(files)
 
     # populate dictionary of file names along with the date for which they were downloaded
     files_by_date[date] = files_for_current_date
 
-    return files, files_by_date
+    return files, files_by_date, [url for url, f in downloads]
 
-def daily_avg(date, var, period, tifs_for_date):
+def readHourly(file, var):
     '''
-    Calculate a daily average tif file from all the hourly tif files
-    INPUT   date: list of dates we want to try to fetch, in the format YYYY-MM-DD (list of strings)
+    Read one hour of data for a variable from a netcdf file
+    INPUT   file: file name for netcdf that has already been downloaded (string)
+            var: variable to read (string)
+    RETURN  data: data for the hour, north up, with nodata pixels masked (numpy masked array of float32)
+            transform: affine transformation of the data (Affine)
+    '''
+    with Dataset(file) as nc:
+        # only one time step is available in each file
+        data = np.ma.masked_values(nc[var][0, :, :].astype(np.float32), np.float32(NODATA_VALUE), copy=False)
+        lat = nc['lat'][:]
+        lon = nc['lon'][:]
+    # the grid is stored south to north, flip it so that the first row is the northernmost
+    if lat[0] < lat[-1]:
+        data = data[::-1, :]
+    # get the resolution of the grid and the coordinates of its top left corner
+    res = abs(float(lon[1] - lon[0]))
+    transform = rio.transform.from_origin(float(lon.min()) - res / 2, float(lat.max()) + res / 2, res, res)
+    return data, transform
+
+def composite(files, var, combine):
+    '''
+    Combine the hourly data for a variable into a single array, one hour at a time
+    Only one hour is held in memory besides the running result, no matter how many hours are combined.
+    INPUT   files: list of file names for netcdfs that have already been downloaded (list of strings)
+            var: variable to combine (string)
+            combine: numpy function used to combine the running result with each hour, ex: np.add (ufunc)
+    RETURN  result: combined data (numpy array of float32)
+            nodata: True for pixels that are missing in any hour (numpy array of booleans)
+            transform: affine transformation of the data (Affine)
+    '''
+    result = nodata = None
+    for f in files:
+        data, transform = readHourly(f, var)
+        mask = np.ma.getmaskarray(data)
+        data = data.filled(0)
+        if result is None:
+            result, nodata = data, mask
+        else:
+            combine(result, data, out=result)
+            nodata |= mask
+    return result, nodata, transform
+
+def writeCog(data, nodata, transform, tif):
+    '''
+    Write an array to a cloud optimized GeoTIFF
+    INPUT   data: data to write (numpy array of float32)
+            nodata: True for pixels that should be set to NODATA_VALUE (numpy array of booleans)
+            transform: affine transformation of the data (Affine)
+            tif: file name for the tif file to create (string)
+    '''
+    data[nodata] = NODATA_VALUE
+    # generate profile for the tif file that we will create
+    profile = dict(COG_OPTIONS, driver='GTiff', height=data.shape[0], width=data.shape[1], count=1,
+                   dtype=rio.float32, crs='EPSG:4326', transform=transform, nodata=NODATA_VALUE)
+    # build the tif with overviews in memory, then copy it out with the overviews ahead of the data
+    with rio.MemoryFile() as memfile:
+        with memfile.open(**profile) as mem:
+            mem.write(data, 1)
+            mem.build_overviews(COG_OVERVIEWS, Resampling.average)
+        rio_copy(memfile.name, tif, driver='GTiff', copy_src_overviews=True, **COG_OPTIONS)
+
+def daily_avg(date, var, period, files):
+    '''
+    Calculate a daily average tif file from all the hourly netcdf files
+    INPUT   date: date we are calculating the average for, in the format YYYY-MM-DD (string)
             var: variable for which we are taking daily averages (string)
             period: period for which we are calculating metric, historical or forecast (string)
-            tifs_for_date: list of file names for tifs that were created from downloaded netcdfs (list of strings)
-    RETURN  result_tif: file name for tif file created after averaging all the input tifs (string)
-    '''
-    # create a list to store the tifs and variable names to be used in gdal_calc
-    gdal_tif_list=[]
-    # set up calc input for gdal_calc
-    calc = '--calc="('
-    # go through each hour in the day to be averaged
-    for i in range(len(tifs_for_date)):
-        # generate a letter variable for that tif to use in gdal_calc (A, B, C...)
-        letter = ascii_uppercase[i]
-        # add each letter to the list to be used in gdal_calc
-        gdal_tif_list.append('-'+letter)
-        # pull the tif name
-        tif = tifs_for_date[i]
-        # add each tif name to the list to be used in gdal_calc
-        gdal_tif_list.append('"'+tif+'"')
-        # add the variable to the calc input for gdal_calc
-        if i==0:
-            # for first tif, it will be like: --calc="(A
-            calc= calc +letter
-        else:
-            # for second tif and onwards, keep adding each letter like: --calc="(A+B
-            calc = calc+'+'+letter
-    # calculate the number of tifs we are averaging
-    num_tifs = len(tifs_for_date)
-    # finish creating calc input
-    # since we are trying to find average, the algorithm is: (sum all tifs/number of tifs)*(conversion factor for corresponding variable)
-    calc= calc + ')*{}/{}"'.format(CONVERSION_FACTORS[var], num_tifs)
+            files: list of file names for netcdfs that have already been downloaded (list of strings)
+    RETURN  result_tif: file name for tif file created after averaging all the hourly data (string)
+    '''
+    # sum all the hours
+    total, nodata, transform = composite(files, var, np.add)
+    # since we are trying to find average, the algorithm is: (sum all hours/number of hours)*(conversion factor for corresponding variable)
+    total *= np.float32(CONVERSION_FACTORS[var] / len(files))
     # generate a file name for the daily average tif
     result_tif = DATA_DIR+'/'+FILENAME.format(period=period, metric=METRIC_BY_COMPOUND[var], var=var, date=date)+'.tif'
-    # create the gdal command to calculate the average by putting it all together
-    cmd = ('gdal_calc.py {} --outfile="{}" {}').format(' '.join(gdal_tif_list), result_tif, calc)
-    # using gdal from command line from inside python
-    subprocess.check_output(cmd, shell=True)
+    writeCog(total, nodata, transform, result_tif)
     return result_tif
 
-def daily_max(date, var, period, tifs_for_date):
+def daily_max(date, var, period, files):
     '''
-    Calculate a daily maximum tif file from all the hourly tif files
-    INPUT   date: list of dates we want to try to fetch, in the format YYYY-MM-DD (list of strings)
-            var: variable for which we are taking daily averages (string)
+    Calculate a daily maximum tif file from all the hourly netcdf files
+    INPUT   date: date we are calculating the maximum for, in the format YYYY-MM-DD (string)
+            var: variable for which we are taking daily maximums (string)
             period: period for which we are calculating metric, historical or forecast (string)
-            tifs_for_date: list of file names for tifs that were created from downloaded netcdfs (list of strings)
-    RETURN  result_tif: file name for tif file created after finding the max from all the input tifs (string)
-    '''
-    # create a list to store the tifs and variable names to be used in gdal_calc
-    gdal_tif_list=[]
-
-    # go through each hour in the day to find the maximum
-    for i in range(len(tifs_for_date)):
-        # generate a letter variable for that tif to use in gdal_calc
-        letter = ascii_uppercase[i]
-        # add each letter to the list of tifs to be used in gdal_calc
-        gdal_tif_list.append('-'+letter)
-        # pull the tif name
-        tif = tifs_for_date[i]
-        # add each tif name to the list to be used in gdal_calc
-        gdal_tif_list.append('"'+tif+'"')
-        #add the variable to the calc input for gdal_calc
-        if i == 0:
-            calc = letter
-        else:
-            # set up calc input for gdal_calc to find the maximum from all tifs
-            calc = 'maximum('+calc+','+letter+')'
-    # finish creating calc input
-    calc = '--calc="'+calc + '*{}"'.format(CONVERSION_FACTORS[var])
-    #generate a file name for the daily maximum tif
+            files: list of file names for netcdfs that have already been downloaded (list of strings)
+    RETURN  result_tif: file name for tif file created after finding the max from all the hourly data (string)
+    '''
+    # find the maximum across all the hours
+    maximum, nodata, transform = composite(files, var, np.maximum)
+    # convert the units
+    maximum *= np.float32(CONVERSION_FACTORS[var])
+    # generate a file name for the daily maximum tif
     result_tif = DATA_DIR+'/'+FILENAME.format(period=period, metric=METRIC_BY_COMPOUND[var], var=var, date=date)+'.tif'
-    # create the gdal command to calculate the maximum by putting it all together
-    cmd = ('gdal_calc.py {} --outfile="{}" {}').format(' '.join(gdal_tif_list), result_tif, calc)
-    # using gdal from command line from inside python
-    subprocess.check_output(cmd, shell=True)
+    writeCog(maximum, nodata, transform, result_tif)
     return result_tif
 
-def processNewData(var, all_files, files_by_date, period, assets_to_delete):
+def daily_metric(date, var, period, files):
     '''
-    Process and upload clean new data
+    Calculate the metric for a variable (specified by METRIC_BY_COMPOUND) from all the hourly netcdf files
+    This is run in a separate process for each variable and date.
+    INPUT   date: date we are calculating the metric for, in the format YYYY-MM-DD (string)
+            var: variable for which we are calculating the metric (string)
+            period: period for which we are calculating metric, historical or forecast (string)
+            files: list of file names for netcdfs that have already been downloaded (list of strings)
+    RETURN  date: date the metric was calculated for (string)
+            var: variable the metric was calculated for (string)
+            tif: file name for tif file created (string)
+    '''
+    logging.info('Calculating {} of {} for {}'.format(METRIC_BY_COMPOUND[var], var, date))
+    return date, var, globals()[METRIC_BY_COMPOUND[var]](date, var, period, files)
+
+def fetchAndComposite(new_dates, first_date, unformatted_source_url, period):
+    '''
+    Fetch the hourly files for each date and calculate the daily metric for every variable in a pool of processes
+    The metrics for one date are calculated while the files for the next date are downloaded, and the netcdf files
+    for a date are deleted as soon as all its metrics have been calculated.
+    INPUT   new_dates: list of dates we want to fetch, in the format YYYY-MM-DD (list of strings)
+            first_date: date of the first forecast, in the format YYYY-MM-DD (string)
+            unformatted_source_url: url for air quality data (string)
+            period: period for which we want to get the data, historical or forecast (string)
+    RETURN  tifs_by_var: file names for the daily tifs of each variable, by date (dictionary of dictionaries)
+            urls: list of urls the netcdfs were downloaded from, to remove from the download cache once uploaded (list of strings)
+    '''
+    tifs_by_var = {var: {} for var in VARS}
+    urls = []
+    # metric calculations that are still running, with the netcdf files they are using
+    running = []
+    with ProcessPoolExecutor(max_workers=COMPOSITE_WORKERS) as pool:
+        for date in new_dates:
+            files, files_by_date, date_urls = fetch(date, first_date, unformatted_source_url, period)
+            urls += date_urls
+            running.append((files, [pool.submit(daily_metric, date, var, period, files) for var in VARS]))
+            # delete the netcdf files for dates whose metrics are done
+            for files, futures in [r for r in running if all(future.done() for future in r[1])]:
+                running.remove((files, futures))
+                collectMetrics(futures, files, tifs_by_var)
+        # wait for the remaining dates
+        for files, futures in running:
+            collectMetrics(futures, files, tifs_by_var)
+    return tifs_by_var, urls
+
+def collectMetrics(futures, files, tifs_by_var):
+    '''
+    Wait for the metrics calculated for a date, then delete the netcdf files they were calculated from
+    INPUT   futures: metric calculations for the date (list of futures)
+            files: list of file names for netcdfs the metrics were calculated from (list of strings)
+            tifs_by_var: file names for the daily tifs of each variable, by date, to add the new tifs to (dictionary of dictionaries)
+    '''
+    for future in futures:
+        date, var, tif = future.result()
+        tifs_by_var[var][date] = tif
+    for f in files:
+        os.remove(f)
+
+def processNewData(var, tifs_by_date, period, assets_to_delete, uploads):
+    '''
+    Queue clean new data for upload
     INPUT   var: variable that we are processing data for (string)
-            all_files: list of file names for netcdfs that have been downloaded (list of strings)
-            files_by_date: dictionary of netcdf file names along with the date for which they were downloaded (dictionary of strings)
+            tifs_by_date: dictionary of daily tif file names for the variable along with the date they were calculated for (dictionary of strings)
             period: period for which we want to process the data, historical or forecast (string)
             assets_to_delete: list of old assets to delete (list of strings)
-    RETURN  assets: list of file names for netcdfs that have been downloaded (list of strings)
+            uploads: tif file names, asset names and datetimes to upload, to add the new data to (dictionary of lists)
+    RETURN  assets: list of names of the GEE assets that will be uploaded (list of strings)
     '''
-    # if files is empty list do nothing, otherwise, process data
-    if all_files:
-        # create an empty list to store the names of the tifs we generate
-        tifs = []
+    # if there are no tifs do nothing, otherwise, queue them for upload
+    if tifs_by_date:
         # create an empty list to store the names we want to use for the GEE assets
         assets=[]
-        # create an empty list to store the list of dates from the averaged or maximum tifs
-        dates = []
-        # create an empty list to store the list of datetime objects from the averaged or maximum tifs
-        datestamps = []
-        # loop over each downloaded netcdf file
-        for date, files in files_by_date.items():
-            logging.info('Converting files')
-            # Convert new files from netcdf to tif files
-            hourly_tifs = convert(files, var, period)
-            # take relevant metric (daily average or maximum) of hourly tif files for days we have pulled
-            metric = METRIC_BY_COMPOUND[var]
-            tif = globals()[metric](date, var, period, hourly_tifs)
+        # loop over the averaged or maximum tif for each date, oldest first
+        for date, tif in sorted(tifs_by_date.items()):
             # add the averaged or maximum tif file to the list of files to upload to GEE
-            tifs.append(tif)
+            uploads['tifs'].append(tif)
             # Get a list of the names we want to use for the assets once we upload the files to GEE
             assets.append(getAssetName(date, period, var))
-            # get new list of date strings (in case order is different) from the processed tifs
-            dates.append(getDateTimeString(tif))
             # generate datetime objects for each tif date
-            datestamps.append(datetime.datetime.strptime(date, DATE_FORMAT))
+            uploads['datestamps'].append(datetime.datetime.strptime(date, DATE_FORMAT))
+        uploads['assets'] += assets
         # delete old assets (none for historical)
         for asset in assets_to_delete:
             ee.data.deleteAsset(asset)
             logging.info(f'Deleteing {asset}')
-
-        logging.info('Uploading files:')
-        for asset in assets:
-            logging.info(os.path.split(asset)[1])
-        # Upload new files (tifs) to GEE
-        eeUtil.uploadAssets(tifs, assets, GS_FOLDER, datestamps)
+        # record the deleted assets in the cache of the collection's contents
+        if assets_to_delete:
+            getCollectionCache(getCollectionName(period, var)).remove(assets_to_delete)
         return assets
     #if no new assets, return empty list
     else:
         return []
 
+def uploadAssets(uploads):
+    '''
+    Upload the tifs for every variable to GEE in a single pass: all of the tifs are staged on Google Cloud Storage at once,
+    skipping any that are already there from an earlier try, and then ingested into GEE side by side
+    INPUT   uploads: tif file names, asset names and datetimes to upload (dictionary of lists)
+    '''
+    if not uploads['tifs']:
+        return
+    logging.info('Uploading files:')
+    for asset in uploads['assets']:
+        logging.info(os.path.split(asset)[1])
+    # set up Google Cloud Storage project and bucket objects
+    gcsClient = storage.Client(os.environ.get("CLOUDSDK_CORE_PROJECT"))
+    gcsBucket = gcsClient.bucket(os.environ.get("GEE_STAGING_BUCKET"))
+    # Upload new files (tifs) to GEE
+    tasks = ingestAssets(gcsBucket, uploads['tifs'], uploads['assets'], uploads['datestamps'], GS_FOLDER,
+                         scheduler=TaskScheduler(max_in_flight=MAX_TASKS), workers=UPLOAD_WORKERS)
+    # record the new assets in the cache of each collection's contents, so the collections do not need to be listed again
+    uploaded = {}
+    for task in tasks:
+        if task.succeeded:
+            uploaded.setdefault(os.path.dirname(task.name), []).append(task.name)
+    for collection, assets in uploaded.items():
+        getCollectionCache(collection).add(assets)
+    failed = [task.name for task in tasks if not task.succeeded]
+    if failed:
+        raise Exception('Unable to upload {} assets: {}'.format(len(failed), failed))
+
+def newUploads():
+    '''
+    Create an empty set of uploads for processNewData to add data to
+    RETURN  uploads: empty lists of tif file names, asset names and datetimes (dictionary of lists)
+    '''
+    return {'tifs': [], 'assets': [], 'datestamps': []}
+
 def checkCreateCollection(VARS, period):
     '''
     List assets in collection if it exists, else create new collection
@@ -621,25 +693,19 @@ def checkCreateCollection(VARS, period):
             logging.info('{} does not exist, creating'.format(parent_folder))
             eeUtil.createFolder(parent_folder)
 
-        # If the GEE collection for a particular variable exists, get a list of existing assets
-        if eeUtil.exists(collection):
-            existing_assets = eeUtil.ls(collection)
-            # get a list of the dates from these existing assets
-            dates = [getDate_GEE(a) for a in existing_assets]
-            # append this list of dates to our list of dates by variable
-            existing_dates_by_var.append(dates)
-
-            # for each of the dates that we have for this variable, append the date to the master list
-            # list of which dates we already have data for (if it isn't already in the list)
-            for date in dates:
-                if date not in existing_dates:
-                    existing_dates.append(date)
-        #If the GEE collection does not exist, append an empty list to our list of dates by variable
-        else:
-            existing_dates_by_var.append([])
-            # create a collection for this variable
-            logging.info('{} does not exist, creating'.format(collection))
-            eeUtil.createFolder(collection, True)
+        # Get a list of existing assets from the cache of the collection's contents; the collection is only listed
+        # on GEE (or created, if it does not exist) when it has changed since the cache was saved
+        existing_assets = getCollectionCache(collection).assets
+        # get a list of the dates from these existing assets
+        dates = [getDate_GEE(a) for a in existing_assets]
+        # append this list of dates to our list of dates by variable
+        existing_dates_by_var.append(dates)
+
+        # for each of the dates that we have for this variable, append the date to the master list
+        # list of which dates we already have data for (if it isn't already in the list)
+        for date in dates:
+            if date not in existing_dates:
+                existing_dates.append(date)
 
     '''
      We want make sure all variables correctly uploaded the data on the last run. To do this, we will
@@ -673,6 +739,8 @@ def deleteExcessAssets(collection, all_assets, max_assets):
         # go through each assets, starting with the oldest, and delete until we only have the max number of assets left
         for asset in all_assets[:-max_assets]:
             eeUtil.removeAsset(collection +'/'+ asset)
+        # record the deleted assets in the cache of the collection's contents
+        getCollectionCache(collection).remove(all_assets[:-max_assets])
 
 def get_most_recent_date(all_assets):
     '''
@@ -713,6 +781,8 @@ def clearCollectionMultiVar(period):
                 # delete each asset
                 for item in list.getInfo():
                     ee.data.deleteAsset(item['id'])
+        # forget the saved list of assets, so that the collection is listed again
+        CollectionCache(getCollectionName(period, var), cache_dir=CACHE_DIR).clear()
 
 def listAllCollections(var, period):
     '''
@@ -721,17 +791,10 @@ def listAllCollections(var, period):
             period: period we are checking collection for, historical or forecast (string)
     RETURN  all_assets: list of old assets to delete (list of strings)
     '''
-    all_assets = []
-    collection = getCollectionName(period, var)
-    if eeUtil.exists(collection):
-        if collection[0] == '/':
-            collection = collection[1:]
-        a = ee.ImageCollection(collection)
-        collection_size = a.size().getInfo()
-        if collection_size > 0:
-            list = a.toList(collection_size)
-            for item in list.getInfo():
-                all_assets.append(item['id'])
+    # read the assets from the cache of the collection's contents
+    collection = getCollectionCache(getCollectionName(period, var))
+    # remove the / from the beginning of the asset ids to be used in ee module
+    all_assets = [collection.assetId(asset).lstrip('/') for asset in collection.assets]
     return all_assets
 
 def initialize_ee():
@@ -872,8 +935,8 @@ def updateResourceWatch(new_dates_historical, new_dates_forecast):
         var = VARS[var_num]
         # specify GEE collection name
         collection = getCollectionName('historical', var)
-        # get a list of assets in the collection
-        existing_assets = eeUtil.ls(collection)
+        # get a list of assets in the collection from the cache of its contents
+        existing_assets = getCollectionCache(collection).assets
         try:
             # Get the most recent date from the data in the GEE collection
             most_recent_date = get_most_recent_date(existing_assets)
@@ -937,40 +1000,43 @@ def main():
     logging.info('Getting new dates to pull.')
     new_dates_historical = getNewDatesHistorical(existing_dates)
     
+    # there is no first date if there are no new dates to fetch
+    first_date = None
     if new_dates_historical:
         # convert date string to datetime object and go back one day 
         first_date = datetime.datetime.strptime(new_dates_historical[0], DATE_FORMAT) - datetime.timedelta(days=1)
         # generate a string from the datetime object
         first_date = datetime.datetime.strftime(first_date, DATE_FORMAT)
-    # Fetch new files
+    # Fetch new files and calculate the daily metric for every variable and date
     logging.info('Fetching files for {}'.format(new_dates_historical))
-    for new_date_historical in new_dates_historical:
-        files, files_by_date = fetch(new_date_historical, first_date, SOURCE_URL_HISTORICAL, period='historical')
+    tifs_by_var, urls = fetchAndComposite(new_dates_historical, first_date, SOURCE_URL_HISTORICAL, period='historical')
 
-        # Process historical data, one variable at a time
-        for var_num in range(len(VARS)):
-            logging.info('Processing {}'.format(VARS[var_num]))
-            # get variable name
-            var = VARS[var_num]
+    # Upload historical data for every variable at once, don't delete any historical assets
+    uploads = newUploads()
+    new_assets_by_var = {var: processNewData(var, tifs_by_var[var], period='historical', assets_to_delete=[], uploads=uploads) for var in VARS}
+    uploadAssets(uploads)
+    # the netcdfs will not be needed again now that their data has been uploaded, so remove them from the download cache
+    DownloadManager(CACHE_DIR).forget(urls)
 
-            # Process new data files, don't delete any historical assets
-            new_assets_historical = processNewData(var, files, files_by_date, period='historical', assets_to_delete=[])
-            logging.info('Previous assets for {}: {}, new: {}, max: {}'.format(var, len(existing_dates_by_var[var_num]), len(new_dates_historical), MAX_ASSETS))
-
-            # Delete extra assets, past our maximum number allowed that we have set
-            # get list of existing assets in current variable's GEE collection
-            existing_assets = eeUtil.ls(getCollectionName(period, var))
-            # make list of all assets by combining existing assets with new assets
-            all_assets_historical = np.sort(np.unique(existing_assets + [os.path.split(asset)[1] for asset in new_assets_historical]))
-            # delete the excess assets
-            deleteExcessAssets(getCollectionName(period, var), all_assets_historical, MAX_ASSETS)
-            logging.info('SUCCESS for {}'.format(var))
+    # Clean up historical data, one variable at a time
+    for var_num in range(len(VARS)):
+        logging.info('Processing {}'.format(VARS[var_num]))
+        # get variable name
+        var = VARS[var_num]
+        new_assets_historical = new_assets_by_var[var]
+        logging.info('Previous assets for {}: {}, new: {}, max: {}'.format(var, len(existing_dates_by_var[var_num]), len(new_dates_historical), MAX_ASSETS))
 
-            # Delete local tif files because we will run out of space
-            delete_local(ext = '.tif')
+        # Delete extra assets, past our maximum number allowed that we have set
+        # get list of existing assets in current variable's GEE collection from the cache of its contents
+        existing_assets = getCollectionCache(getCollectionName(period, var)).assets
+        # make list of all assets by combining existing assets with new assets
+        all_assets_historical = np.sort(np.unique(existing_assets + [os.path.split(asset)[1] for asset in new_assets_historical]))
+        # delete the excess assets
+        deleteExcessAssets(getCollectionName(period, var), all_assets_historical, MAX_ASSETS)
+        logging.info('SUCCESS for {}'.format(var))
 
-        # Delete local netcdf files
-        delete_local()
+    # Delete local tif files because we will run out of space
+    delete_local(ext = '.tif')
 
     '''
     Process Forecast Data
@@ -993,37 +1059,38 @@ def main():
     logging.info('Getting new dates to pull.')
     new_dates_forecast = getNewDatesForecast(existing_dates)
 
+    # there is no first date if there are no new dates to fetch
+    first_date = None
     if new_dates_forecast:
         # convert date string to datetime object and go back one day
         first_date = datetime.datetime.strptime(new_dates_forecast[0], DATE_FORMAT) - datetime.timedelta(days=1)
         # generate a string from the datetime object
         first_date = datetime.datetime.strftime(first_date, DATE_FORMAT)
-    # Fetch new files
+    # Fetch new files and calculate the daily metric for every variable and forecast day
     logging.info('Fetching files for {}'.format(new_dates_forecast))
-    
-    new_layers = 0
-    for new_date_forecast in new_dates_forecast:
-        files, files_by_date = fetch(new_date_forecast, first_date, SOURCE_URL_FORECAST, period='forecast')
-        new_layers += 1
-        # Process forecast data, one variable at a time
-        for var_num in range(len(VARS)):
-            logging.info('Processing {}'.format(VARS[var_num]))
-            # get variable name
-            var = VARS[var_num]
-
-            # Process new data files, delete all forecast assets currently in collection
-            if new_date_forecast == new_dates_forecast[0]:
-                new_assets_forecast = processNewData(var, files, files_by_date, period='forecast', assets_to_delete=listAllCollections(var, period))
-            else:
-                new_assets_forecast = processNewData(var, files, files_by_date, period='forecast', assets_to_delete=[])
-            logging.info('New assets for {}: {}, max: {}'.format(var, new_layers, MAX_ASSETS))
-            logging.info('SUCCESS for {}'.format(var))
+    tifs_by_var, urls = fetchAndComposite(new_dates_forecast, first_date, SOURCE_URL_FORECAST, period='forecast')
+
+    # Upload forecast data for every variable at once
+    uploads = newUploads()
+    for var_num in range(len(VARS)):
+        logging.info('Processing {}'.format(VARS[var_num]))
+        # get variable name
+        var = VARS[var_num]
+
+        # Queue new data files, delete all forecast assets currently in collection
+        if tifs_by_var[var]:
+            processNewData(var, tifs_by_var[var], period='forecast', assets_to_delete=listAllCollections(var, period), uploads=uploads)
+        logging.info('New assets for {}: {}, max: {}'.format(var, len(tifs_by_var[var]), MAX_ASSETS))
+    uploadAssets(uploads)
+    # the netcdfs will not be needed again now that their data has been uploaded, so remove them from the download cache
+    DownloadManager(CACHE_DIR).forget(urls)
+    logging.info('SUCCESS for {}'.format(', '.join(VARS)))
 
-            # Delete local tif files because we will run out of space
-            delete_local(ext = '.tif')
+    # Delete local tif files because we will run out of space
+    delete_local(ext = '.tif')
 
-        # Delete local netcdf files
-        delete_local()
+    # Remove files left in the download cache by failed runs that have not been used for CACHE_MAX_AGE
+    DownloadManager(CACHE_DIR).prune(CACHE_MAX_AGE)
 
     # Update Resource Watch
     updateResourceWatch(new_dates_historical, new_dates_forecast)
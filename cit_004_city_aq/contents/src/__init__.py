@@ -7,6 +7,12 @@ import cartosql
 import requests
 import json
 import time
+import codecs
+import functools
+import glob
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 import cartoframes
@@ -18,6 +24,12 @@ CLEAR_TABLE_FIRST = False
 # name of data directory in Docker container
 DATA_DIR = 'data'
 
+# local cache of the station table, kept between runs so the Carto table only needs to be read when it has changed
+STATION_CACHE = os.path.join('cache', 'cit_004_city_aq_stations.json')
+
+# number of new stations to fetch from the API at the same time
+STATION_WORKERS = 8
+
 # Carto username and API key for account where we will store the data
 CARTO_USER = os.getenv('CARTO_USER')
 CARTO_KEY = os.getenv('CARTO_KEY')
@@ -251,33 +263,207 @@ def getConversion_ugm3_ppb(gas):
         s = 1.96
     return s
 
-def processStnData(stn_data):
+def processStnData(stn_data_list):
+    '''
+    process new station data and send it to the Carto table in one batch
+    INPUT   stn_data_list: data for each new station from API (list of json)
+    RETURN  dictionary of the new stations keyed by station id, each with its geojson geometry and name (dictionary)
+    '''
+    # create an empty list to store a row of data for each station
+    rows = []
+    for stn_data in stn_data_list:
+        # create an empty list to store data from this row
+        row = []
+        # go through each column in the Carto table
+        for field in STATION_CARTO_SCHEMA.keys():
+            # if we are fetching data for geometry column
+            if field == 'the_geom':
+                # get geojson geometry
+                data = stn_data.get("geometry")
+                # add geojson geometry to the list of data from this row
+                row.append(data)
+            elif field=='id':
+                # get id
+                data = stn_data.get("id")
+                # add to the list of data from this row
+                row.append(data)
+            elif field=='name':
+                # get station name
+                name = stn_data.get("properties")['name']
+                # add to the list of data from this row
+                row.append(name)
+        rows.append(row)
+    if rows:
+        cartosql.insertRows(STATION_CARTO_TABLE, STATION_CARTO_SCHEMA.keys(), STATION_CARTO_SCHEMA.values(), rows, user=CARTO_USER, key=CARTO_KEY)
+    return {str(stn_data['id']): {'the_geom': stn_data.get('geometry'), 'name': stn_data.get('properties')['name']}
+            for stn_data in stn_data_list}
+
+def fetchStation(stn):
+    '''
+    fetch data for one station from the API
+    INPUT   stn: station number (integer)
+    RETURN  station data from API (json), or None if it could not be fetched
+    '''
+    # generate url to get details of the station being processed
+    stn_url = STATION_URL.format(station = stn)
+    for tries in range(3):
+        # get data from station url
+        stn_r = requests.get(stn_url)
+        if stn_r.ok:
+            # pull data from request response json
+            return stn_r.json()
+        logging.error('Could not fetch station data for station: {}, trying again'.format(stn))
+        time.sleep(100)
+    logging.error('Could not fetch station data for station: {}, aborting'.format(stn))
+    return None
+
+def addNewStations(stations, station_lookup):
+    '''
+    fetch new stations concurrently, upload them to the Carto station table in one batch and add them to the cache
+    INPUT   stations: station numbers that are not in the station table yet (set of integers)
+            station_lookup: dictionary of known stations keyed by station id (dictionary)
+    RETURN  station_lookup: dictionary of known stations, including the new ones that could be fetched (dictionary)
+    '''
+    logging.info('Fetching {} new stations'.format(len(stations)))
+    with ThreadPoolExecutor(max_workers=STATION_WORKERS) as executor:
+        stn_data_list = [stn_data for stn_data in executor.map(fetchStation, sorted(stations)) if stn_data]
+    station_lookup.update(processStnData(stn_data_list))
+    saveStationCache(station_lookup)
+    return station_lookup
+
+@functools.lru_cache(maxsize=None)
+def parseDatetime(date_str):
+    '''
+    Convert a date string from the source to a datetime; forecasts share a handful of dates, so results are cached
+    INPUT   date_str: date in the format DATETIME_FORMAT (string)
+    RETURN  date as a datetime (datetime)
+    '''
+    return datetime.datetime.strptime(date_str, DATETIME_FORMAT)
+
+def iterRecords(files, chunk_size=1024 * 1024):
+    '''
+    Stream the records of a JSON array that was written across several files
+    Records split between two files are joined back together rather than dropped
+    INPUT   files: paths to the files, in the order they were written (list of strings)
+            chunk_size: number of bytes to read at a time (integer)
+    RETURN  generator of records (dictionaries)
+    '''
+    decoder = json.JSONDecoder()
+    # decode the bytes incrementally, so characters split between two files are kept intact
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    # characters between records: whitespace, commas and the brackets of the array
+    separators = re.compile(r'[\s,\[\]]*')
+    buf = ''
+    for path in files:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                buf += utf8.decode(chunk)
+                pos = 0
+                while True:
+                    pos = separators.match(buf, pos).end()
+                    try:
+                        record, end = decoder.raw_decode(buf, pos)
+                    except ValueError:
+                        # the rest of the buffer is an incomplete record; wait for more data
+                        break
+                    yield record
+                    pos = end
+                buf = buf[pos:]
+    buf += utf8.decode(b'', final=True)
+    if separators.sub('', buf):
+        raise ValueError('Truncated record at end of data: {}'.format(buf[:100]))
+
+def getStationLookup(existing_stations):
+    '''
+    Get the geometry and name of every station, from the local cache if it has every station in the Carto table
+    INPUT   existing_stations: list of station IDs that we already have in our Carto table (list of strings)
+    RETURN  dictionary of stations keyed by station id, each with its geojson geometry and name (dictionary)
+    '''
+    # load the stations cached by the previous run
+    if os.path.exists(STATION_CACHE):
+        with open(STATION_CACHE) as f:
+            station_lookup = json.load(f)
+        # use the cache as long as it has every station in the Carto table
+        if set(existing_stations) <= set(station_lookup):
+            logging.info('Loaded {} stations from {}'.format(len(station_lookup), STATION_CACHE))
+            return station_lookup
+    # otherwise read the whole station table from Carto and cache it
+    station_df = cartoframes.read_carto(STATION_CARTO_TABLE, credentials=AUTH)
+    station_lookup = {str(stn_id): {'the_geom': mapping(geom), 'name': name}
+                      for stn_id, geom, name in zip(station_df['id'], station_df['the_geom'], station_df['name'])}
+    saveStationCache(station_lookup)
+    return station_lookup
+
+def saveStationCache(station_lookup):
+    '''
+    Save the stations to the local cache
+    INPUT   station_lookup: dictionary of stations keyed by station id (dictionary)
+    '''
+    os.makedirs(os.path.dirname(STATION_CACHE), exist_ok=True)
+    # write to a temporary file first so an interrupted run never leaves a partial cache
+    with open(STATION_CACHE + '.tmp', 'w') as f:
+        json.dump(station_lookup, f)
+    os.replace(STATION_CACHE + '.tmp', STATION_CACHE)
+
+def buildRow(uid, created, dt, obs, station):
     '''
-    process new station data and send to Carto table
-    INPUT   stn_data: station data from API (json)
+    Build a row of data for the Carto table from an observation
+    INPUT   uid: unique id for the row (string)
+            created: date when forecast was generated (string)
+            dt: date for current data row (string)
+            obs: observation from the API (dictionary)
+            station: geojson geometry and name of the observation's station (dictionary)
+    RETURN  row: values for each column in the Carto table (list)
     '''
     # create an empty list to store data from this row
     row = []
     # go through each column in the Carto table
-    for field in STATION_CARTO_SCHEMA.keys():
+    for field in CARTO_SCHEMA.keys():
         # if we are fetching data for geometry column
         if field == 'the_geom':
-            # get geojson geometry
-            data = stn_data.get("geometry")
-            # add geojson geometry to the list of data from this row
-            row.append(data)
-        elif field=='id':
-            # get id
-            data = stn_data.get("id")
-            # add to the list of data from this row
-            row.append(data)
-        elif field=='name':
-            # get station name
-            name = stn_data.get("properties")['name']
-            # add to the list of data from this row
-            row.append(name)
-    cartosql.insertRows(STATION_CARTO_TABLE, STATION_CARTO_SCHEMA.keys(), STATION_CARTO_SCHEMA.values(), [row], user=CARTO_USER, key=CARTO_KEY)
-
+            # add the station's geojson geometry to the list of data from this row
+            row.append(station['the_geom'])
+        # if we are fetching data for unique id column
+        elif field == 'uid':
+            # add already generated unique id to the list of data from this row
+            row.append(uid)
+        # if we are fetching data for station name
+        elif field == 'name':
+            # add the station name to the list of data from this row
+            row.append(station['name'])
+        # if we are fetching data for date of forecast creation column
+        elif field == 'created':
+            # add the forecast creation date as a datetime to the list of data from this row
+            row.append(parseDatetime(created))
+        # if we are fetching data for date column
+        elif field == 'date':
+            # add the date as a datetime to the list of data from this row
+            row.append(parseDatetime(dt))
+        # remaining fields to process are the different air quality variables
+        else:
+            # get unit for column we are processing
+            unit = field.rsplit('_', 1)[1]
+            # get gas for column we are processing
+            gas = field.rsplit('_', 1)[0]
+            # get concentratiion
+            conc = obs['gas'].get(gas)
+            # the API returns data in units of µg/m3, so no conversion is necessary for this column
+            # add the data to the row
+            if unit == 'ugm3':
+                row.append(conc)
+            # if we are processing a ppm column, convert units from µg/m3 and add the data to the row
+            if unit == 'ppm':
+                if conc is not None:
+                    row.append(conc/getConversion_ugm3_ppb(gas)/1000)
+                else:
+                    row.append(None)
+            # if we are processing a ppb column, convert units from µg/m3 and add the data to the row
+            if unit == 'ppb':
+                if conc is not None:
+                    row.append(conc/getConversion_ugm3_ppb(gas))
+                else:
+                    row.append(None)
+    return row
 
 def processNewData(src_url, existing_ids, existing_stations):
     '''
@@ -296,6 +482,7 @@ def processNewData(src_url, existing_ids, existing_stations):
     # Limit for each of the json files 
     file_size = 52428800
     
+    start = time.time()
     for i in range(0, n_tries):
         try: 
             # Create path to json file where we're writing the API response
@@ -323,162 +510,80 @@ def processNewData(src_url, existing_ids, existing_stations):
             time.sleep(300)
         
         else:
-            break
+            # make sure the last json file is completely written before we read it
             f_out.close()
+            break
     else:
         logging.info('Failed to fetch data.')
         raise fetch_exception
    
     
+    logging.info('Fetched data in {:.1f}s'.format(time.time() - start))
+
+    # create a set to look up the ids already in the Carto table in constant time
+    existing_id_set = set(existing_ids)
     # create an empty list to store unique ids of new data we will be sending to Carto table
-    logging.info('Creating list to store unique ids')
     new_ids = []
+    # create a set to look up the ids we have already added to the list in constant time
+    new_id_set = set()
     # create an empty list to store each row of new data
-    logging.info('Creating list to store new rows')
     new_rows = []
-    # List containing the json files where the API response will be stored
-    logging.info('Creating list with json file paths')
-    raw_files = os.listdir(DATA_DIR)
-    # get most updated list of station information
+    # get the oldest forecast creation date in the current Carto table, if there are existing IDs in the table
+    oldest_forecast_dt = getForecastCreationDT(existing_ids, old_or_new='oldest') if existing_ids else None
+    # get station information, from the local cache if it is up to date
     logging.info('Getting station table')
-    station_df = cartoframes.read_carto('cit_004_city_aq_stations', credentials=AUTH)
-    # Iterating over the json files
-    for index_num,element in enumerate(raw_files):
-        with open(os.path.join(DATA_DIR,raw_files[index_num])) as f:
-            # Reading json file contents as a list of strings
-            json_data = f.read()
-        # Spliting elements in list as different lines
-        all_json = json_data.split('\n')
-        # Removing unnecesary commas at the end of strings
-        all_json = [x[:-1] for x in all_json]
-        # Removing corrupted first line
-        all_json = all_json[1:]
-        # Removing corrupted last line 
-        all_json = all_json[:-1]
-        # Sending clean data to a json object
-        logging.info('Pulling json data')
-        data = [json.loads(i) for i in all_json if i] 
-        # Order json data by date
-        logging.info('Ordering json by creation date')
-        data = sorted(data, key = lambda x: datetime.datetime.strptime(x["created"],"%Y-%m-%dT%H:%M:%S.%fZ"))
-        logging.info('Reversing data')
-        data.reverse()    
-
-        # Start processing batch of data 
-        logging.info('Processing batch of data')
-        # loop until no new observations
-        for obs in data:
-            # get the forecast creation date
-            created = obs['created']
-            # if there are existing IDs in the table, make sure the obs isn't older than the oldest
-            if existing_ids:
-                # get the oldest forecast creation date in the current Carto table:
-                oldest_forecast_dt = getForecastCreationDT(existing_ids, old_or_new='oldest')
-                # if the forecast creation date of the current observation is older than 
-                # the oldest in the table, skip this observation
-                if datetime.datetime.strptime(created, DATETIME_FORMAT) < oldest_forecast_dt:
-                    logging.info('Observation older than oldest record in table, moving to next batch.')
-                    break
-            # get the date from date feature 
-            dt = obs['date']
-            # get the station number from 'station' feature
-            stn = obs['station']
-            # generate unique id by using the date and station number
-            uid = genUID(created, dt, stn)
-            # if the id doesn't already exist in Carto table or 
-            # isn't added to the list for sending to Carto yet 
-            if uid not in existing_ids + new_ids:
-                # if we don't already have the station information for this station, add it to the table
-                if str(stn) not in existing_stations:
-                    # generate url to get details of the station being processed
-                    stn_url = STATION_URL.format(station = stn)
-                    tries = 0
-                    while tries < 3:
-                        # get data from station url
-                        stn_r = requests.get(stn_url)
-                        if r.ok:
-                            # pull data from request response json
-                            stn_data = stn_r.json()
-                            # process station data and send to Carto
-                            processStnData(stn_data)
-                            # add station to list of existing stations
-                            existing_stations.append(str(stn_data['id']))
-                            # get most updated list of station information
-                            station_df = cartoframes.read_carto('cit_004_city_aq_stations', credentials=AUTH)
-                            break
-                        else:
-                            logging.error('Could not fetch station data for uid: {}, trying again'.format(uid))
-                            time.sleep(100)
-                            tries += 1
-                    if tries==3:
-                        logging.error('Could not fetch station data for uid: {}, aborting'.format(uid))
-                # append the id to the list for sending to Carto 
-                new_ids.append(uid)
-                # create an empty list to store data from this row
-                row = []
-                # get station data from Carto table
-                station_row = station_df[station_df['id']==str(stn)].iloc[0]
-                # go through each column in the Carto table
-                for field in CARTO_SCHEMA.keys():
-                    # if we are fetching data for geometry column
-                    if field == 'the_geom':
-                        # construct geojson geometry
-                        geom = mapping(station_row['the_geom'])
-                        # add geojson geometry to the list of data from this row
-                        row.append(geom)
-                    # if we are fetching data for unique id column
-                    elif field == 'uid':
-                        # add already generated unique id to the list of data from this row
-                        row.append(uid)
-                    # if we are fetching data for station name
-                    elif field == 'name':
-                        # get station name from the dictionary
-                        name = station_row["name"]
-                        # add text to the list of data from this row
-                        row.append(name)
-                    # if we are fetching data for date of forecast creation column
-                    elif field == 'created':
-                        # turn already generated creation date into a datetime
-                        created = datetime.datetime.strptime(created, DATETIME_FORMAT)
-                        # add date to the list of data from this row
-                        row.append(created)
-                    # if we are fetching data for date column
-                    elif field == 'date':
-                        # turn already generated date into a datetime
-                        date = datetime.datetime.strptime(dt, DATETIME_FORMAT)
-                        # add date to the list of data from this row
-                        row.append(date)
-                    # remaining fields to process are the different air quality variables
-                    else:
-                        # get unit for column we are processing
-                        unit = field.rsplit('_', 1)[1]
-                        # get gas for column we are processing
-                        gas = field.rsplit('_', 1)[0]
-                        # get concentratiion
-                        conc = obs['gas'].get(gas)
-                        # the API returns data in units of µg/m3, so no conversion is necessary for this column
-                        # add the data to the row
-                        if unit == 'ugm3':
-                            row.append(conc)
-                        # if we are processing a ppm column, convert units from µg/m3 and add the data to the row
-                        if unit == 'ppm':
-                            if conc is not None:
-                                row.append(conc/getConversion_ugm3_ppb(gas)/1000)
-                            else:
-                                row.append(None)
-                        # if we are processing a ppb column, convert units from µg/m3 and add the data to the row
-                        if unit == 'ppb':
-                            if conc is not None:
-                                row.append(conc/getConversion_ugm3_ppb(gas))
-                            else:
-                                row.append(None)
-                # add the list of values from this row to the list of new data
-                new_rows.append(row)
-            # once we reach an observation we have already uploaded to Carto
-            # stop processing the old data
-            else:
-                logging.info('Observation exists in table, moving to next batch.')
-                break
+    station_lookup = getStationLookup(existing_stations)
+    # create an empty list to store observations from stations we don't have information for yet
+    pending = []
+    # create an empty set to store the numbers of those stations
+    new_stations = set()
+    # list of json files where the API response was stored, in the order they were written
+    raw_files = sorted(glob.glob(os.path.join(DATA_DIR, 'data_*.json')), key=lambda f: int(re.findall(r'\d+', os.path.basename(f))[0]))
+    logging.info('Processing {} json files'.format(len(raw_files)))
+    start = time.time()
+    # stream the observations across the json files, including those split between two files
+    for obs in iterRecords(raw_files):
+        # get the forecast creation date
+        created = obs['created']
+        # if the forecast creation date of the current observation is older than 
+        # the oldest in the table, skip this observation
+        if oldest_forecast_dt and parseDatetime(created) < oldest_forecast_dt:
+            continue
+        # get the date from date feature 
+        dt = obs['date']
+        # get the station number from 'station' feature
+        stn = obs['station']
+        # generate unique id by using the date and station number
+        uid = genUID(created, dt, stn)
+        # skip the observation if the id already exists in Carto table or 
+        # has already been added to the list for sending to Carto
+        if uid in existing_id_set or uid in new_id_set:
+            continue
+        new_id_set.add(uid)
+        # if we don't already have the station information for this station, 
+        # hold on to the observation until the new stations have been fetched
+        if str(stn) not in station_lookup:
+            new_stations.add(stn)
+            pending.append((uid, created, dt, obs))
+            continue
+        # append the id to the list for sending to Carto 
+        new_ids.append(uid)
+        # add the list of values from this row to the list of new data
+        new_rows.append(buildRow(uid, created, dt, obs, station_lookup[str(stn)]))
+    logging.info('Parsed {} new rows in {:.1f}s'.format(len(new_rows) + len(pending), time.time() - start))
+
+    # fetch all the new stations at once and add them to the station table
+    if new_stations:
+        start = time.time()
+        station_lookup = addNewStations(new_stations, station_lookup)
+        logging.info('Added new stations in {:.1f}s'.format(time.time() - start))
+    # process the observations from the new stations
+    for uid, created, dt, obs in pending:
+        if str(obs['station']) not in station_lookup:
+            logging.error('No station data for uid: {}, skipping'.format(uid))
+            continue
+        new_ids.append(uid)
+        new_rows.append(buildRow(uid, created, dt, obs, station_lookup[str(obs['station'])]))
     # find the length (number of rows) of new_data 
     new_count = len(new_rows)
     # Delete local files created during process
@@ -487,9 +592,11 @@ def processNewData(src_url, existing_ids, existing_stations):
     if new_count:
         logging.info('Sending new data to Carto')
         logging.info('Pushing {} new rows'.format(new_count))
+        start = time.time()
         # insert new data into the carto table
         cartosql.insertRows(CARTO_TABLE, CARTO_SCHEMA.keys(), CARTO_SCHEMA.values(),
             new_rows, user=CARTO_USER, key=CARTO_KEY)
+        logging.info('Uploaded {} new rows in {:.1f}s'.format(new_count, time.time() - start))
     return new_ids
 
 def deleteExcessRows(table, max_rows, time_field, max_age=''):
@@ -12,6 +12,7 @@ import json
 import boto3
 from google.cloud import storage
 import shutil
+from .geeTaskScheduler import TaskScheduler, TIMEOUT_ABANDON
 
 # url for air quality data
 SOURCE_URL = 'COPERNICUS/S5P/OFFL/L3_{var}'
@@ -56,6 +57,18 @@ RESOLUTION = 3.5 #km
 # how many assets can be stored in the GEE collection before the oldest ones are deleted?
 MAX_ASSETS = 3
 
+# how many export tasks should run on GEE at once?
+MAX_TASKS = 10
+
+# how many seconds should we wait for an export task before giving up on it?
+TASK_TIMEOUT = 5000
+
+# how many seconds should we wait between checks on the export tasks?
+POLL_INTERVAL = 60
+
+# name of the NO2 file we share on Amazon S3 for the GFW data API
+NO2_S3_FILENAME = 'tropomi_nitrogen_dioxide_latest_month'
+
 # format of date (used in both the source data files and GEE)
 DATE_FORMAT = '%Y-%m-%d'
 
@@ -363,6 +376,59 @@ def fetch_multi_day_avg(var, new_dates):
             logging.debug(e)
     return dates, averages
 
+def getGcsFilename(date):
+    '''
+    get the name of the file the NO2 data for a date are exported to on Google Cloud Storage
+    INPUT   date: date of the data, in the format of the DATE_FORMAT variable (string)
+    RETURN  file name without the extension (string)
+    '''
+    return '{}_{}'.format(NO2_S3_FILENAME, date)
+
+def uploadNO2ToS3(task, date, var):
+    '''
+    Move the NO2 data exported to Google Cloud Storage for a date to Amazon S3 storage for GFW data API
+    INPUT   task: export task for the data, once it has ended (ScheduledTask)
+            date: date of the data, in the format of the DATE_FORMAT variable (string)
+            var: variable of the data (string)
+    '''
+    # the task has already logged an error if the export did not succeed
+    if not task.succeeded:
+        return
+    # set up Google Cloud Storage project and bucket objects
+    gcsClient = storage.Client(os.environ.get("CLOUDSDK_CORE_PROJECT"))
+    gcsBucket = gcsClient.bucket(os.environ.get("GEE_STAGING_BUCKET"))
+    # download data from Google Cloud Storage to local
+    logging.info('Downloading ' + date + ' ' + var + ' data from Google Cloud Storage')
+    source_blob_name = getGcsFilename(date) + '.tif'
+    raw_data_dir = os.path.join(DATA_DIR, NO2_S3_FILENAME + '.tif')
+    blob = gcsBucket.blob(source_blob_name)
+    blob.download_to_filename(raw_data_dir)
+    logging.info("Downloaded storage object {} from bucket {} to local file {}.".format(source_blob_name, os.environ.get("GEE_STAGING_BUCKET"), raw_data_dir))
+    # delete file on Google Cloud Storage
+    gcsBucket.delete_blob(source_blob_name)
+    logging.info("Deleted storage object {}.".format(source_blob_name))
+    # upload local data to Amazon S3 storage
+    logging.info('Uploading ' + date + ' ' + var + ' data to AWS Bucket')
+    # set up Amazon S3 storage and bucket object
+    aws_bucket = 'wri-public-data'
+    s3_prefix = 'resourcewatch/gfw_data_api_rw_datasets/tropomi_nitrogen_dioxide_latest_month/v{}/raw/'.format(datetime.datetime.strptime(date, '%Y-%m-%d').date().strftime('%Y%m%d'))
+    s3 = boto3.client('s3', aws_access_key_id = os.getenv('S3_ACCESS_KEY'), aws_secret_access_key = os.getenv('S3_SECRET_KEY'))
+    # upload raw data file to Amazon S3 storage
+    s3.upload_file(raw_data_dir, aws_bucket, s3_prefix + os.path.basename(raw_data_dir))
+    # remove old files in the bucket
+    version_list = []
+    remove_list = []
+    for key in reversed(s3.list_objects(Bucket = aws_bucket, Prefix = 'resourcewatch/gfw_data_api_rw_datasets/tropomi_nitrogen_dioxide_latest_month')['Contents']):
+        if len(version_list) < MAX_ASSETS:
+            if key['Key'][77:86] not in version_list:
+                version_list.append(key['Key'][77:86])
+        else:
+            if key['Key'][77:86] != '.DS_Store' and key['Key'][77:86] != 'v20211015':
+                s3.delete_object(Bucket = aws_bucket, Key = key['Key'])
+                if key['Key'][77:86] not in remove_list:
+                    remove_list.append(key['Key'][77:86])
+    logging.info('Remove data version in AWS S3: {} '.format(remove_list))
+
 def processNewData(var, existing_dates):
     '''
     Fetch, process, and upload clean new data
@@ -390,102 +456,35 @@ def processNewData(var, existing_dates):
         scale = RESOLUTION*1000
         # create the geometry bounds for the image we want to upload
         geometry = ee.Geometry.Rectangle([-lon, -lat, lon, lat], 'EPSG:4326', False)
-        # upload each image
+        # export all of the images at once, rather than waiting for each export to finish before starting the next
+        scheduler = TaskScheduler(max_in_flight=MAX_TASKS, poll_interval=POLL_INTERVAL,
+                                  timeout=TASK_TIMEOUT, on_timeout=TIMEOUT_ABANDON)
         for i in range(len(dates)):
             logging.info('Uploading ' + assets[i])
             # export the averaged image to a new asset in GEE
             task = ee.batch.Export.image.toAsset(images[i],
                                                  assetId=assets[i],
                                                  region=geometry, scale=scale, maxPixels=1e13)
-            task.start()
-            # set the state to 'RUNNING' because we have started the task
-            state = 'RUNNING'
-            # set a start time to track the time it takes to upload the image
-            start = time.time()
-            # wait for task to complete, but quit if it takes more than 5000 seconds
-            while state == 'RUNNING' and (time.time() - start) < 5000:
-                # wait for a minute before checking the state
-                time.sleep(60)
-                # check the status of the upload
-                status = task.status()['state']
-                logging.info('Current Status: ' + status +', run time (min): ' + str((time.time() - start)/60))
-                # log if the task is completed and change the state
-                if status == 'COMPLETED':
-                    state = status
-                    logging.info(status)
-                # log an error if the task fails and change the state
-                elif status == 'FAILED':
-                    state = status
-                    logging.error(task.status()['error_message'])
-                    logging.debug(task.status())
+            scheduler.submit(task, name=assets[i])
 
             # upload NO2 data to Amazon S3 storage for GFW data API
             if var == 'NO2':
-                # set up Google Cloud Storage project and bucket objects
-                gcsClient = storage.Client(os.environ.get("CLOUDSDK_CORE_PROJECT"))
-                gcsBucket = gcsClient.bucket(os.environ.get("GEE_STAGING_BUCKET"))
                 logging.info('Exporting ' + dates[i] + ' ' + var + ' data to Google Cloud Storage')
-                # export the averaged image to a Google Cloud Storage
+                # export the averaged image to a Google Cloud Storage, using a separate file for each date
+                # so that the exports can run at the same time
                 task = ee.batch.Export.image.toCloudStorage(image = images[i],
                                                             description = 'imageToCloudExample',
                                                             bucket = os.environ.get("GEE_STAGING_BUCKET"),
-                                                            fileNamePrefix = 'tropomi_nitrogen_dioxide_latest_month',
+                                                            fileNamePrefix = getGcsFilename(dates[i]),
                                                             scale = scale,
                                                             region = geometry,
                                                             maxPixels = 1e13)
-                task.start()
-                # set the state to 'RUNNING' because we have started the task
-                state = 'RUNNING'
-                # set a start time to track the time it takes to upload the image
-                start = time.time()
-                # wait for task to complete, but quit if it takes more than 5000 seconds
-                while state == 'RUNNING' and (time.time() - start) < 5000:
-                    # wait for a minute before checking the state
-                    time.sleep(60)
-                    # check the status of the upload
-                    status = task.status()['state']
-                    logging.info('Current Status: ' + status +', run time (min): ' + str((time.time() - start)/60))
-                    # log if the task is completed and change the state
-                    if status == 'COMPLETED':
-                        state = status
-                        logging.info(status)
-                    # log an error if the task fails and change the state
-                    elif status == 'FAILED':
-                        state = status
-                        logging.error(task.status()['error_message'])
-                        logging.debug(task.status())
-
-                # download data from Google Cloud Storage to local
-                logging.info('Downloading ' + dates[i] + ' ' + var + ' data from Google Cloud Storage')
-                source_blob_name = 'tropomi_nitrogen_dioxide_latest_month.tif'
-                raw_data_dir = os.path.join(DATA_DIR, source_blob_name)
-                blob = gcsBucket.blob(source_blob_name)
-                blob.download_to_filename(raw_data_dir)
-                logging.info("Downloaded storage object {} from bucket {} to local file {}.".format(source_blob_name, os.environ.get("GEE_STAGING_BUCKET"), raw_data_dir))
-                # delete file on Google Cloud Storage
-                gcsBucket.delete_blob(source_blob_name)
-                logging.info("Deleted storage object {}.".format(source_blob_name))
-                # upload local data to Amazon S3 storage
-                logging.info('Uploading ' + dates[i] + ' ' + var + ' data to AWS Bucket')
-                # set up Amazon S3 storage and bucket object
-                aws_bucket = 'wri-public-data'
-                s3_prefix = 'resourcewatch/gfw_data_api_rw_datasets/tropomi_nitrogen_dioxide_latest_month/v{}/raw/'.format(datetime.datetime.strptime(dates[i], '%Y-%m-%d').date().strftime('%Y%m%d'))
-                s3 = boto3.client('s3', aws_access_key_id = os.getenv('S3_ACCESS_KEY'), aws_secret_access_key = os.getenv('S3_SECRET_KEY'))
-                # upload raw data file to Amazon S3 storage
-                s3.upload_file(raw_data_dir, aws_bucket, s3_prefix + os.path.basename(raw_data_dir))
-                # remove old files in the bucket
-                version_list = []
-                remove_list = []
-                for key in reversed(s3.list_objects(Bucket = aws_bucket, Prefix = 'resourcewatch/gfw_data_api_rw_datasets/tropomi_nitrogen_dioxide_latest_month')['Contents']):
-                    if len(version_list) < MAX_ASSETS:
-                        if key['Key'][77:86] not in version_list:
-                            version_list.append(key['Key'][77:86])
-                    else:
-                        if key['Key'][77:86] != '.DS_Store' and key['Key'][77:86] != 'v20211015':
-                            s3.delete_object(Bucket = aws_bucket, Key = key['Key'])
-                            if key['Key'][77:86] not in remove_list:
-                                remove_list.append(key['Key'][77:86])   
-                logging.info('Remove data version in AWS S3: {} '.format(remove_list))
+                # once the export has finished, move the file to Amazon S3 storage
+                scheduler.submit(task, name=getGcsFilename(dates[i]),
+                                 callback=lambda task, date=dates[i]: uploadNO2ToS3(task, date, var))
+
+        # wait for all of the exports to finish
+        scheduler.run()
     # if no new assets, return empty list
     else:
         assets = []
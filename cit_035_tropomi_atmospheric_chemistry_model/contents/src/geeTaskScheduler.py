@@ -0,0 +1,217 @@
+'''
+Run Google Earth Engine ingestion and export tasks side by side
+Example:
+```
+from geeTaskScheduler import TaskScheduler
+scheduler = TaskScheduler(max_in_flight=10, timeout=5000)
+for image, asset in zip(images, assets):
+    task = ee.batch.Export.image.toAsset(image, assetId=asset, region=geometry, scale=scale)
+    scheduler.submit(task, name=asset, callback=onDone)
+results = scheduler.run()
+```
+Every task is handed to the scheduler up front. Up to `max_in_flight` of
+them are started at once, and every task still running is checked with a
+single ee.data.getTaskStatus call per poll, so a backlog of uploads takes
+about as long as the slowest one instead of the sum of all of them.
+
+A task that runs for longer than `timeout` seconds is cancelled, or with
+`on_timeout=TIMEOUT_ABANDON` left running on Earth Engine and no longer
+waited for. Either way it ends in the TIMED_OUT state.
+
+Connectors build their Docker images from their own folder, so copy this
+file next to the connector's `__init__.py` to use it.
+'''
+import logging
+import time
+
+import ee
+
+# states Earth Engine reports for tasks that have ended
+TASK_FINISHED_STATES = (ee.batch.Task.State.COMPLETED,
+                        ee.batch.Task.State.FAILED,
+                        ee.batch.Task.State.CANCELLED)
+# state given to tasks that ran for longer than the timeout
+TIMED_OUT = 'TIMED_OUT'
+# what to do with a task that runs for longer than the timeout
+TIMEOUT_CANCEL = 'cancel'
+TIMEOUT_ABANDON = 'abandon'
+
+# tasks running on Earth Engine at once
+MAX_IN_FLIGHT = 10
+# seconds to wait between status checks
+POLL_INTERVAL = 10
+# seconds to let a task run before giving up on it
+TIMEOUT = 3600
+# seconds between progress messages
+LOG_INTERVAL = 60
+
+
+class ScheduledTask(object):
+    '''
+    A task handed to the scheduler and what became of it
+    `id` and `started` are set once the task is started; `state`,
+    `error_message` and `finished` are kept up to date while it runs
+    '''
+    def __init__(self, start, name=None, callback=None):
+        self.start = start
+        self.name = name
+        self.callback = callback
+        self.id = None
+        self.state = ee.batch.Task.State.UNSUBMITTED
+        self.error_message = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def done(self):
+        return self.state in TASK_FINISHED_STATES + (TIMED_OUT,)
+
+    @property
+    def succeeded(self):
+        return self.state == ee.batch.Task.State.COMPLETED
+
+    @property
+    def elapsed(self):
+        '''Seconds the task has been running, or ran for'''
+        if self.started is None:
+            return 0
+        return (self.finished or time.time()) - self.started
+
+    def __repr__(self):
+        return '<ScheduledTask {} {} {}>'.format(self.name, self.id, self.state)
+
+
+class TaskScheduler(object):
+    '''
+    Starts Earth Engine tasks, keeping up to `max_in_flight` of them
+    running, and waits for all of them to end
+    `timeout` seconds each task may run; `on_timeout` TIMEOUT_CANCEL to
+    cancel tasks that run longer, TIMEOUT_ABANDON to leave them running
+    `callback` called with each ScheduledTask once it has ended, after
+    the task's own callback
+    '''
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, poll_interval=POLL_INTERVAL,
+                 timeout=TIMEOUT, on_timeout=TIMEOUT_CANCEL, callback=None):
+        if on_timeout not in (TIMEOUT_CANCEL, TIMEOUT_ABANDON):
+            raise ValueError('Unknown timeout policy: {}'.format(on_timeout))
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+        self.callback = callback
+        self.tasks = []
+
+    def submit(self, start, name=None, callback=None):
+        '''
+        Add a task to run; `start` is either an unstarted ee.batch.Task or
+        a function that starts a task and returns its id, such as
+        assetManagement.transferGEE
+        `callback` called with the ScheduledTask once it has ended
+        '''
+        task = ScheduledTask(start, name, callback)
+        self.tasks.append(task)
+        return task
+
+    def watch(self, task_id, name=None, callback=None):
+        '''Wait for a task that has already been started'''
+        task = self.submit(None, name or task_id, callback)
+        task.id = task_id
+        task.state = ee.batch.Task.State.READY
+        task.started = time.time()
+        return task
+
+    def _start(self, task):
+        '''Start a task, marking it as failed if it cannot be started'''
+        task.started = time.time()
+        try:
+            if isinstance(task.start, ee.batch.Task):
+                task.start.start()
+                task.id = task.start.id
+            else:
+                task.id = task.start()
+            task.state = ee.batch.Task.State.READY
+            logging.info('Started task {} for {}'.format(task.id, task.name))
+        except Exception as e:
+            task.error_message = str(e)
+            self._finish(task, ee.batch.Task.State.FAILED)
+
+    def _finish(self, task, state):
+        '''Record that a task has ended and call its callbacks'''
+        task.state = state
+        task.finished = time.time()
+        if task.succeeded:
+            logging.info('Task {} for {} completed after {:.0f} seconds'.format(task.id, task.name, task.elapsed))
+        else:
+            logging.error('Task {} for {} ended at state {} after {:.0f} seconds: {}'.format(
+                task.id, task.name, state, task.elapsed, task.error_message))
+        for callback in (task.callback, self.callback):
+            if callback is None:
+                continue
+            try:
+                callback(task)
+            except Exception as e:
+                logging.error('Callback for task {} failed: {}'.format(task.name, e))
+
+    def _timeOut(self, task):
+        '''Stop waiting for a task that has run for longer than the timeout'''
+        if self.on_timeout == TIMEOUT_CANCEL:
+            try:
+                ee.data.cancelTask(task.id)
+            except Exception as e:
+                logging.warning('Unable to cancel task {}: {}'.format(task.id, e))
+        task.error_message = 'Timed out after {} seconds'.format(self.timeout)
+        self._finish(task, TIMED_OUT)
+
+    def poll(self):
+        '''Check the status of every running task with a single request'''
+        running = [task for task in self.tasks if task.id is not None and not task.done]
+        if not running:
+            return
+        try:
+            statuses = {status['id']: status for status in ee.data.getTaskStatus([task.id for task in running])}
+        except Exception as e:
+            # keep waiting, the next poll may get through; tasks can still time out
+            logging.warning('Unable to check task status: {}'.format(e))
+            statuses = {}
+        for task in running:
+            status = statuses.get(task.id, {})
+            state = status.get('state', task.state)
+            task.error_message = status.get('error_message', task.error_message)
+            if state in TASK_FINISHED_STATES:
+                self._finish(task, state)
+            elif task.elapsed > self.timeout:
+                self._timeOut(task)
+            else:
+                task.state = state
+
+    def run(self):
+        '''
+        Start the submitted tasks and wait for all of them to end
+        Returns the ScheduledTasks, in the order they were submitted
+        '''
+        last_log = time.time()
+        while True:
+            # top up the tasks running on Earth Engine
+            in_flight = sum(1 for task in self.tasks if task.id is not None and not task.done)
+            for task in self.tasks:
+                if in_flight >= self.max_in_flight:
+                    break
+                if task.state == ee.batch.Task.State.UNSUBMITTED:
+                    self._start(task)
+                    in_flight += not task.done
+            if all(task.done for task in self.tasks):
+                break
+            time.sleep(self.poll_interval)
+            self.poll()
+            if time.time() - last_log >= LOG_INTERVAL:
+                logging.info('Tasks: {}'.format(self.summary()))
+                last_log = time.time()
+        logging.info('Tasks: {}'.format(self.summary()))
+        return list(self.tasks)
+
+    def summary(self):
+        '''Number of tasks in each state'''
+        counts = {}
+        for task in self.tasks:
+            counts[task.state] = counts.get(task.state, 0) + 1
+        return counts
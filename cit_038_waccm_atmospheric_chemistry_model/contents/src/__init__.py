@@ -5,7 +5,6 @@ import sys
 import urllib
 import datetime
 import logging
-import subprocess
 import eeUtil
 import urllib.request
 import requests
@@ -14,6 +13,7 @@ import copy
 import ee
 import time
 import json
+from .rasterConvert import convert as convertBands
 
 # This dataset owner has created a subset of the data specifically for our needs on Resource Watch.
 # If you want to switch back to pulling from the original source, set the following variable to False.
@@ -399,41 +399,27 @@ def convert(files, var_num, last_date):
         # get list of bands in netcdf for all available times at desired pressure level
         bands = getBands(var_num, f, last_date)
         logging.info('Converting {} to tiff'.format(f))
-        for band in bands:
-            # generate the subdatset name for current netcdf file for a particular variable
-            sds_path = SDS_NAME.format(fname=f, var=var)
-            '''
-            Google Earth Engine needs to get tif files with longitudes of -180 to 180.
-            These files have longitudes from 0 to 360. I checked this using gdalinfo.
-            I downloaded a file onto my local computer and in command line, ran:
-                    gdalinfo NETCDF:"{file_loc/file_name}":{variable}
-            with the values in {} replaced with the correct information.
-            I looked at the 'Corner Coordinates' that were printed out.
-
-            Since the longitude is in the wrong format, we will have to fix it. First,
-            we will convert the files from netcdfs to tifs using gdal_translate,
-            then we will fix the longitude values using gdalwarp.
-            '''
-            #generate names for tif files that we are going to create from netcdf
-            file_name_with_time = getTiffname(file=f, hour=TIME_HOURS[bands.index(band)], var=var)
-            #create a file for the initial tif that is in the 0 to 360 longitude format
-            tif_0_360 = '{}_0_360.tif'.format(file_name_with_time)
-            # create a file name for the final tif that is in the -180 to 180 file format
-            tif = '{}.tif'.format(file_name_with_time)
-
-            # first we will translate this file from a netcdf to a tif
-            cmd = ['gdal_translate', '-b', str(band), '-q', '-a_nodata', str(NODATA_VALUE), '-a_srs', 'EPSG:4326', sds_path, tif_0_360] #'-q' means quiet so you don't see it
-            subprocess.call(cmd)
-
-            # Now we will fix the longitude. To do this we need the x and y resolution.
-            # I also got x and y res for data set using the gdalinfo command described above.
-            xres='1.250000000000000'
-            yres= '-0.942408376963351'
-            cmd_warp = ['gdalwarp', '-t_srs', 'EPSG:4326', '-tr', xres, yres, tif_0_360, tif, '-wo', 'SOURCE_EXTRA=1000', '--config', 'CENTER_LONG', '0']
-            subprocess.call(cmd_warp) #using the gdal from command line from inside python
-
-            # add the new tif files to the list of tifs
-            all_tifs.append(tif)
+        # generate the subdatset name for current netcdf file for a particular variable
+        sds_path = SDS_NAME.format(fname=f, var=var)
+        '''
+        Google Earth Engine needs to get tif files with longitudes of -180 to 180.
+        These files have longitudes from 0 to 360. I checked this using gdalinfo.
+        I downloaded a file onto my local computer and in command line, ran:
+                gdalinfo NETCDF:"{file_loc/file_name}":{variable}
+        with the values in {} replaced with the correct information.
+        I looked at the 'Corner Coordinates' that were printed out.
+
+        Since the longitude is in the wrong format, we will have to fix it. We read all of the bands
+        for this file at once, move the columns east of 180 degrees to the western edge of the data,
+        and write each band straight to its own tif.
+        '''
+        # generate names for the tif files that we are going to create from netcdf, one for each time
+        tifs = ['{}.tif'.format(getTiffname(file=f, hour=TIME_HOURS[i], var=var)) for i in range(len(bands))]
+        # convert the bands to tifs in the -180 to 180 longitude format
+        convertBands(sds_path, [([band], tif) for band, tif in zip(bands, tifs)], nodata=NODATA_VALUE)
+
+        # add the new tif files to the list of tifs
+        all_tifs += tifs
     # If we don't want to use all the times available, we should have set the TS_FROM_END parameter at the beginning.
     if TS_FROM_END>0:
         # from the list of all the tifs created, get a list of the tifs you actually want to upload
@@ -8,6 +8,9 @@ import cartosql
 from collections import OrderedDict
 import numpy as np
 import sys
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 '''
 Useful links:
@@ -18,6 +21,9 @@ https://developers.google.com/transit/gtfs/reference/#pathwaystxt
 # name of data directory in Docker container
 DATA_DIR = 'data'
 
+# file to keep the row hash of each feed last sent to Carto in between runs
+SNAPSHOT_FILE = os.path.join('cache', 'cit_041_gtfs_snapshot.json')
+
 # Carto username and API key for account where we will store the data
 CARTO_USER = os.getenv('CARTO_USER')
 CARTO_KEY = os.getenv('CARTO_KEY')
@@ -33,7 +39,7 @@ UID_FIELD = 'feed_id'
 # column types should be one of the following: geometry, text, numeric, timestamp
 CARTO_SCHEMA = OrderedDict([
     ('the_geom', 'geometry'),
-    ('feed_id', 'numeric'),
+    ('feed_id', 'text'),
     ('feed_type', 'text'),
     ('feed_title', 'text'),
     ('loc_id', 'numeric'),
@@ -45,7 +51,25 @@ CARTO_SCHEMA = OrderedDict([
     ('timestamp_epoch', 'numeric'),
     ('ts_latest', 'timestamp'),
     ('gtfs_zip', 'text'),
-    ('gtfs_txt', 'text')
+    ('gtfs_txt', 'text'),
+    ('row_hash', 'text')
+])
+
+# columns of the flattened getFeeds results and the names we give them in the Carto table
+# described in API documentation http://transitfeeds.com/api/swagger/#!/default/getFeeds
+FEED_COLUMNS = OrderedDict([
+    ('id', 'feed_id'),
+    ('ty', 'feed_type'),
+    ('t', 'feed_title'),
+    ('l.id', 'loc_id'),
+    ('l.pid', 'ploc_id'),
+    ('l.t', 'loc_title_l'),
+    ('l.n', 'loc_title_s'),
+    ('l.lat', 'latitude'),
+    ('l.lng', 'longitude'),
+    ('latest.ts', 'timestamp_epoch'),
+    ('u.d', 'gtfs_zip'),
+    ('u.i', 'gtfs_txt'),
 ])
 
 # url for locations that provide transit feed data
@@ -66,6 +90,15 @@ DATE_FORMAT = '%Y-%m-%d'
 # maximum attempt that will be made to download the data
 MAX_TRIES = 8
 
+# number of locations to fetch feeds for at once
+LOCATION_WORKERS = 16
+
+# maximum attempts that will be made to fetch the feeds for a single location
+LOCATION_TRIES = 3
+
+# number of feeds to delete from Carto in each request
+DELETE_BLOCKSIZE = 500
+
 # Resource Watch dataset API ID
 # Important! Before testing this script:
 # Please change this ID OR comment out the getLayerIDs(DATASET_ID) function in the script below
@@ -112,6 +145,11 @@ The functions below have been tailored to this specific dataset.
 They should all be checked because their format likely will need to be changed.
 '''
 
+# pooled session for requests to the transit feed API, shared by the threads fetching location feeds
+session = requests.Session()
+adapter = requests.adapters.HTTPAdapter(pool_connections=LOCATION_WORKERS, pool_maxsize=LOCATION_WORKERS)
+session.mount('https://', adapter)
+
 def getGeom(lon, lat):
     '''
     Define point geometry from latitude and longitude
@@ -126,18 +164,6 @@ def getGeom(lon, lat):
     }
     return geometry
 
-def convert_time_since_epoch(timestamp):
-    '''
-    Function to convert seconds since the epoch to human-readable time
-    INPUT   timestamp: date, formatted as time since linux epoch (integer)
-    RETURN  formatted string of date (string)
-    '''
-    # create a datetime object from timestamp
-    value = datetime.datetime.fromtimestamp(timestamp)
-
-    return value.strftime('%Y-%m-%d')
-
-
 def location():
     '''
     Function to grab the unique location id from the locations api.
@@ -145,7 +171,7 @@ def location():
     '''
     logging.info('Fetching location ids')
     # get the transit feed data from the url through a request response json
-    r = requests.get(DATA_LOCATION_URL)
+    r = session.get(DATA_LOCATION_URL)
     json_obj = r.json()
     # store the values from the 'results' feature to a variable
     json_obj_list = json_obj['results']
@@ -164,57 +190,117 @@ def location():
     return location_id
 
 
+def fetchLocationFeed(id):
+    '''
+    Function to get the first transit feed for a location, trying again if the request fails
+    INPUT   id: location id (integer)
+    RETURN  feed information for the location, or None if the location has no feeds (dictionary)
+    '''
+    for tries in range(1, LOCATION_TRIES + 1):
+        try:
+            # generate url using id and get the data for this location
+            r = session.get(DATA_URL.format(id))
+            r.raise_for_status()
+            # store 'feeds' variable from 'result' feature of the JSON to a list
+            feed_feeds = r.json()['results']['feeds']
+            # return the data for this location, if any data is in the list
+            return feed_feeds[0] if feed_feeds else None
+        except Exception:
+            if tries == LOCATION_TRIES:
+                raise
+            time.sleep(tries)
+
 def feeds():
     '''
     Function to use API location ids to obtain the feed information and put them into a 
     pandas dataframe with all the levels of the json unpacked
     RETURN  df: dataframe of transit feed data for all locations (pandas dataframe)
     '''
-    # create an empty list to store feed results
-    feed_list = []
     logging.info('Fetching Feed info')
-    # loop through each locations in the transit feed data using 'id' variable from the JSON
-    for id in location():
-        # generate url using id and get the data for this location
-        r = requests.get(DATA_URL.format(id))
-        json_obj = r.json()
-        # store 'results' feature from the JSON to a list
-        feed_results = json_obj['results']
-        # store 'feeds' variable from 'result' feature to a list
-        feed_feeds = feed_results['feeds']
-        # append the data for this location to the feed_list, if any data is in the list
-        try:
-            feed_list.append(feed_feeds[0])
-        except:
-            continue
-    # create a pandas dataframe using feed_list
-    df_3 = pd.DataFrame(feed_list)
-    # There are some columns in the dataframe which are dictionary rather than one dimensional array
-    # we want to break the elements from those dictionary and add them as separate columns in the dataframe
-    # get the elements from the column 'l' and append them as columns to the end of the dataframe
-    # then drop the column 'l' since it's not useful anymore
-    df_2 = pd.concat([df_3.drop(['l'], axis=1), df_3['l'].apply(pd.Series)], axis=1)
-    # similarly get the elements from the column 'latest' and then drop the column
-    df_1 = pd.concat([df_2.drop(['latest'], axis=1), df_2['latest'].apply(pd.Series)], axis=1)
-    # similarly get the elements from the column 'u' and then drop the column
-    df = pd.concat([df_1.drop(['u'], axis=1), df_1['u'].apply(pd.Series)], axis=1)
-    # drop columns where all values are missing
-    df = df.dropna(axis=1, how='all')
-    # Original columns = 'id', 'ty', 't', 'id', 'pid', 't', 'n', 'lat', 'lng', 0, 'ts', 'd', 'i', 
-    # described in API documentation http://transitfeeds.com/api/swagger/#!/default/getFeeds
-    # rename the columns to be more descriptive
-    new_columns = ['feed_id', 'feed_type', 'feed_title', 'loc_id', 'ploc_id', 'loc_title_l', 'loc_title_s', 'latitude',
-                   'longitude', 'timestamp_epoch', 'gtfs_zip', 'gtfs_txt']
-    df.columns = new_columns
+    # fetch the feeds for the locations in the transit feed data, several locations at a time
+    with ThreadPoolExecutor(max_workers=LOCATION_WORKERS) as executor:
+        feed_list = [feed for feed in executor.map(fetchLocationFeed, location()) if feed]
+    logging.info('Fetched {} feeds'.format(len(feed_list)))
+    # create a pandas dataframe using feed_list, breaking the nested dictionaries ('l', 'latest' and 'u')
+    # into separate columns named after their parent, such as 'l.lat'
+    df = pd.io.json.json_normalize(feed_list)
+    # keep the columns we use, adding any that none of the feeds had, and rename them to be more descriptive
+    df = df.reindex(columns=list(FEED_COLUMNS)).rename(columns=FEED_COLUMNS)
+    # the same feed can be listed for more than one location; keep the first one
+    df = df.drop_duplicates(UID_FIELD).reset_index(drop=True)
     # add a new column for geometry using the coulmns 'latitude' and'longitude'
-    df['the_geom'] = df.apply(lambda row: getGeom(row['longitude'], row['latitude']), axis=1)
+    df['the_geom'] = [getGeom(lon, lat) for lon, lat in zip(df['longitude'], df['latitude'])]
     # replace NaN with zero and infinity with large finite numbers for 'timestamp_epoch' column
     df['timestamp_epoch'] = np.nan_to_num(df['timestamp_epoch'].values)
     # create date string from 'timestamp_epoch' column and add the values to a new column
-    df['ts_latest'] = [convert_time_since_epoch(x) for x in df['timestamp_epoch'].values]
+    df['ts_latest'] = pd.to_datetime(df['timestamp_epoch'], unit='s').dt.strftime(DATE_FORMAT)
+    # hash the contents of each feed, so we can tell which feeds have changed since the last upload
+    # the geometry is left out since it is built from the 'latitude' and 'longitude' columns
+    hash_columns = [field for field in CARTO_SCHEMA if field not in ('the_geom', 'row_hash')]
+    df['row_hash'] = pd.util.hash_pandas_object(df[hash_columns], index=False).map('{:016x}'.format)
 
     return df
 
+def loadSnapshot():
+    '''
+    Function to load the row hash of each feed that was last sent to Carto
+    RETURN  row hash for each feed id, or None if there is no snapshot (dictionary)
+    '''
+    try:
+        with open(SNAPSHOT_FILE) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def saveSnapshot(snapshot):
+    '''
+    Function to save the row hash of each feed that was sent to Carto, replacing the old snapshot only once the new
+    one has been fully written
+    INPUT   snapshot: row hash for each feed id (dictionary)
+    '''
+    os.makedirs(os.path.dirname(SNAPSHOT_FILE), exist_ok=True)
+    tmp = SNAPSHOT_FILE + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, SNAPSHOT_FILE)
+
+def getCartoHashes():
+    '''
+    Function to get the row hash of each feed in the Carto table
+    Rows written before the table had a 'row_hash' column have no hash, so they will be treated as changed
+    RETURN  row hash for each feed id in the Carto table (dictionary)
+    '''
+    # add the row_hash column to tables created before it was part of the schema
+    cartosql.sendSql('ALTER TABLE "{}" ADD COLUMN IF NOT EXISTS row_hash text'.format(CARTO_TABLE),
+                     user=CARTO_USER, key=CARTO_KEY)
+    r = cartosql.getFields([UID_FIELD, 'row_hash'], CARTO_TABLE, f='json', user=CARTO_USER, key=CARTO_KEY, post=True)
+    return {str(row[UID_FIELD]): row['row_hash'] for row in r.json()['rows']}
+
+def upsertFeeds(df, existing):
+    '''
+    Function to update the Carto table so that it matches the dataframe, only touching the feeds that have changed
+    INPUT   df: dataframe of transit feed data for all locations (pandas dataframe)
+            existing: row hash for each feed id in the Carto table (dictionary)
+    RETURN  number of feeds that were deleted and inserted (tuple of integers)
+    '''
+    new_hashes = dict(zip(df[UID_FIELD].astype(str), df['row_hash']))
+    # find the feeds that are new or whose contents have changed
+    changed = [feed_id for feed_id, row_hash in new_hashes.items() if existing.get(feed_id) != row_hash]
+    # find the feeds that need to be removed from the table: changed feeds that are already in it, and feeds that
+    # are no longer in the catalog
+    stale = [feed_id for feed_id in existing if feed_id not in new_hashes or feed_id in changed]
+    # delete the stale feeds, a block at a time
+    for i in range(0, len(stale), DELETE_BLOCKSIZE):
+        ids = ','.join("'{}'".format(feed_id.replace("'", "''")) for feed_id in stale[i:i + DELETE_BLOCKSIZE])
+        cartosql.deleteRows(CARTO_TABLE, '{} = ANY(ARRAY[{}])'.format(UID_FIELD, ids), user=CARTO_USER, key=CARTO_KEY)
+    # insert the new and changed feeds
+    if changed:
+        rows = df.loc[df[UID_FIELD].astype(str).isin(changed), list(CARTO_SCHEMA)].astype(object)
+        # make sure all null values are set to None
+        rows = rows.where(pd.notnull(rows), None)
+        cartosql.insertRows(CARTO_TABLE, CARTO_SCHEMA.keys(), CARTO_SCHEMA.values(), rows.values.tolist(),
+                            user=CARTO_USER, key=CARTO_KEY, blocksize=500)
+    return len(stale), len(changed)
 
 def processData():
     '''
@@ -243,6 +329,7 @@ def processData():
                 logging.error("Error fetching data, and max tries reached. See source for last data update.")
     # if we suceessfully collected data from the url
     if success == True:
+        new_hashes = dict(zip(df[UID_FIELD].astype(str), df['row_hash']))
         # check it the table doesn't already exist in Carto
         if not cartosql.tableExists(CARTO_TABLE, user=CARTO_USER, key=CARTO_KEY):
             logging.info('Table {} does not exist'.format(CARTO_TABLE))
@@ -253,14 +340,16 @@ def processData():
             cc = cartoframes.CartoContext(base_url="https://{user}.carto.com/".format(user=CARTO_USER),
                                           api_key=CARTO_KEY)
             cc.write(df, CARTO_TABLE, overwrite=True, privacy='link')
+        # if the catalog is the same as the one we last sent to Carto, there is nothing to write
+        elif loadSnapshot() == new_hashes:
+            logging.info('No feeds have changed since the last update')
         else:
-            # if the table already exists, delete all the rows
-            cartosql.deleteRows(CARTO_TABLE, 'cartodb_id IS NOT NULL', user=CARTO_USER, key=CARTO_KEY)
-            # Send the processed dataframe to Carto
+            # compare the feeds to the ones in the table, and only replace the feeds that have changed
             logging.info('Writing to Carto')
-            cc = cartoframes.CartoContext(base_url="https://{user}.carto.com/".format(user=CARTO_USER),
-                                          api_key=CARTO_KEY)
-            cc.write(df, CARTO_TABLE, overwrite=True, privacy='link')
+            deleted, inserted = upsertFeeds(df, getCartoHashes())
+            logging.info('Deleted {} and inserted {} feeds'.format(deleted, inserted))
+        # remember which feeds are in the table now
+        saveSnapshot(new_hashes)
 
 def main():
     logging.basicConfig(stream=sys.stderr, level=logging.INFO)
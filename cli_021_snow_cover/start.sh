@@ -9,6 +9,7 @@ docker run \
     --log-driver=syslog \
     --log-opt syslog-address=$LOG \
     --log-opt tag=$NAME \
+    -v $(pwd)/cache:/opt/$NAME/cache \
     --env-file .env \
     --rm $NAME \
     python main.py
@@ -14,6 +14,7 @@ import requests
 import time
 from dateutil.relativedelta import relativedelta
 import json
+from .rasterConvert import rollLongitudes, writeCog
 
 
 # url for surface temperature analysis data
@@ -320,57 +321,47 @@ def extract_subdata_by_date(nc_file, dtype, nodata, available_dates, target_date
             target_dates: list of new dates we want to try to get (list of strings)
     RETURN  sub_tifs: list of file names for tifs that have been generated (list of strings)
     '''
-    # open the netcdf file and create an instance of the ncCDF4 class
-    nc = Dataset(nc_file)
-    # create and empty list to store the names of the tifs we generate
-    sub_tifs = []
-    # go through each date we want to try to get and check if it is available in the netcdf
+    # find the index of each date we want to try to get in the netcdf
+    date_ixs = []
+    dates = []
     for date in target_dates:
         # find index in available date, if not available, skip this date
         try:
-            date_ix = available_dates.index(date)
+            date_ixs.append(available_dates.index(date))
+            dates.append(date)
             logging.info("Date {} found! Processing...".format(date))
-        except:
+        except ValueError:
             logging.info("Date {} not found in available dates".format(date))
-            continue
-
-        # Extract data from netcdf for the available date
-        data_tmp = nc[VAR_NAME][date_ix,:,:]
-        # change center point of data by switching left and right side of data matrix
-        data = np.zeros(data_tmp.shape)
-        data[:,:90] = data_tmp[:,90:]
-        data[:,90:] = data_tmp[:,:90]
-
-        # Create profile/tif metadata for the available date
-        south_lat = -90
-        north_lat = 90
-        west_lon = -180
-        east_lon = 180
-        # return an Affine transformation using bounds, width and height
-        transform = rio.transform.from_bounds(west_lon, south_lat, east_lon, north_lat, data.shape[1], data.shape[0])
-        # generate profile for the tif file that we will create
-        profile = {
-            'driver':'GTiff',
-            'height':data.shape[0],
-            'width':data.shape[1],
-            'count':1,
-            'dtype':dtype,
-            'crs':'EPSG:4326',
-            'transform':transform,
-            'compress':'lzw',
-            'nodata':nodata
-        }
+    if not dates:
+        return []
+
+    # open the netcdf file and create an instance of the ncCDF4 class
+    nc = Dataset(nc_file)
+    # Extract data from netcdf for all of the available dates at once
+    # netCDF4 needs the indices in increasing order, so keep track of where each date ends up
+    file_ixs = sorted(set(date_ixs))
+    data = np.ma.getdata(nc[VAR_NAME][file_ixs, :, :])
+    # delete the instance of the ncCDF4 class from memory
+    del nc
+
+    # Create profile/tif metadata for the available dates
+    # the data run from 0 to 360 degrees longitude
+    transform = rio.transform.from_bounds(0, -90, 360, 90, data.shape[2], data.shape[1])
+    # change center point of data by switching left and right side of data matrix, for all dates at once
+    transform = rollLongitudes(data, transform)
+    profile = {'dtype': dtype, 'crs': 'EPSG:4326', 'transform': transform, 'nodata': nodata}
+
+    # create and empty list to store the names of the tifs we generate
+    sub_tifs = []
+    for date, date_ix in zip(dates, date_ixs):
         # generate a name to save the tif file we will create from the netcdf file
         sub_tif = os.path.join(DATA_DIR,'{}.tif'.format(FILENAME.format(date=date)))
         logging.info(sub_tif)
         # create tif file for the available date
-        with rio.open(sub_tif, 'w', **profile) as dst:
-            dst.write(data.astype(dtype), indexes=1)
+        writeCog(sub_tif, data[file_ixs.index(date_ix)], profile)
         # add the new tif files to the list of tifs
         sub_tifs.append(sub_tif)
 
-    # delete the instance of the ncCDF4 class from memory
-    del nc
     return sub_tifs
 
 
@@ -14,6 +14,9 @@ import requests
 import time
 import ee
 import json 
+from google.cloud import storage
+from .geeTaskScheduler import TaskScheduler
+from .geeUploadsUtils import ingestAssets
 
 # url for vegetation health products data
 # old url 'ftp://ftp.star.nesdis.noaa.gov/pub/corp/scsb/wguo/data/Blended_VH_4km/VH/{target_file}'
@@ -35,6 +38,9 @@ COLLECTION_NAMES = {
 # name of data directory in Docker container
 DATA_DIR = 'data'
 
+# name of folder to store data in Google Cloud Storage
+GS_FOLDER = 'foo_024_051_vegetation_health_products'
+
 # do you want to delete everything currently in the GEE collection when you run this script?
 CLEAR_COLLECTION_FIRST = False
 
@@ -240,6 +246,14 @@ def getAssetName(tif, collection):
     date = getDate(tif)
     return os.path.join(collection, FILENAME.format(collection=collection, date=date))
 
+def getAssetId(asset):
+    '''
+    get full GEE asset id from an asset name relative to the eeUtil home folder
+    INPUT   asset: asset name, as returned by getAssetName (string)
+    RETURN  full GEE asset id for input asset name (string)
+    '''
+    return os.path.join(eeUtil.getCWD(), asset)
+
 def getDate(filename):
     '''
     get date from filename (last 7 characters of filename after removing extension)
@@ -345,30 +359,47 @@ def convert(nc_file, var, collection, date):
     logging.info('Converted {} to {}'.format(nc_file, new_file))
     return new_file
 
-def uploadAssets(tifs, collection):
-    '''
-    upload tif files to Google Earth Engine collection
-    INPUT   tifs: list of tif files to upload (list of strings)
-            collection: GEE collection we want to upload the files to(string)
-    RETURN  assets: list of GEE assets that have been uploaded (list of strings)
-    '''
-    # get a list of asset names to use for the input tif files
-    assets = [getAssetName(tif, collection) for tif in tifs]
-    # get a list of dates associated with each tif file
-    dates = [getDate(tif) for tif in tifs]
-    # Get a list of datetimes from these dates for each of the dates we are uploading
-    # Set date to the end of the reported week, -0 corresponding to Sunday at end of week
-    datestamps = [datetime.datetime.strptime(date + '-0', '%G0%V-%w') for date in dates]
-    # Upload new files (tifs) to GEE - try to upload data twice before quitting
+def uploadAssets(tifs_dict):
+    '''
+    upload the tif files for every collection to Google Earth Engine in a single pass: all of the tifs are staged
+    on Google Cloud Storage at once, skipping any that are already there from an earlier try, and then ingested
+    into GEE side by side
+    INPUT   tifs_dict: dictionary containing GEE collection name and list of tif files to upload to it (dictionary)
+    RETURN  new_assets_by_var: dictionary containing GEE collection name and list of GEE assets that have been
+                                    uploaded to it (dictionary)
+    '''
+    # list the tif file, GEE collection, asset name and datetime of every upload
+    uploads = []
+    for collection, tifs in tifs_dict.items():
+        for tif in tifs:
+            # Set date to the end of the reported week, -0 corresponding to Sunday at end of week
+            datestamp = datetime.datetime.strptime(getDate(tif) + '-0', '%G0%V-%w')
+            uploads.append((tif, collection, getAssetName(tif, collection), datestamp))
+    new_assets_by_var = defaultdict(list)
+    if not uploads:
+        return new_assets_by_var
+    # set up Google Cloud Storage project and bucket objects
+    gcsClient = storage.Client(os.environ.get("CLOUDSDK_CORE_PROJECT"))
+    gcsBucket = gcsClient.bucket(os.environ.get("GEE_STAGING_BUCKET"))
+    # Upload new files (tifs) to GEE - try to upload data twice before quitting, only trying again for the
+    # files that failed; the files of failed uploads are kept on Google Cloud Storage, so they are not staged again
     try_num=1
-    while try_num<=2:
+    while uploads and try_num<=2:
+        logging.info('Upload try number {}'.format(try_num))
         try:
-            logging.info('Upload {} try number {}'.format(collection, try_num))
-            eeUtil.uploadAssets(tifs, assets, collection, datestamps, timeout=3000)
-            break
-        except:
-            try_num+=1
-    return assets
+            tifs, collections, assets, datestamps = zip(*uploads)
+            tasks = ingestAssets(gcsBucket, list(tifs), [getAssetId(asset) for asset in assets], list(datestamps),
+                                 GS_FOLDER, scheduler=TaskScheduler(timeout=3000))
+            for collection, asset, task in zip(collections, assets, tasks):
+                if task.succeeded:
+                    new_assets_by_var[collection].append(asset)
+            uploads = [upload for upload, task in zip(uploads, tasks) if not task.succeeded]
+        except Exception as e:
+            logging.error('Upload try number {} failed: {}'.format(try_num, e))
+        try_num+=1
+    if uploads:
+        logging.error('Unable to upload {} assets: {}'.format(len(uploads), [upload[2] for upload in uploads]))
+    return new_assets_by_var
 
 def processNewData(existing_dates_by_var):
     '''
@@ -410,11 +441,9 @@ def processNewData(existing_dates_by_var):
         # delete netcdf file for this date because we have finished processing it
         os.remove(nc_file)
 
-    # Upload new files (tifs) to GEE
+    # Upload new files (tifs) to GEE, for all of the collections at once
     logging.info('Uploading files')
-    new_assets_by_var = defaultdict(list)
-    for collection, tifs in tifs_dict.items():
-        new_assets_by_var[collection] = uploadAssets(tifs, collection)
+    new_assets_by_var = uploadAssets(tifs_dict)
 
     # Delete local files
     logging.info('Cleaning local files')
@@ -10,7 +10,13 @@ import shapely
 import numpy as np
 import json
 import hashlib
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from . import SamplePythonDataBridgesCall as wfpsample
+from .uid_registry import UidRegistry
 # import dotenv 
 import pandas as pd
 from dateutil.relativedelta import relativedelta
@@ -105,6 +111,31 @@ CATEGORIES = OrderedDict([
     ('miscellaneous food', 'miscellaneous food'),
     ('non-food', 'non-food')])
 
+# column of the parsed ALPS dataframe (see parseAlpsFrame) that holds the data for each column in the alps Carto table
+# columns mapped to None are left empty
+ALPS_COLUMNS = OrderedDict([
+    ("uid", "uid"),
+    ("date", "date"),
+    ("currency", "currencyName"),
+    ("mktid", "marketID"),
+    ("cmid", "commodityID"),
+    ("ptid", "priceTypeID"),
+    ("umid", "commodityUnitID"),
+    ("catid", "categoryId"),
+    ("unit", "commodityUnitName"),
+    ("cmname", "cmname"),
+    ("category", "name"),
+    ("mktname", "marketName"),
+    ("admname", "admin1Name"),
+    ("adm1id", "admin1Code"),
+    ("sn", "sn"),
+    ("forecast", "forecast"),
+    ("mp_price", "analysisValueEstimatedPrice"),
+    ("trend", None),
+    ("pewi", "analysisValuePewiValue"),
+    ("alps", "alps")
+])
+
 # list of carto tables that we will process
 CARTO_TABLES = [CARTO_ALPS_TABLE, CARTO_MARKET_TABLE, CARTO_INTERACTION_TABLE]
 
@@ -123,6 +154,20 @@ INTERACTION_STRING_FORMAT = "[{num}] {commodity} markets were at a '{alps}' leve
 # specify how many months back we want to display alerts for
 LOOKBACK = 3
 
+# how many interaction IDs to delete from the Carto table in each request
+DELETE_BLOCKSIZE = 1000
+
+# folder where the registries of unique IDs already sent to Carto are saved between runs
+DATA_DIR = 'data'
+UID_CACHE = os.path.join(DATA_DIR, '{table}_uids.npy')
+
+# number of countries to fetch from the WFP API at once
+FETCH_WORKERS = 8
+# number of countries that can wait between each stage of processing before the previous stage pauses
+QUEUE_SIZE = 4
+# number of rows to send to Carto in each insert, batched across countries
+UPLOAD_BLOCKSIZE = 1000
+
 # how many rows can be stored in the Carto table before the oldest ones are deleted?
 MAXROWS = 150000
 # how many days can be stored in the Carto table before the old data is deleted?
@@ -254,7 +299,7 @@ def parseMarkets(mkt, existing_markets):
     '''
     Parse markets data excluding existing observations
     INPUT   mkt: information about each market (JSON feature)
-            existing_markets: list of unique market IDs that we already have in our Carto table (list of strings)
+            existing_markets: registry of unique market IDs that we already have in our Carto table (UidRegistry)
     RETURN  new_rows: list of new rows of data found for the input market (list of strings)
     '''
     # create an empty list to store new data (data that's not already in our Carto table)
@@ -279,10 +324,8 @@ def parseMarkets(mkt, existing_markets):
     }
     # generate unique id for the market using region id, market id and market name
     uid = genMarketUID(region_id, market_id, market_name)
-    # if the unique id doesn't already exist in our Carto table
-    if uid not in existing_markets:
-        # append the id to existing_markets list
-        existing_markets.append(uid)
+    # if the unique id doesn't already exist in our Carto table, add it to the registry
+    if existing_markets.add(uid):
         # go through each column in the Carto table
         for field in CARTO_MARKET_SCHEMA.keys():
             # if we are fetching data for unique id column
@@ -344,7 +387,7 @@ def parseAlps(market_data, existing_alps):
     '''
     For a particular market, get any dates of data that are new. Each date is a new row.
     INPUT   market_data: information about each regional market (JSON feature)
-            existing_alps: list of unique alps IDs that we already have in our Carto table (list of strings)
+            existing_alps: registry of unique alps IDs that we already have in our Carto table (UidRegistry)
     RETURN  new_rows: list of new rows of data found for the input market (list of strings)
     '''
     # get the start date from 'commodityPriceDate' variable and convert it to a datetime object formatted according
@@ -365,10 +408,8 @@ def parseAlps(market_data, existing_alps):
     uid = genAlpsUID(market_data['sn'], date, flag)
     # create an empty list to store data from this row
     row = []
-    # if the unique id doesn't already exist in our Carto table
-    if uid not in existing_alps:
-        # append the id to existing_alps list
-        existing_alps.append(uid)
+    # if the unique id doesn't already exist in our Carto table, add it to the registry
+    if existing_alps.add(uid):
 
         # go through each column in the Carto table
         for field in CARTO_ALPS_SCHEMA.keys():
@@ -430,6 +471,50 @@ def parseAlps(market_data, existing_alps):
     
     return row
 
+def buildRows(df, columns):
+    '''
+    Turn a dataframe into rows for a Carto table
+    INPUT   df: data to send to the Carto table (pandas dataframe)
+            columns: column of df holding the data for each column in the Carto table, or None to leave it empty (dictionary)
+    RETURN  list of rows in the same column order as the Carto table, with missing values as None (list of lists)
+    '''
+    # pick the columns in the order of the Carto table, adding empty columns where there is no data
+    rows = pd.DataFrame({field: df[column] if column else None for field, column in columns.items()},
+                        index=df.index, columns=list(columns.keys())).astype(object)
+    # replace all NaN with None
+    return rows.where(pd.notnull(rows), None).values.tolist()
+
+def parseAlpsFrame(alps_df, existing_alps):
+    '''
+    Parse every observation in an ALPS dataframe at once, excluding existing observations
+    This produces the same rows as running parseAlps on each observation.
+    INPUT   alps_df: ALPS data merged with market and commodity information (pandas dataframe)
+            existing_alps: registry of unique alps IDs that we already have in our Carto table (UidRegistry)
+    RETURN  new_rows: list of new rows of data found for the input markets (list of lists)
+    '''
+    # convert the dates to datetime objects
+    dates = pd.to_datetime(alps_df['commodityPriceDate'], format=DATE_FORMAT)
+    # flag whether the price is forecast or not
+    forecast = alps_df['analysisValuePriceFlag'] == 'forecast'
+    # generate sn variable
+    sn = (alps_df['marketID'].map(str) + '_' + alps_df['commodityID'].map(str) + '_' +
+          alps_df['priceTypeID'].map(str) + '_' + alps_df['commodityUnitID'].map(str))
+    # generate unique id for each observation using 'sn' variable, date and the availability of forecast data
+    # (matching genAlpsUID)
+    uid = sn + '_' + dates.dt.strftime('%Y-%m-%d %H:%M:%S') + '_' + forecast.map(str)
+    # only keep observations whose unique id doesn't already exist in our Carto table, adding them to the registry
+    new = existing_alps.addNew(uid)
+    # assign ALPS based on market pewi (matching assignALPS)
+    pewi = pd.to_numeric(alps_df['analysisValuePewiValue'][new])
+    alps = pd.Series(np.select([pewi < .25, pewi < 1, pewi < 2], ['Normal', 'Stress', 'Alert'], 'Crisis'),
+                     index=pewi.index).where(pewi.notnull(), None)
+    df = alps_df[new].assign(
+        uid=uid[new], sn=sn[new], forecast=forecast[new], alps=alps,
+        # format the dates according to DATE_FORMAT
+        date=dates[new].dt.strftime(DATE_FORMAT),
+        cmname=alps_df['commodityName'][new] + ' - ' + alps_df['priceTypeName'][new])
+    return buildRows(df, ALPS_COLUMNS)
+
 def flatten(lst, items):
     '''
     Add elements from the list 'items' to the end of the list 'lst'
@@ -448,11 +533,183 @@ def clean_null_rows(row):
     '''
     return any(row)
 
+class StageCounter(object):
+    '''
+    Throughput counter for one stage of the processNewData pipeline
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, items, rows, seconds):
+        '''
+        Record work done by the stage
+        INPUT   items: number of countries or blocks processed (integer)
+                rows: number of rows processed (integer)
+                seconds: time spent processing them (float)
+        '''
+        with self.lock:
+            self.items += items
+            self.rows += rows
+            self.seconds += seconds
+
+    def log(self, elapsed):
+        '''
+        Log the throughput of the stage
+        INPUT   elapsed: total time taken by the pipeline, in seconds (float)
+        '''
+        logging.info('{}: {} items, {} rows, {:.1f} s busy of {:.1f} s, {:.1f} rows/s'.format(
+            self.name, self.items, self.rows, self.seconds, elapsed, self.rows / elapsed if elapsed else 0))
+
+def fetchCountry(api, country_code, counter):
+    '''
+    Fetch markets and alerts for price spikes (alps) data for a country
+    INPUT   api: WFP API client (WfpApi)
+            country_code: iso3 code of the country (string)
+            counter: throughput counter for the fetch stage (StageCounter)
+    RETURN  country_code: iso3 code of the country (string)
+            markets: markets data for the country (list of dictionaries)
+            alps: alps data for the country (list of dictionaries)
+    '''
+    start = time.time()
+    # Fetch new data
+    logging.info("Fetching country data for {}".format(country_code))
+    # pull markets data from the url as a request response JSON
+    markets = api.get_market_list(country_code)
+    # pull alerts for price spikes (alps) data from the url as a request response JSON
+    alps = api.get_alps(country_code)
+    counter.add(1, len(markets) + len(alps), time.time() - start)
+    return country_code, markets, alps
+
+def fetchCountries(api, country_codes, fetched, counter):
+    '''
+    Fetch the data for each country with a bounded pool of workers, putting the data for each country on a queue
+    INPUT   api: WFP API client (WfpApi)
+            country_codes: iso3 codes of the countries to fetch (list of strings)
+            fetched: bounded queue to put the data for each country on (queue); once every country has been fetched,
+                    None is put on the queue, or the exception raised if a fetch failed
+            counter: throughput counter for the fetch stage (StageCounter)
+    '''
+    codes = iter(country_codes)
+    try:
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+            # only keep FETCH_WORKERS countries in flight
+            pending = {pool.submit(fetchCountry, api, code, counter) for code in itertools.islice(codes, FETCH_WORKERS)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    # this blocks if the merge stage is QUEUE_SIZE countries behind
+                    fetched.put(future.result())
+                    for code in itertools.islice(codes, 1):
+                        pending.add(pool.submit(fetchCountry, api, code, counter))
+    except Exception as e:
+        fetched.put(e)
+    else:
+        fetched.put(None)
+
+def parseCountry(markets, alps, com_list_df, com_cat_df, existing_markets, existing_alps):
+    '''
+    Merge and parse the data for a country, excluding existing observations
+    INPUT   markets: markets data for the country (list of dictionaries)
+            alps: alps data for the country (list of dictionaries)
+            com_list_df: commodity list (pandas dataframe)
+            com_cat_df: commodity category list (pandas dataframe)
+            existing_markets: registry of unique IDs that we already have in our markets Carto table (UidRegistry)
+            existing_alps: registry of unique IDs that we already have in our alps Carto table (UidRegistry)
+    RETURN  new_markets: new rows of data for the markets Carto table (list of lists)
+            new_alps: new rows of data for the alps Carto table (list of lists)
+    '''
+    # convert list dictionary to dataframe
+    markets_df = pd.DataFrame(markets)
+    alps_df = pd.DataFrame(alps)
+
+    # Parse market data excluding existing observations
+    # returns a 2D list, 1st dimension represents a particular market
+    # 2nd dimention represents the columns of the Carto table for that region and market
+    new_markets = [parseMarkets(mkt, existing_markets) for mkt in markets]
+
+    if len(alps)>0:
+        # Merge alps dataframe with market dataframe, commodity dataframe, and category dataframe
+        alps_cat_df = alps_df.merge(markets_df.loc[:, ['admin1Code', 'admin1Name', 'marketId']], left_on = 'marketID', right_on='marketId', how='inner')
+        alps_cat_df = alps_cat_df.merge(com_list_df.loc[:, ['id','categoryId']], left_on='commodityID', right_on='id', how='inner')
+        alps_cat_df = alps_cat_df.merge(com_cat_df.loc[:, ['id','name']], left_on='categoryId', right_on='id', how='inner')
+        alps_cat_df.drop(['id_x','id_y', 'marketId'], axis=1, inplace=True)
+        alps_cat_df.drop_duplicates(inplace=True)
+        # replace all NaN with None
+        alps_cat_df = alps_cat_df.where((pd.notnull(alps_cat_df)), None)
+        alps_cat_df = alps_cat_df.replace({np.nan: None})
+
+        # Parse alps data excluding existing observations
+        # returns a 2D list, 1st dimension represents the time steps that are new
+        # 2nd dimention represents the columns of the Carto table for that market and time step
+        new_alps = parseAlpsFrame(alps_cat_df, existing_alps)
+    else:
+        new_alps = []
+
+    # Remove empty List from List
+    # using list comprehension
+    new_markets = [ele for ele in new_markets if ele != []]
+    new_alps = [ele for ele in new_alps if ele != []]
+
+    # Clean any rows that are all None
+    new_markets = list(filter(clean_null_rows, new_markets))
+    new_alps = list(filter(clean_null_rows, new_alps))
+    return new_markets, new_alps
+
+def uploadRows(parsed, counter):
+    '''
+    Batch the new rows for each table across countries and insert them into Carto in blocks of UPLOAD_BLOCKSIZE rows
+    INPUT   parsed: bounded queue of (table, schema, rows) to upload (queue); None is put on the queue once every
+                    country has been parsed
+            counter: throughput counter for the upload stage (StageCounter)
+    RETURN  errors: list holding the exception raised by a failed upload, if any (list)
+    '''
+    # rows waiting to be uploaded to each table
+    blocks = OrderedDict()
+    errors = []
+
+    def insert(table, schema, rows):
+        start = time.time()
+        logging.info('Pushing {} new rows to {}'.format(len(rows), table))
+        cartosql.insertRows(table, schema.keys(), schema.values(), rows,
+                            user=CARTO_USER, key=CARTO_KEY, blocksize=UPLOAD_BLOCKSIZE)
+        counter.add(1, len(rows), time.time() - start)
+
+    while True:
+        item = parsed.get()
+        # once an upload has failed, keep emptying the queue so that the merge stage does not block
+        if errors and item is not None:
+            continue
+        try:
+            if item is None:
+                # upload the rows left over for each table
+                for table, (schema, rows) in blocks.items():
+                    if rows:
+                        insert(table, schema, rows)
+                break
+            table, schema, rows = item
+            block = blocks.setdefault(table, (schema, []))[1]
+            block.extend(rows)
+            # upload full blocks as soon as they are ready
+            while len(block) >= UPLOAD_BLOCKSIZE:
+                insert(table, schema, block[:UPLOAD_BLOCKSIZE])
+                del block[:UPLOAD_BLOCKSIZE]
+        except Exception as e:
+            errors.append(e)
+            if item is None:
+                break
+    return errors
+
 def processNewData(existing_markets, existing_alps):
     '''
     Fetch, process and upload new data
-    INPUT   existing_markets: list of unique IDs that we already have in our markets Carto table (list of strings)
-            existing_alps: list of unique IDs that we already have in our alps Carto table (list of strings)
+    Countries are fetched by a bounded pool of workers, merged and parsed as they arrive, and the new rows are uploaded
+    in large blocks by a separate thread. Bounded queues between the stages keep a slow stage from being flooded.
+    INPUT   existing_markets: registry of unique IDs that we already have in our markets Carto table (UidRegistry)
+            existing_alps: registry of unique IDs that we already have in our alps Carto table (UidRegistry)
     RETURN  num_new_markets: number of rows of new data sent to markets Carto table (integer)
             num_new_alps: number of rows of new data sent to alps Carto table (integer)
             markets_updated: list of unique market IDs for markets that were updated (list of strings)
@@ -460,8 +717,10 @@ def processNewData(existing_markets, existing_alps):
     # initialize the number of new markets and alps table entries as zero
     num_new_markets = 0
     num_new_alps = 0
-    # create an empty list to store the ids of the markets that are updated
-    markets_updated = []
+    # create an empty set to store the ids of the markets that are updated
+    markets_updated = set()
+    # get the position of the region id, market id and market name columns in the alps table
+    adm1id, mktid, mktname = [list(CARTO_ALPS_SCHEMA.keys()).index(field) for field in ('adm1id', 'mktid', 'mktname')]
 
     # initialize WFP API
     api = wfpsample.WfpApi(api_key=WFP_KEY, api_secret=WFP_SECRET)
@@ -478,100 +737,143 @@ def processNewData(existing_markets, existing_alps):
     country_codes = []
     for regions in requests.get("https://api.vam.wfp.org/geodata/CountriesInRegion").json():
         country_codes = country_codes + [country['iso3Alpha3'] for country in regions['countryOffices']]
-    
-    # get and parse each data for each country
-    for country_code in country_codes:
-        # Fetch new data
-        logging.info("Fetching country data for {}".format(country_code))
-        # pull markets data from the url as a request response JSON
-        markets = api.get_market_list(country_code)
-        # pull alerts for price spikes (alps) data from the url as a request response JSON
-        alps = api.get_alps(country_code)
-        # convert list dictionary to dataframe
-        markets_df = pd.DataFrame(markets)
-        alps_df = pd.DataFrame(alps)
-
-        # Parse market data excluding existing observations
-        # returns a 2D list, 1st dimension represents a particular market
-        # 2nd dimention represents the columns of the Carto table for that region and market
-        new_markets = [parseMarkets(mkt, existing_markets) for mkt in markets]
-
-        if len(alps)>0:
-            # Merge alps dataframe with market dataframe, commodity dataframe, and category dataframe
-            alps_cat_df = alps_df.merge(markets_df.loc[:, ['admin1Code', 'admin1Name', 'marketId']], left_on = 'marketID', right_on='marketId', how='inner')
-            alps_cat_df = alps_cat_df.merge(com_list_df.loc[:, ['id','categoryId']], left_on='commodityID', right_on='id', how='inner')
-            alps_cat_df = alps_cat_df.merge(com_cat_df.loc[:, ['id','name']], left_on='categoryId', right_on='id', how='inner')
-            alps_cat_df.drop(['id_x','id_y', 'marketId'], axis=1, inplace=True)
-            alps_cat_df.drop_duplicates(inplace=True)
-            # replace all NaN with None
-            alps_cat_df = alps_cat_df.where((pd.notnull(alps_cat_df)), None)
-            alps_cat_df = alps_cat_df.replace({np.nan: None})
-            # convert dataframe back to list dictionary
-            alps_cat = [dict(x) for i, x in alps_cat_df.iterrows()]
-
-            # Parse alps data excluding existing observations
-            # returns a 2D list, 1st dimension represents the time steps that are new
-            # 2nd dimention represents the columns of the Carto table for that market and time step
-            new_alps = [parseAlps(alp, existing_alps) for alp in alps_cat]
-        else:
-            new_alps = []
-
-        logging.debug('Country {} Data: After map:'.format(country_code))
-        logging.debug(new_markets)
-        logging.debug(new_alps)
-
-        # Remove empty List from List
-        # using list comprehension
-        new_markets = [ele for ele in new_markets if ele != []]
-        new_alps = [ele for ele in new_alps if ele != []]
-
-        logging.debug('Country {} Data: After reduce:'.format(country_code))
-        logging.debug(new_markets)
-        logging.debug(new_alps)
-
-        # Clean any rows that are all None
-        new_markets = list(filter(clean_null_rows, new_markets))
-        new_alps = list(filter(clean_null_rows, new_alps))
-
-        # Check which market ids were updated so that we can update their interactions
-        # get only markets that have been updated
-        # get market id index
-        if len(new_alps)>0:
-            for entry in new_alps:
-                # get the unique id for this particular market using its region id, market id and market name
-                uid=genMarketUID(entry[list(CARTO_ALPS_SCHEMA.keys()).index("adm1id")],
-                                 entry[list(CARTO_ALPS_SCHEMA.keys()).index("mktid")],
-                                 entry[list(CARTO_ALPS_SCHEMA.keys()).index("mktname")])
-                # save the ids for the markets that have been updated
-                markets_updated.append(uid)
-            # filter and get only the unique ids and convert them to a list
-            markets_updated = np.unique(markets_updated).tolist()
-        logging.debug('Country {} Data: After filter:'.format(country_code))
-        logging.debug(new_markets)
-        logging.debug(new_alps)
-        # update the number of rows of new data that will be sent to markets Carto table
-        num_new_markets += len(new_markets)
-        # update the number of rows of new data that will be sent to alps Carto table
-        num_new_alps += len(new_alps)
-
-        # Insert new rows
-        # if we have found new market data
-        if len(new_markets):
-            # insert new data into the markets carto table
-            logging.info('Pushing {} new Markets rows'.format(len(new_markets)))
-            cartosql.insertRows(CARTO_MARKET_TABLE, CARTO_MARKET_SCHEMA.keys(),
-                                CARTO_MARKET_SCHEMA.values(), new_markets,
-                                user=CARTO_USER, key =CARTO_KEY, blocksize=100)
-        # if we have found new alps data
-        if len(new_alps):
-            # insert new data into the alps carto table
-            logging.info('Pushing {} new ALPS rows'.format(len(new_alps)))
-            cartosql.insertRows(CARTO_ALPS_TABLE, CARTO_ALPS_SCHEMA.keys(),
-                                CARTO_ALPS_SCHEMA.values(), new_alps,
-                                user=CARTO_USER, key =CARTO_KEY, blocksize=100)
-
-
-    return num_new_markets, num_new_alps, markets_updated
+
+    # throughput counters for each stage of the pipeline
+    fetch_counter = StageCounter('fetch')
+    merge_counter = StageCounter('merge')
+    upload_counter = StageCounter('upload')
+    start = time.time()
+
+    # start fetching countries in the background
+    fetched = queue.Queue(maxsize=QUEUE_SIZE)
+    fetcher = threading.Thread(target=fetchCountries, args=(api, country_codes, fetched, fetch_counter), daemon=True)
+    fetcher.start()
+    # start the upload stage in the background
+    parsed = queue.Queue(maxsize=QUEUE_SIZE)
+    upload_errors = []
+    uploader = threading.Thread(target=lambda: upload_errors.extend(uploadRows(parsed, upload_counter)), daemon=True)
+    uploader.start()
+
+    try:
+        while True:
+            # get the data for the next country that has been fetched
+            item = fetched.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            country_code, markets, alps = item
+            merge_start = time.time()
+            # get and parse each data for each country
+            new_markets, new_alps = parseCountry(markets, alps, com_list_df, com_cat_df, existing_markets, existing_alps)
+            # Check which market ids were updated so that we can update their interactions
+            # get the unique id for each market using its region id, market id and market name
+            markets_updated.update(genMarketUID(entry[adm1id], entry[mktid], entry[mktname]) for entry in new_alps)
+            merge_counter.add(1, len(new_markets) + len(new_alps), time.time() - merge_start)
+            logging.info('Country {}: {} new markets, {} new ALPS rows'.format(country_code, len(new_markets), len(new_alps)))
+            # update the number of rows of new data that will be sent to markets and alps Carto tables
+            num_new_markets += len(new_markets)
+            num_new_alps += len(new_alps)
+
+            # Insert new rows
+            # this blocks if the upload stage is QUEUE_SIZE countries behind
+            if new_markets:
+                parsed.put((CARTO_MARKET_TABLE, CARTO_MARKET_SCHEMA, new_markets))
+            if new_alps:
+                parsed.put((CARTO_ALPS_TABLE, CARTO_ALPS_SCHEMA, new_alps))
+    finally:
+        # let the upload stage send the rows left over and finish
+        parsed.put(None)
+        uploader.join()
+    if upload_errors:
+        raise upload_errors[0]
+
+    # log the throughput of each stage
+    elapsed = time.time() - start
+    for counter in (fetch_counter, merge_counter, upload_counter):
+        counter.log(elapsed)
+
+    return num_new_markets, num_new_alps, sorted(markets_updated)
+
+def getMarkets():
+    '''
+    Get every market in the markets Carto table in a single request
+    RETURN  markets: markets Carto table, one row per market (pandas dataframe)
+    '''
+    r = cartosql.getFields(list(CARTO_MARKET_SCHEMA.keys()), CARTO_MARKET_TABLE, f='json', post=True,
+                           user=CARTO_USER, key=CARTO_KEY)
+    return pd.DataFrame(r.json()['rows'], columns=list(CARTO_MARKET_SCHEMA.keys()))
+
+def getRecentAlps():
+    '''
+    Get the most recent entry for each commodity at each market that is NOT a forecast, for the last LOOKBACK
+    months, in a single request
+    RETURN  alps: most recent ALPS entry for each market, category and commodity (pandas dataframe)
+    '''
+    # SQL gets most recent entry for each commodity at each market and category that is NOT a forecast
+    request = ("SELECT DISTINCT ON (adm1id, mktid, mktname, category, cmname) adm1id, mktid, mktname, category, cmname, "
+               "alps, pewi, date FROM {table} WHERE category IN ({categories}) AND date > current_date - interval '{x}' month "
+               "AND forecast = 'False' ORDER BY adm1id, mktid, mktname, category, cmname, date desc").format(
+        table=CARTO_ALPS_TABLE, x=LOOKBACK,
+        categories=', '.join("'{}'".format(cat.replace("'", "''")) for cat in CATEGORIES.values()))
+    r = cartosql.post(request, user=CARTO_USER, key=CARTO_KEY)
+    alps = pd.DataFrame(r.json()['rows'], columns=['adm1id', 'mktid', 'mktname', 'category', 'cmname', 'alps', 'pewi', 'date'])
+    alps['pewi'] = pd.to_numeric(alps['pewi'])
+    return alps
+
+def buildInteractions(markets, alps):
+    '''
+    Compact the ALPS entries for each market and food category into a single interaction row
+    INPUT   markets: markets we want to build interactions for (pandas dataframe)
+            alps: most recent ALPS entry for each market, category and commodity (pandas dataframe)
+    RETURN  new_rows: list of new rows of data for the interaction table (list of lists)
+    '''
+    if alps.empty or markets.empty:
+        return []
+    # map the source category names back to the category names used in the interaction table
+    category_names = {sql_query: food_category for food_category, sql_query in CATEGORIES.items()}
+    # attach each ALPS entry to the market it was observed at
+    alps = alps.merge(markets, left_on=['adm1id', 'mktid', 'mktname'],
+                      right_on=['region_id', 'market_id', 'market_name'])
+    # commodities are listed in alphabetical order within each interaction
+    alps = alps.sort_values(['uid', 'category', 'cmname'])
+    # geometries are shared by every category at a market, so only convert them once
+    points = {}
+    # create an empty list to store new data for this table
+    new_rows = []
+    # go through each market and food category that has ALPS entries
+    for (m_uid, category), entries in alps.groupby(['uid', 'category'], sort=False):
+        market_entry = entries.iloc[0]
+        food_category = category_names[category]
+        # generate the text to display in interaction using commodity number, commodity name, alert level and date
+        # separating each commodity in a market by a semicolon
+        interaction_string = ';\n'.join(
+            INTERACTION_STRING_FORMAT.format(num=num, commodity=cmname, alps=alps_level.lower(), date=date[:10])
+            for num, (cmname, alps_level, date) in enumerate(zip(entries['cmname'], entries['alps'], entries['date']), 1))
+        # get the maximum pewi and the alert level for it
+        highest_pewi = entries['pewi'].max()
+        highest_alps = assignALPS(highest_pewi) if pd.notnull(highest_pewi) else None
+        if m_uid not in points:
+            # Return a geometric object from a Well Known Binary (WKB) representation and load it as JSON
+            points[m_uid] = shapely.geometry.mapping(wkb.loads(market_entry['the_geom'], hex=True))
+        values = {
+            'uid': genInteractionUID(market_entry['region_id'], market_entry['market_id'],
+                                     market_entry['market_name'], food_category),
+            'the_geom': points[m_uid],
+            'region_name': market_entry['region_name'],
+            'region_id': int(market_entry['region_id']),
+            'market_name': market_entry['market_name'],
+            'market_id': int(market_entry['market_id']),
+            'category': food_category,
+            'market_interaction': interaction_string,
+            'highest_pewi': None if pd.isnull(highest_pewi) else float(highest_pewi),
+            'highest_alps': highest_alps,
+            # get the oldest interaction date for each observation
+            INTERACTION_TIME_FIELD: entries['date'].min(),
+        }
+        # order the values to match the columns in the Carto table
+        new_rows.append([values[field] for field in CARTO_INTERACTION_SCHEMA.keys()])
+    return new_rows
 
 def processInteractions(markets_updated):
     '''
@@ -580,182 +882,84 @@ def processInteractions(markets_updated):
     For each geometry, only one row of data will be used on Resource Watch map interactions, so when 
     there are multiple food commodities for a given geometry, we need to compact them into a single row so that 
     all the information will be shown on an interaction.
+    The markets and recent ALPS entries are pulled in bulk and grouped locally, so the number of requests sent to
+    Carto does not grow with the number of markets being processed.
     INPUT   markets_updated: list of market IDs for markets that have been updated (list of strings)
     RETURN  num_new_interactions: number of rows of new data sent to market interactions Carto table (integer)
     '''
-    # initialize number of rows of new data sent to Carto table as zero
-    num_new_interactions = 0
+    # get information about every market
+    markets = getMarkets()
     # if we want to process interactions for all ALPS data
     if PROCESS_HISTORY_INTERACTIONS==True:
         logging.info('Processing interactions for all ALPS data')
-        # get ids for all markets
-        markets_to_process = getIds(CARTO_MARKET_TABLE, 'uid')
+        # process every market
+        markets_to_process = markets
 
     # otherwise, we will only re-process interactions for markets that have been updated or that have data older than
     # what is allowed (specified by LOOKBACK variable)
     else:
         logging.info('Getting IDs of interactions that should be updated')
-        # get a list of all the values from 'region_id', 'market_id', 'market_name' columns where oldest interaction date is more than three months ago
+        # get all the values from 'region_id', 'market_id', 'market_name' columns where oldest interaction date is more than three months ago
         r = cartosql.getFields(['region_id', 'market_id', 'market_name'], CARTO_INTERACTION_TABLE, where="{} < current_date - interval '{}' month".format(INTERACTION_TIME_FIELD, LOOKBACK),
-                               f='csv', user=CARTO_USER, key=CARTO_KEY)
-        # turn the response into a list of strings, removing the first and last entries (header and an empty space at end)
-        # split each list using ',' to separately retrieve region_id, market_id and market_name
-        old_ids = [market.split(',') for market in r.text.split('\r\n')[1:-1]]
+                               f='json', post=True, user=CARTO_USER, key=CARTO_KEY)
         # get the unique id for each market using region id, market id and market name
-        old_market_uids = [genMarketUID(old_id[0], old_id[1], old_id[2]) for old_id in old_ids]
+        old_market_uids = [genMarketUID(old_id['region_id'], old_id['market_id'], old_id['market_name']) for old_id in r.json()['rows']]
 
         logging.info('Processing interactions for new ALPS data and re-processing interactions that are out of date')
         # get unique ids for new as well as outdated ALPS date
-        markets_to_process = np.unique(markets_updated + old_market_uids)
-    # initialize number of markets as one
-    market_num = 1
+        markets_to_process = markets[markets['uid'].isin(set(markets_updated) | set(old_market_uids))]
     logging.info('{} markets to update interactions for'.format(len(markets_to_process)))
-    # go through each market that was updated and update the interaction rows for it
-    for m_uid in markets_to_process:
-        logging.info('processing {} out of {} markets'.format(market_num, len(markets_to_process)))
-        # create an empty list to store new data for this table
-        new_rows = []
-        # loop through each category in interaction table
-        for food_category, sql_query in CATEGORIES.items():
-            # initialize number of tries to fetch data as zero
-            try_num=1
-            # stop trying if we can't get data within three tries
-            while try_num <=3:
-                try:
-                    # get information about market
-                    r = cartosql.get("SELECT * FROM {} WHERE uid='{}'".format(CARTO_MARKET_TABLE, m_uid),
-                                     user=CARTO_USER, key=CARTO_KEY)
-                    # break out of the loop if we couldn't find any rows 
-                    if r.json()['total_rows']==0:
-                        #logging.info('No rows for interaction')
-                        alps_entries=[]
-                        break
-                    # turn the reponse into a JSON
-                    market_entry = r.json()['rows'][0]
-
-                    # get information about food prices at market
-                    # SQL gets most recent entry for each commodity at each market that is NOT a forecast
-                    request = "SELECT DISTINCT ON (mktid, cmname) * FROM {table} WHERE mktid={market_id} AND mktname='{market_name}' AND adm1id={region_id} AND category LIKE '{cat_name}' AND date > current_date - interval '{x}' month AND forecast = 'False' ORDER  BY mktid, cmname, date desc".format(
-                        table=CARTO_ALPS_TABLE, market_id=market_entry['market_id'],
-                        market_name=market_entry['market_name'].replace("'", "''"), region_id=market_entry['region_id'],
-                        cat_name=sql_query, x=LOOKBACK)
-                    # get all the rows from Carto table which satisfy the above SQL query
-                    r = cartosql.get(request, user=CARTO_USER, key=CARTO_KEY)
-                    # turn the reponse into a JSON
-                    alps_entries = r.json()['rows']
-                    break
-                except:
-                    # increase the count of number of tries
-                    try_num += 1
-            # Generate unique id for a market using region id, market id, market name and food category
-            uid = genInteractionUID(market_entry['region_id'], market_entry['market_id'], market_entry['market_name'],
-                                    food_category)
-            # if we found information for food prices at market
-            if alps_entries:
-                # initialize the number of commodities to 1
-                commodity_num=1
-                # loop through each commodities in a market
-                for entry in alps_entries:
-                    # if we are processing the first food commodity in a market
-                    if commodity_num==1:
-                        # generate the text to display in interaction using commodity number, commodity name, alert level and date
-                        interaction_string = INTERACTION_STRING_FORMAT.format(num=commodity_num, commodity=entry['cmname'], alps=entry['alps'].lower(), date=entry['date'][:10])
-                    # if there is more than one commodity, add the interaction_string to the existing one(s), separated by a semicolon
-                    else:
-                        interaction_string = interaction_string + ';\n' + INTERACTION_STRING_FORMAT.format(num=commodity_num, commodity=entry['cmname'], alps=entry['alps'].lower(), date=entry['date'][:10])
-                    # increase commodity_num by 1 for next iteration
-                    commodity_num+=1
-                # create an empty list to store data from this row
-                row = []
-                # go through each column in the Carto table
-                for field in CARTO_INTERACTION_SCHEMA.keys():
-                    # if we are fetching data for unique id column
-                    if field == 'uid':
-                        # add the unique id to the list of data from this row
-                        row.append(uid)
-                    # if we are fetching data for market id column
-                    elif field == 'market_id':
-                        # get market_id from market_entry and convert it to a integer
-                        # add market id to the list of data from this row
-                        row.append(int(market_entry['market_id']))
-                    # if we are fetching data for geometry column
-                    elif field == 'the_geom':
-                        # Return a geometric object from a Well Known Binary (WKB) representation
-                        shapely_point = wkb.loads(market_entry['the_geom'], hex=True)
-                        # load the geometric object as JSON
-                        json_point = json.loads(json.dumps(shapely.geometry.mapping(shapely_point)))
-                        # add the processed geometry to the list of data from this row
-                        row.append(json_point)
-                    # if we are fetching data for region name column
-                    elif field == 'region_name':
-                        # add region name to the list of data from this row
-                        row.append(market_entry['region_name'])
-                    # if we are fetching data for region id column
-                    elif field == 'region_id':
-                        # add region id to the list of data from this row
-                        row.append(market_entry['region_id'])
-                    # if we are fetching data for market name column
-                    elif field == 'market_name':
-                        # add market name to the list of data from this row
-                        row.append(market_entry['market_name'])
-                    # if we are fetching data for market interaction column
-                    elif field == 'market_interaction':
-                        # if there are no values, append None
-                        if len(alps_entries) == 0:
-                            row.append(None)
-                        else:
-                            # add interaction_string to the list of data from this row
-                            row.append(interaction_string)
-                    # if we are fetching data for category column
-                    elif field == 'category':
-                        # add food category to the list of data from this row
-                        row.append(food_category)
-                    # if we are fetching data for highest_pewi column
-                    elif field == 'highest_pewi':
-                        # if there are no values, append None
-                        if len(alps_entries) == 0:
-                            row.append(None)
-                        else:
-                            # get the maximum pewi for each observation
-                            highest_pewi = max([entry['pewi'] for entry in alps_entries])
-                            # add highest_pewi to the list of data from this row
-                            row.append(highest_pewi)
-                    # if we are fetching data for highest_alps column
-                    elif field == 'highest_alps':
-                        # if there are no values, append None
-                        if len(alps_entries) == 0:
-                            row.append(None)
-                        else:
-                            # get the alert level for highest_pewi using alps indicator value, 
-                            highest_alps_category = assignALPS(highest_pewi)
-                            # add highest_alps_category to the list of data from this row
-                            row.append(highest_alps_category)
-                    # if we are fetching data for oldest_interaction_date column
-                    elif field == INTERACTION_TIME_FIELD:
-                        # if there are no values, append None
-                        if len(alps_entries) == 0:
-                            row.append(None)
-                        else:
-                            # get the oldest interaction date for each observation
-                            row.append(min(entry['date'] for entry in alps_entries))
-                # add the list of values from this row to the list of new_rows
-                new_rows.append(row)
-                # increase the count of rows of new data sent to Carto table by one
-                num_new_interactions+=1
-            # delete old entries for the markets that were updated
-            try:
-                cartosql.deleteRows(CARTO_INTERACTION_TABLE, "{} = '{}'".format(UID_FIELD, uid), user=CARTO_USER,
-                                    key=CARTO_KEY)
-            except:
-                pass
-        # send new rows for these markets
-        if new_rows:
-            cartosql.insertRows(CARTO_INTERACTION_TABLE, CARTO_INTERACTION_SCHEMA.keys(),
-                                CARTO_INTERACTION_SCHEMA.values(), new_rows, blocksize=500, user=CARTO_USER, key=CARTO_KEY)
-        # increase count of market_num by 1 after we finish processing a market data
-        market_num+=1
-    return num_new_interactions
+    if markets_to_process.empty:
+        return 0
+
+    # get information about food prices at all markets and build the interactions locally
+    new_rows = buildInteractions(markets_to_process, getRecentAlps())
+
+    # delete old entries for the markets that are being processed
+    if PROCESS_HISTORY_INTERACTIONS==True:
+        cartosql.deleteRows(CARTO_INTERACTION_TABLE, 'cartodb_id IS NOT NULL', user=CARTO_USER, key=CARTO_KEY)
+    else:
+        # every category is cleared for a market, including those with no recent ALPS entries
+        old_uids = [genInteractionUID(market['region_id'], market['market_id'], market['market_name'], food_category)
+                    for market in markets_to_process.to_dict('records') for food_category in CATEGORIES]
+        # split the deletion into blocks so that each request stays a reasonable size
+        for i in range(0, len(old_uids), DELETE_BLOCKSIZE):
+            cartosql.deleteRows(CARTO_INTERACTION_TABLE, "{} = ANY(ARRAY[{}])".format(
+                UID_FIELD, ','.join("'{}'".format(uid) for uid in old_uids[i:i+DELETE_BLOCKSIZE])),
+                user=CARTO_USER, key=CARTO_KEY)
+    # send new rows for these markets
+    if new_rows:
+        logging.info('Pushing {} new interaction rows'.format(len(new_rows)))
+        cartosql.insertRows(CARTO_INTERACTION_TABLE, CARTO_INTERACTION_SCHEMA.keys(),
+                            CARTO_INTERACTION_SCHEMA.values(), new_rows, blocksize=500, user=CARTO_USER, key=CARTO_KEY)
+    return len(new_rows)
+
+
+def loadRegistry(table, existing_ids):
+    '''
+    Load the registry of unique IDs that have been sent to a Carto table in previous runs
+    IDs of rows that have since been deleted as too old stay in the registry, so they are not uploaded again.
+    INPUT   table: name of the Carto table (string)
+            existing_ids: list of unique IDs that we already have in the Carto table (list of strings)
+    RETURN  registry: registry of unique IDs sent to the Carto table (UidRegistry)
+    '''
+    path = UID_CACHE.format(table=table)
+    # start from an empty registry if the table has been cleared or there is no saved registry yet
+    if CLEAR_TABLE_FIRST or not os.path.exists(path):
+        registry = UidRegistry()
+    else:
+        registry = UidRegistry.load(path)
+    registry.update(existing_ids)
+    return registry
 
+def saveRegistry(table, registry):
+    '''
+    Save the registry of unique IDs that have been sent to a Carto table
+    INPUT   table: name of the Carto table (string)
+            registry: registry of unique IDs sent to the Carto table (UidRegistry)
+    '''
+    os.makedirs(DATA_DIR, exist_ok=True)
+    registry.save(UID_CACHE.format(table=table))
 
 def getIds(table, id_field):
     '''
@@ -941,8 +1145,16 @@ def main():
     # Check if table exists, create it if it does not
     existing_interactions = checkCreateTable(CARTO_INTERACTION_TABLE, CARTO_INTERACTION_SCHEMA, UID_FIELD, INTERACTION_TIME_FIELD)
 
+    # Load the IDs sent to Carto in previous runs and add the IDs currently in the tables
+    market_registry = loadRegistry(CARTO_MARKET_TABLE, existing_markets)
+    alps_registry = loadRegistry(CARTO_ALPS_TABLE, existing_alps)
+
     # Iterively fetch, parse and post new data
-    num_new_markets, num_new_alps, markets_updated = processNewData(existing_markets, existing_alps)
+    num_new_markets, num_new_alps, markets_updated = processNewData(market_registry, alps_registry)
+
+    # Save the IDs that have now been sent to Carto for the next run
+    saveRegistry(CARTO_MARKET_TABLE, market_registry)
+    saveRegistry(CARTO_ALPS_TABLE, alps_registry)
 
     # Update Interaction table
     num_new_interactions = processInteractions(markets_updated)
@@ -0,0 +1,115 @@
+'''
+Benchmark for parsing ALPS observations, using a synthetic feed shaped like the merged WFP data
+Compares parseAlps run row by row (with the old list of IDs and with UidRegistry) against parseAlpsFrame.
+Run from the contents folder:
+```
+python -m src.benchmark_alps 200000
+```
+'''
+import sys
+import os
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+from . import parseAlps, parseAlpsFrame, DATE_FORMAT
+from .uid_registry import UidRegistry
+
+# the row by row parse with a list of IDs is quadratic, so only time it on a sample of this many rows
+LIST_SAMPLE = 20000
+
+
+class _IdList(list):
+    '''List of IDs with the registry interface, as the IDs were stored before UidRegistry'''
+    def add(self, uid):
+        if uid in self:
+            return False
+        self.append(uid)
+        return True
+
+
+def syntheticAlps(n, seed=0):
+    '''
+    Generate `n` ALPS observations merged with market and commodity information
+    INPUT   n: number of observations to generate (integer)
+            seed: seed for the random number generator (integer)
+    RETURN  ALPS observations (pandas dataframe)
+    '''
+    rng = np.random.RandomState(seed)
+    # each series is one commodity, price type and unit at one market, observed monthly
+    months = 60
+    series = np.arange(n) // months
+    dates = pd.date_range('2015-01-15', periods=months, freq='MS') + pd.Timedelta(days=14)
+    pewi = rng.normal(0.5, 1, n).round(3)
+    df = pd.DataFrame({
+        'commodityPriceDate': dates[np.arange(n) % months].strftime(DATE_FORMAT),
+        'analysisValueEstimatedPrice': rng.uniform(10, 1000, n).round(2),
+        'analysisValuePewiValue': pewi,
+        'analysisValuePriceFlag': np.where(rng.rand(n) < 0.1, 'forecast', 'actual'),
+        'marketID': series // 20,
+        'commodityID': series % 20,
+        'priceTypeID': 15,
+        'commodityUnitID': 5,
+        'currencyName': 'USD',
+        'categoryId': series % 8,
+        'commodityUnitName': 'KG',
+        'commodityName': ['Commodity {}'.format(i) for i in series % 20],
+        'priceTypeName': 'Retail',
+        'name': 'cereals and tubers',
+        'marketName': ["Market {}'s".format(i) for i in series // 20],
+        'admin1Name': 'Region',
+        'admin1Code': series // 200,
+    })
+    return df
+
+
+def benchmark(n=200000):
+    '''
+    Time each way of parsing `n` synthetic ALPS observations, half of which are already in the Carto table
+    INPUT   n: number of observations to parse (integer)
+    RETURN  results: seconds taken by each method (dictionary)
+    '''
+    df = syntheticAlps(n)
+    existing = syntheticAlps(n // 2)
+    existing_uids = parseAlpsFrame(existing, UidRegistry())
+    existing_uids = [row[0] for row in existing_uids]
+    results = {}
+
+    # row by row with the old list of IDs, on a sample
+    sample = df.iloc[:LIST_SAMPLE]
+    ids = _IdList(existing_uids[:LIST_SAMPLE // 2])
+    start = time.time()
+    rows = [parseAlps(dict(x), ids) for i, x in sample.iterrows()]
+    results['list'] = time.time() - start
+
+    # row by row with the registry
+    registry = UidRegistry(existing_uids)
+    start = time.time()
+    rows = [parseAlps(dict(x), registry) for i, x in df.iterrows()]
+    rows = [row for row in rows if row]
+    results['registry'] = time.time() - start
+
+    # whole dataframe at once
+    registry = UidRegistry(existing_uids)
+    start = time.time()
+    frame_rows = parseAlpsFrame(df, registry)
+    results['frame'] = time.time() - start
+    assert frame_rows == rows, 'parseAlpsFrame rows differ from parseAlps rows'
+
+    # save and load the registry
+    path = os.path.join(tempfile.mkdtemp(), 'uids.npy')
+    start = time.time()
+    registry.save(path)
+    assert len(UidRegistry.load(path)) == len(registry)
+    results['save_load'] = time.time() - start
+
+    print('{} observations, {} already in the table, {} new rows'.format(n, len(existing_uids), len(rows)))
+    print('parseAlps with a list of IDs    {:8.2f} s ({} observations)'.format(results['list'], len(sample)))
+    print('parseAlps with UidRegistry      {:8.2f} s'.format(results['registry']))
+    print('parseAlpsFrame with UidRegistry {:8.2f} s'.format(results['frame']))
+    print('UidRegistry save and load       {:8.2f} s ({} bytes)'.format(results['save_load'], os.path.getsize(path)))
+    return results
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
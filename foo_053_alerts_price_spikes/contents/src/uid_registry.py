@@ -0,0 +1,79 @@
+'''
+Compact registry of the unique IDs already stored in a Carto table
+Each ID is kept as a 64-bit hash rather than as a string, so membership checks are O(1) and
+the registry can be saved to disk between runs at 8 bytes per ID.
+'''
+import os
+import hashlib
+import numpy as np
+
+
+def uidKey(uid):
+    '''
+    Hash a unique ID to the 64-bit key stored in the registry
+    INPUT   uid: unique ID of a row (string)
+    RETURN  64-bit key for the unique ID (integer)
+    '''
+    return int.from_bytes(hashlib.blake2b(str(uid).encode('utf8'), digest_size=8).digest(), 'little')
+
+
+class UidRegistry(object):
+    '''
+    Set of unique IDs that have already been sent to a Carto table
+    '''
+    def __init__(self, uids=()):
+        self.keys = set()
+        self.update(uids)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, uid):
+        return uidKey(uid) in self.keys
+
+    def update(self, uids):
+        '''
+        Add unique IDs to the registry
+        INPUT   uids: unique IDs to add (iterable of strings)
+        '''
+        self.keys.update(uidKey(uid) for uid in uids)
+
+    def add(self, uid):
+        '''
+        Add a unique ID to the registry if it is not already in it
+        INPUT   uid: unique ID to add (string)
+        RETURN  True if the unique ID is new, False if it was already in the registry (boolean)
+        '''
+        key = uidKey(uid)
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        return True
+
+    def addNew(self, uids):
+        '''
+        Add every unique ID that is not already in the registry, keeping only the first of any repeated IDs
+        INPUT   uids: unique IDs to check (iterable of strings)
+        RETURN  mask that is True where the unique ID was new (numpy array of booleans)
+        '''
+        return np.fromiter((self.add(uid) for uid in uids), dtype=bool)
+
+    def save(self, path):
+        '''
+        Save the registry to a .npy file, replacing the file only once it has been fully written
+        INPUT   path: location of the file to save the registry to (string)
+        '''
+        tmp = path + '.tmp.npy'
+        np.save(tmp, np.fromiter(self.keys, dtype=np.uint64, count=len(self.keys)))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load a registry saved with UidRegistry.save
+        INPUT   path: location of the saved registry (string)
+        RETURN  registry: registry holding the saved keys (UidRegistry)
+        '''
+        registry = cls()
+        registry.keys.update(np.load(path).tolist())
+        return registry
@@ -0,0 +1,195 @@
+'''
+Local record of the assets in Google Earth Engine collections
+Example:
+```
+from collectionCache import getCollection
+collection = getCollection(EE_COLLECTION, getDate=getDate)
+new_dates = [date for date in target_dates if date not in collection]
+eeUtil.uploadAssets(tifs, assets, GS_FOLDER, datestamps)
+collection.add(assets)
+for asset in collection.excess(MAX_ASSETS):
+    eeUtil.removeAsset(asset)
+collection.remove(collection.excess(MAX_ASSETS))
+most_recent_date = collection.mostRecentDate()
+```
+Listing a collection with eeUtil.ls gets slow as the collection grows, so
+the asset names are kept in a JSON file in `cache_dir` along with the
+collection's update time. On the next run the collection is only listed
+again if its update time has changed or the file is older than `max_age`
+seconds. Uploads and deletes made by the script itself are recorded with
+add and remove, so the collection does not need to be listed after them.
+
+Collections can be named by absolute asset id, such as
+'/projects/resource-watch-gee/bio_037_chl_a', or relative to the eeUtil
+working folder, such as 'cli_021_snow_cover_monthly'; relative names are
+resolved against eeUtil.getCWD() to look up the update time, so eeUtil
+must be initialized before a collection is opened.
+
+Connectors build their Docker images from their own folder, so copy this
+file next to the connector's `__init__.py` to use it, and mount the cache
+folder as a volume so it survives between runs.
+'''
+import bisect
+import json
+import logging
+import os
+import time
+
+import ee
+import eeUtil
+
+# seconds to trust the saved asset list before listing the collection again
+MAX_AGE = 7 * 24 * 3600
+
+# collections opened by this process, by name
+_collections = {}
+
+
+def _fileName(collection):
+    return collection.strip('/').replace('/', '__') + '.json'
+
+
+class CollectionCache(object):
+    '''
+    The assets in a GEE collection, and the date of each
+    `getDate` function that returns the date of an asset from its name;
+    dates must sort in time order, such as '20200131'
+    `public` whether to make the collection public if it has to be created
+    Lookups by date, the most recent date and the excess assets are read
+    from memory without listing the collection
+    '''
+    def __init__(self, collection, getDate=None, cache_dir='cache', max_age=MAX_AGE, public=True):
+        self.collection = collection
+        self.getDate = getDate or (lambda asset: asset)
+        # absolute, so that the file stays put if the script changes directory
+        self.path = os.path.join(os.path.abspath(cache_dir), _fileName(collection))
+        self.max_age = max_age
+        self.public = public
+        self.update_time = None
+        self.listed = 0
+        self._setAssets([])
+
+    def _setAssets(self, assets):
+        self.assets_by_date = {}
+        for asset in assets:
+            self.assets_by_date[self.getDate(asset)] = asset
+        self.dates = sorted(self.assets_by_date)
+
+    @property
+    def assets(self):
+        '''Names of the assets in the collection, oldest first'''
+        return [self.assets_by_date[date] for date in self.dates]
+
+    def __contains__(self, date):
+        return date in self.assets_by_date
+
+    def __len__(self):
+        return len(self.dates)
+
+    def assetId(self, asset):
+        '''Full id of an asset in the collection, from its name'''
+        return '{}/{}'.format(self.collection, os.path.basename(asset))
+
+    def mostRecentDate(self):
+        '''Date of the newest asset, or None if the collection is empty'''
+        return self.dates[-1] if self.dates else None
+
+    def excess(self, max_assets):
+        '''Full ids of the oldest assets, past the newest `max_assets`'''
+        return [self.assetId(self.assets_by_date[date]) for date in self.dates[:max(len(self.dates) - max_assets, 0)]]
+
+    def fullId(self):
+        '''Full GEE id of the collection, resolving names relative to the eeUtil working folder'''
+        if self.collection.startswith('/'):
+            return self.collection.lstrip('/')
+        return os.path.join(eeUtil.getCWD(), self.collection)
+
+    def updateTime(self):
+        '''
+        Update time of the collection on GEE; raises ee.EEException if
+        the collection does not exist
+        '''
+        return ee.data.getAsset(self.fullId()).get('updateTime')
+
+    def load(self):
+        '''
+        Read the saved asset list, listing the collection again if it
+        has changed on GEE since, and create the collection if it does
+        not exist
+        '''
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            saved = None
+        if saved and time.time() - saved['listed'] < self.max_age:
+            try:
+                update_time = self.updateTime()
+            except ee.EEException:
+                update_time = False
+            if update_time == saved['update_time']:
+                self.update_time, self.listed = saved['update_time'], saved['listed']
+                self._setAssets(saved['assets'])
+                logging.info('Read {} assets in {} from {}'.format(len(self), self.collection, self.path))
+                return self
+        return self.refresh()
+
+    def refresh(self):
+        '''List the collection on GEE, creating it if it does not exist, and save the assets'''
+        if eeUtil.exists(self.collection):
+            self._setAssets(eeUtil.ls(self.collection))
+        else:
+            logging.info('{} does not exist, creating'.format(self.collection))
+            eeUtil.createFolder(self.collection, True, public=self.public)
+            self._setAssets([])
+        self.listed = time.time()
+        self.save()
+        return self
+
+    def save(self):
+        '''Write the assets and the collection's current update time to the cache file atomically'''
+        try:
+            self.update_time = self.updateTime()
+        except ee.EEException as e:
+            logging.warning('Unable to get update time of {}: {}'.format(self.collection, e))
+            self.update_time = None
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'collection': self.collection, 'update_time': self.update_time,
+                       'listed': self.listed, 'assets': self.assets}, f)
+        os.replace(tmp, self.path)
+
+    def add(self, assets):
+        '''Record assets that have been uploaded to the collection, by name or full id'''
+        for asset in assets:
+            asset = os.path.basename(asset)
+            date = self.getDate(asset)
+            if date not in self.assets_by_date:
+                bisect.insort(self.dates, date)
+            self.assets_by_date[date] = asset
+        self.save()
+
+    def remove(self, assets):
+        '''Record assets that have been deleted from the collection, by name or full id'''
+        for asset in assets:
+            date = self.getDate(os.path.basename(asset))
+            if self.assets_by_date.pop(date, None) is not None:
+                self.dates.remove(date)
+        self.save()
+
+    def clear(self):
+        '''Record that the collection has been deleted, so that it is listed again when it is next opened'''
+        _collections.pop(self.collection, None)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def getCollection(collection, getDate=None, cache_dir='cache', max_age=MAX_AGE, public=True):
+    '''
+    Open a collection's CollectionCache, once per process; later calls
+    for the same collection return the same object
+    '''
+    if collection not in _collections:
+        _collections[collection] = CollectionCache(collection, getDate, cache_dir, max_age, public).load()
+    return _collections[collection]
@@ -4,13 +4,13 @@ import os
 import sys
 import datetime
 import logging
-import subprocess
 import eeUtil
 import requests
 import time
 import urllib
 import urllib.request
 import json
+from .rasterConvert import readBands, rollLongitudes, writeCog
 
 # url for NOAA wave height data
 SOURCE_URL = 'ftp://ftpprd.ncep.noaa.gov/pub/data/nccf/com/wave/prod/multi_1.{date}/'
@@ -343,11 +343,12 @@ def fetch(date, latest_grib):
 
      return files
 
-def convert(file):
+def convert(files, merged_tif):
      '''
-     Convert grib file to tif
-     INPUT   file: file name for grib that have already been downloaded (string)
-     RETURN  final_tif: file name for tif that have been generated (string)
+     Convert grib files to a single tif, with the data from each file as a separate band
+     INPUT   files: list of file names for gribs that have already been downloaded (list of strings)
+             merged_tif: file name for the tif we want to create (string)
+     RETURN  merged_tif: file name for tif that have been generated (string)
      '''
      
      '''
@@ -357,28 +358,16 @@ def convert(file):
             !gdalinfo grib_file_name
      I looked at the 'Corner Coordinates' that were printed out.
 
-     Since the longitude is in the wrong format, we will have to fix it. First,
-     we will convert the files from grib to tifs using gdal_translate,
-     then we will fix the longitude values using gdalwarp.
+     Since the longitude is in the wrong format, we will have to fix it. We read the wave height
+     band (band 5) from every grib file into one array, move the columns east of 180 degrees to
+     the western edge of the data, and write all of the forecasts straight to one tif.
      '''
-     # generate name for tif file that we are going to create from grib
-     temp_tif = file.split('.grib2')[0] + '_temp.tif'
-     # translate the grib file into a tif
-     cmd = ['gdal_translate','-b', '5', '-a_srs', 'EPSG:4326', file, temp_tif] 
-     subprocess.call(cmd) 
-     # Now we will fix the longitude. To do this we need the x and y resolution.
-     # I also got x and y res for data set using the gdalinfo command described above.
-     xres='0.500000000000000'
-     yres= '-0.500000000000000'
-     # generate name for the final corrected tif
-     final_tif = file.split('.grib2')[0] + '.tif'
-     # fix bounds
-     cmd_warp = ['gdalwarp', '-t_srs', 'EPSG:4326', '-tr', xres, yres, temp_tif, final_tif, '-wo', 
-                'SOURCE_EXTRA=1000', '--config', 'CENTER_LONG', '0']
-     # using the gdal from command line from inside python
-     subprocess.call(cmd_warp) 
-
-     return final_tif
+     # read the wave height band from each grib file, setting 9999 as the nodata value
+     data, profile = readBands([(file, 5) for file in files], nodata=9999)
+     # fix the longitude
+     profile['transform'] = rollLongitudes(data, profile['transform'])
+     # write all forecast data to a single tif, with each forecast as a separate band
+     return writeCog(merged_tif, data, profile)
 
 def processNewData(existing_dates_steps):
     '''
@@ -401,21 +390,11 @@ def processNewData(existing_dates_steps):
         # fetch grib files for new data
         logging.info('Fetching files')        
         files = fetch(available_date, latest_grib)
-        # create an empty list to store tifs that will be generated from fetched grib file
-        tifs = []
-        # loop through each grib file and convert them to tif format
-        for _file in files:
-            logging.info('Converting file: {}'.format(_file))
-            # convert gribs to tifs and store the tif filenames to a list
-            tifs.append(convert(_file))
-
-        logging.info('Merging all forecast data to a single tif as separate bands')
+        logging.info('Converting all forecast data to a single tif as separate bands')
         # generate a name to save the tif file that will be produced by merging all forecast data   
         merged_tif = 'merged_' + available_time_step + '_' + available_date + '.tif'
-        # merge all forecast data from grib into a single tif by adding each forecast as 
-        # separate bands
-        merge_cmd = ['gdal_merge.py', '-a_nodata', '9999', '-seperate'] + tifs + ['-o', merged_tif]
-        subprocess.call(merge_cmd)
+        # convert gribs to a single tif by adding each forecast as separate bands
+        convert(files, merged_tif)
 
         logging.info('Uploading files')
         # Generate a name we want to use for the asset once we upload the file to GEE
@@ -10,8 +10,12 @@ import requests
 import json
 import time
 import geopandas as gpd
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import glob
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import warnings
+from . import cartoUploads
 warnings.simplefilter(action='ignore', category=UserWarning)
 
 # do you want to delete everything currently in the Carto table when you run this script?
@@ -34,9 +38,22 @@ session = requests.Session()
 # name of the table in Carto that stores administrative boundaries
 CARTO_GEO = 'wpsi_adm2_counties_display'
 
+# name of data directory in Docker container
+DATA_DIR = 'data'
+
+# local cache of the administrative boundaries, named by the version of the Carto table they were downloaded from
+# the boundaries are only downloaded again when the Carto table changes
+BOUNDARY_CACHE = os.path.join(DATA_DIR, CARTO_GEO + '_{version}.parquet')
+
+# number of administrative areas to upload to Carto in each request
+UPLOAD_BLOCKSIZE = 100
+
 # column that stores the unique ids
 UID_FIELD = 'objectid'
 
+# maximum number of characters of ids to send in a single "= ANY(ARRAY[...])" SQL query
+MAX_ID_BYTES = 100000
+
 # column that stores time in the point dataset
 TIME_FIELD = 'event_date'
 
@@ -73,6 +90,15 @@ MIN_PAGES = 1
 # maximum pages to process
 MAX_PAGES = 800
 
+# number of pages to fetch from the ACLED API at the same time
+FETCH_WORKERS = 8
+
+# local cache of the pages fetched from the ACLED API for a date range, so a crashed run resumes where it stopped
+PAGE_CACHE_DIR = os.path.join(DATA_DIR, 'acled_pages_{date_start}_{date_end}')
+
+# columns to pull from the ACLED data
+ACLED_COLS = ['data_id', 'event_type', 'latitude', 'longitude']
+
 # Resource Watch dataset API ID
 # Important! Before testing this script:
 # Please change this ID OR comment out the getLayerIDs(DATASET_ID) function in the script below
@@ -158,73 +184,87 @@ The functions below have been tailored to this specific dataset.
 They should all be checked because their format likely will need to be changed.
 '''
 
+def fetch_page(src_url, page, cache_dir):
+    '''
+    Fetch one page of ACLED data, from the local page cache if it has already been fetched
+    INPUT   src_url: the url to fetch data from, formatted with everything but the page number (string)
+            page: the page number to fetch (integer)
+            cache_dir: directory storing the pages already fetched for this date range (string)
+    RETURN  page_df: ACLED data on this page (pandas dataframe)
+    '''
+    cache = os.path.join(cache_dir, 'page_{}.json'.format(page))
+    if os.path.exists(cache):
+        # load the page fetched by a previous run
+        with open(cache) as f:
+            data = json.load(f)
+    else:
+        # maximum attempts to make
+        n_tries = 5
+        for i in range(n_tries):
+            try:
+                # generate the url and pull data for this page 
+                r = session.get(src_url.format(page=page))
+                r.raise_for_status()
+                data = r.json()['data']
+                break
+            except Exception as e:
+                logging.warning('Attempt #{} to fetch page {} unsuccessful: {}'.format(i, page, e))
+                if i == n_tries - 1:
+                    logging.error('Could not fetch page {}'.format(page))
+                    raise
+                # wait longer after each failed attempt
+                time.sleep(2 ** i)
+        # write the page to a temporary file first so a crash never leaves a partial page in the cache
+        with open(cache + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(cache + '.tmp', cache)
+    logging.info('Fetched page {} ({} rows)'.format(page, len(data)))
+    # keep the columns we need; if a column doesn't exist in the source data, store blank
+    return pd.DataFrame({col: [obs.get(col, '') for obs in data] for col in ACLED_COLS}, columns=ACLED_COLS)
+
 def fetch_data(src_url):
     '''
     Fetch ACLED data via the API
     INPUT   src_url: the url to fetch data from (string)
     RETURN  data_gdf: ACLED data during the past 12 months (geopandas dataframe)
     '''
-    src_url = SOURCE_URL
     # the dates between which we want the data 
     date_start = get_date_range()[0].strftime("%Y-%m-%d")
     date_end = get_date_range()[1].strftime("%Y-%m-%d")
-
-    # specify the page of source url we want to pull
-    # initialize at 0 so that we can start pulling from page 1 in the loop
-    page = 0
-
-    # length (number of rows) of new_data
-    # initialize at 1 so that the while loop works during first step
-    new_count = 1
-
-    # create an empty list to store ids of data
-    new_ids = []
-    # create an empty dataframe to store data
-    data_df = pd.DataFrame()
-    # get and parse each page; stop when no new results or max pages
-    # process up to MIN_PAGES even if there are no new results from them
-    while page <= MIN_PAGES or new_count and page < MAX_PAGES:
-        try:
-            # increment page number in every loop
-            page += 1
-            logging.info("Fetching page {}".format(page))
-            # create an empty list to store data
-            new_rows = []
-            # generate the url and pull data for this page 
-            r = requests.get(src_url.format(key=ACLED_KEY, user=ACLED_USER, date_start=date_start, date_end=date_end, page=page))
-            # columns of the pandas dataframe
-            """  cols = ["data_id", "event_date", "year", "time_precision", "event_type", "sub_event_type", "actor1", "assoc_actor_1", "inter1", 
-            "actor2", "assoc_actor_2", "inter2", "interaction", "country", "iso3", "region", "admin1", "admin2", "admin3", "location", 
-            "geo_precision", "time_precision", "source", "source_scale", "notes", "fatalities", "latitude", "longitude"] """
-            cols = ['data_id','event_type', 'latitude', 'longitude']
-
-            # pull data from request response json
-            for obs in r.json()['data']:
-                # append the id to the list for sending to Carto 
-                new_ids.append(obs['data_id'])
-                # create an empty list to store data from this row
-                row = []
-                # go through each column in the Carto table
-                for col in cols:
-                    try:
-                        # add data for remaining fields to the list of data from this row
-                        row.append(obs[col])
-                    except:
-                        logging.debug('{} not available for this row'.format(col))
-                        # if the column we are trying to retrieve doesn't exist in the source data, store blank
-                        row.append('')
-
-                # add the list of values from this row to the list of new data
-                new_rows.append(row)
-            
-            # number of new rows added in this page 
-            new_count = len(new_rows)
-            # append the new rows to the pandas dataframe
-            data_df = data_df.append(pd.DataFrame(new_rows, columns=cols))
-
-        except:
-            logging.error('Could not fetch or process page {}'.format(page))
-    # drop duplicate records by data_id
+    # fill in everything in the url except the page number
+    src_url = src_url.format(key=ACLED_KEY, user=ACLED_USER, date_start=date_start, date_end=date_end, page='{page}')
+
+    # create the page cache for this date range, and remove caches left over from other date ranges
+    cache_dir = PAGE_CACHE_DIR.format(date_start=date_start, date_end=date_end)
+    for old_cache in glob.glob(PAGE_CACHE_DIR.format(date_start='*', date_end='*')):
+        if old_cache != cache_dir:
+            shutil.rmtree(old_cache, ignore_errors=True)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # create a dictionary to store the data from each page
+    pages = {}
+    # the first page found to be empty; no pages after it are needed
+    last_page = MAX_PAGES
+    # the next page to request
+    page = 1
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        futures = {}
+        while futures or page <= last_page:
+            # keep FETCH_WORKERS pages in flight until we reach the first empty page
+            while len(futures) < FETCH_WORKERS and page <= last_page:
+                futures[executor.submit(fetch_page, src_url, page, cache_dir)] = page
+                page += 1
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                done_page = futures.pop(future)
+                pages[done_page] = future.result()
+                # stop at the first empty page, processing up to MIN_PAGES even if there are no results from them
+                if pages[done_page].empty and done_page >= MIN_PAGES:
+                    last_page = min(last_page, done_page)
+    logging.info('Fetched {} pages'.format(last_page))
+
+    # build the dataframe from all the pages in one go, and drop duplicate records by data_id
+    data_df = pd.concat([pages[p] for p in sorted(pages) if p <= last_page], ignore_index=True)
     data_df = data_df.drop_duplicates(['data_id']).iloc[:, 1:]
 
     # convert the pandas dataframe to a geopandas dataframe
@@ -240,53 +280,91 @@ def processNewData(data_gdf):
     INPUT   data_gdf: geopandas dataframe storing the point ACLED data (geopandas dataframe)
     RETURN  new_ids: list of unique ids of new data sent to Carto table (list of strings)
     '''
-    # get the ids of polygons from the carto table storing administrative areas
-    r = cartosql.getFields('objectid', CARTO_GEO, f='csv', post=True, user=CARTO_USER, key=CARTO_KEY)
-    
-    # turn the response into a list of ids
-    geo_id = r.text.split('\r\n')[1:-1]
-    
-    # create an empty list to store the ids of rows uploaded to Carto
-    uploaded_ids = []
+    # load the administrative areas, from the local cache if the Carto table hasn't changed since the last run
+    geo_gdf = load_admin_areas(CARTO_GEO)
 
     # get the list of isos of countries covered by acled 
     acled_coverage = fetch_acled_iso()
+    # only keep the administrative areas in countries covered by acled
+    geo_gdf = geo_gdf[geo_gdf['gid_0'].isin(acled_coverage)].drop_duplicates('objectid')
+    # keep only the columns needed for the join, and build the spatial index on that exact frame so that sjoin
+    # queries this prebuilt tree instead of building a new one
+    geo_index = geo_gdf[['objectid', 'geometry']]
+    geo_index.sindex
+
+    # spatial join the acled data for the whole year to the polygons to get the number of points per polygon
+    joined = spatial_join(data_gdf, geo_gdf, geo_index)
+
+    # convert the dataframe to plain python objects for upload, with the geometry column as geojson 
+    upload_df = pd.DataFrame(joined).astype(object)
+    upload_df['geometry'] = [convert_geometry(geom) for geom in joined.geometry]
+    # replace all null values with None
+    upload_df = upload_df.where(upload_df.notnull(), None)
+    rows = upload_df.values.tolist()
+
+    # upload the rows in blocks, sending up to 8 blocks concurrently
+    # a block is only sent again if Carto rate limited it or it never reached Carto, so no rows are inserted twice
+    results = cartoUploads.insertRowsConcurrent(CARTO_TABLE, CARTO_SCHEMA.keys(), CARTO_SCHEMA.values(), rows,
+                                                user=CARTO_USER, key=CARTO_KEY, blocksize=UPLOAD_BLOCKSIZE, workers=8)
+    failed = [result for result in results if not result['ok']]
+    if failed:
+        raise Exception('Upload of {} of {} blocks to Carto failed: {}'.format(len(failed), len(results), failed[0]['error']))
+    # get the ids of the rows uploaded to Carto
+    uid_index = list(CARTO_SCHEMA.keys()).index(UID_FIELD)
+    uploaded_ids = [row[uid_index] for row in rows]
+    logging.info('{} of rows uploaded to Carto.'.format(len(uploaded_ids)))
 
-    # number of rows in each slice 
-    slice = 1000
-
-    # access the administrative areas in slices 
-    for i in range(0, len(geo_id), slice):
-        # if the number of polygons left is smaller than the slice size
-        # update the slice size to be the number of polygons left 
-        if len(geo_id) - i < slice:
-            slice = len(geo_id) - i
-        # fetch the administrative polygons from Carto based on the list of ids
-        geo_gdf = get_admin_area(CARTO_GEO, geo_id[i:i+slice])
-        # spatial join the acled data to the polygons to get the number of points per polygon
-        joined = spatial_join(data_gdf, geo_gdf)
-        # convert the geometry column to geojson 
-        joined['geometry'] = [convert_geometry(geom) for geom in joined.geometry]
-        
+    return uploaded_ids
+
+def get_admin_version(admin_table):
+    '''
+    Get a version string for the Carto table storing the administrative areas, which changes whenever the table is edited
+    INPUT   admin_table: the name of the carto table storing the administrative areas (string)
+    RETURN  version: the last time the table was updated, or its row count if that is unavailable (string)
+    '''
+    try:
+        # ask Carto when the table was last modified
+        sql = "SELECT updated_at FROM CDB_QueryTables_Updated_At('SELECT * FROM \"{}\"')".format(admin_table)
+        r = cartosql.sendSql(sql, user=CARTO_USER, key=CARTO_KEY, f='csv', post=True)
+        version = r.text.split('\r\n')[1]
+    except Exception:
+        # fall back to the number of rows and the largest id in the table
+        r = cartosql.getFields(['count(*)', 'max(cartodb_id)'], admin_table, f='csv', post=True, user=CARTO_USER, key=CARTO_KEY)
+        version = r.text.split('\r\n')[1]
+    # keep only characters that are safe to use in a file name
+    return re.sub('[^0-9A-Za-z]+', '', version)
+
+def load_admin_areas(admin_table):
+    '''
+    Load the administrative areas from the local cache, downloading them from Carto if the table has changed
+    INPUT   admin_table: the name of the carto table storing the administrative areas (string)
+    RETURN  admin_gdf: all administrative areas (geopandas dataframe)
+    '''
+    # generate the name of the cache file for the current version of the table
+    cache = BOUNDARY_CACHE.format(version=get_admin_version(admin_table))
+    if os.path.exists(cache):
+        logging.info('Loading administrative areas from {}'.format(cache))
+        admin_gdf = gpd.read_parquet(cache)
+    else:
+        logging.info('Downloading administrative areas from {}'.format(admin_table))
+        # get the ids of polygons from the carto table storing administrative areas
+        r = cartosql.getFields('objectid', admin_table, f='csv', post=True, user=CARTO_USER, key=CARTO_KEY)
+        # turn the response into a list of ids
+        geo_id = r.text.split('\r\n')[1:-1]
+        # number of rows in each slice 
+        slice = 1000
+        # fetch the administrative polygons from Carto in slices, sending the requests concurrently
         with ThreadPoolExecutor(max_workers = 8) as executor:
-            futures = []
-            for index, row in joined.iterrows():
-                # for each polygon in the geopandas dataframe
-
-                # replace all null values with None
-                row = row.where(row.notnull(), None)
-                # if it's among the acled covered countries and have not been uploaded already 
-                # submit a task to the executor to upload it to carto 
-                if row['objectid'] not in uploaded_ids and row['gid_0'] in acled_coverage: 
-                    futures.append(
-                        executor.submit(
-                            upload_to_carto, row)
-                            )
-            for future in as_completed(futures):
-                uploaded_ids.append(future.result())
-        logging.info('{} of rows uploaded to Carto.'.format(slice))
+            gdfs = list(executor.map(lambda i: get_admin_area(admin_table, geo_id[i:i + slice]), range(0, len(geo_id), slice)))
+        admin_gdf = gpd.GeoDataFrame(pd.concat(gdfs, ignore_index=True), geometry='geometry')
+        # remove caches of older versions of the table
+        for old_cache in glob.glob(BOUNDARY_CACHE.format(version='*')):
+            os.remove(old_cache)
+        # store the polygons so the next run doesn't need to download them again
+        admin_gdf.to_parquet(cache)
+        logging.info('{} administrative areas cached to {}'.format(len(admin_gdf), cache))
 
-    return uploaded_ids
+    return admin_gdf
 
 def fetch_acled_iso():
     '''
@@ -310,55 +388,6 @@ def convert_geometry(geom):
     '''
     return geom.__geo_interface__
 
-def upload_to_carto(row):
-    '''
-    Function to upload data to the Carto table 
-    INPUT   row: the geopandas dataframe of data we want to upload (geopandas dataframe)
-    RETURN  the objectid of the row just uploaded (string)
-    '''
-    # maximum attempts to make
-    n_tries = 8
-    # sleep time between each attempt   
-    retry_wait_time = 6
-
-    insert_exception = None
-
-    # construct the sql query to upload the row to the carto table
-    fields = CARTO_SCHEMA.keys()
-    values = cartosql._dumpRows([row.values.tolist()], tuple(CARTO_SCHEMA.values()))
-    # include the API key and the sql query in the payload of the request 
-    payload = {
-        'api_key': CARTO_KEY,
-        'q': 'INSERT INTO "{}" ({}) VALUES {}'.format(CARTO_TABLE, ', '.join(fields), values)
-        }
-  
-    for i in range(n_tries):
-        try:
-            # send the sql query to the carto API 
-            r = session.post('https://{}.carto.com/api/v2/sql'.format(CARTO_USER), json=payload)
-            r.raise_for_status()
-        except Exception as e: # if there's an exception do this
-            insert_exception = e
-            if r.status_code != 429:
-                try:
-                    logging.warning(r.content)
-                except:
-                    pass
-            logging.warning('Attempt #{} to upload row #{} unsuccessful. Trying again after {} seconds'.format(i, row['objectid'], retry_wait_time))
-            logging.debug('Exception encountered during upload attempt: '+ str(e))
-            time.sleep(retry_wait_time)
-        else: # if no exception do this
-            return row['objectid']
-    else:
-        # this happens if the for loop completes, ie if it attempts to insert row n_tries times
-        logging.error('Upload of row #{} has failed after {} attempts'.format(row['objectid'], n_tries))
-        logging.error('Problematic row: '+ str(row))
-        logging.error('Raising exception encountered during last upload attempt')
-        logging.error(insert_exception)
-        raise insert_exception
-    
-    return row['objectid']
-
 def get_admin_area(admin_table, id_list):
     '''
     Obtain entries in Carto table based on values in a specified column
@@ -366,46 +395,38 @@ def get_admin_area(admin_table, id_list):
             id_list: list of ids for rows to fetch from the table (list of strings)
     RETURN  admin_gdf: data fetched from the table (geopandas dataframe)
     '''
-    # generate empty variable to store WHERE clause of SQL query we will send
-    where = None
     # column: column name where you should search for these values 
     column = 'objectid'
-    # go through each ID in the list to be deleted
-    for id in id_list:
-        # if we already have values in the SQL query, add the new value with an OR before it
-        if where:
-            where += f" OR {column} = '{id}'"
-        # if the SQL query is empty, create the start of the WHERE clause
-        else:
-            where = f"{column} = '{id}'"
-    
-    sql = 'SELECT * FROM "{}" WHERE {}'.format(admin_table, where)
-    # send the request to the Carto API to fetch the corresponding administrative area data
-    r = cartosql.sendSql(sql, user=CARTO_USER, key=CARTO_KEY, f = 'GeoJSON', post=True)
-    # convert the response to json a
-    data = r.json()
+    # create an empty list to store the polygons fetched
+    features = []
+    # match the ids as a set with "= ANY(ARRAY[...])" rather than chaining OR conditions
+    for where in id_set_where(column, id_list):
+        sql = 'SELECT * FROM "{}" WHERE {}'.format(admin_table, where)
+        # send the request to the Carto API to fetch the corresponding administrative area data
+        r = cartosql.sendSql(sql, user=CARTO_USER, key=CARTO_KEY, f = 'GeoJSON', post=True)
+        # add the features in the response to the list of polygons
+        features.extend(r.json()['features'])
     # convert the data to a geopandas dataframe 
-    admin_gdf = gpd.GeoDataFrame.from_features(data)
-    
+    admin_gdf = gpd.GeoDataFrame.from_features(features)
 
     return admin_gdf
 
-def spatial_join(gdf_pt, gdf_poly):
+def spatial_join(gdf_pt, gdf_poly, gdf_index):
     '''
     Spatial join two geopandas dataframes 
     INPUT   gdf_pt: the point data from ACLED (geopandas dataframe)
             gdf_poly: the polygons of administrative areas (geopandas dataframe)
+            gdf_index: the ids and geometries of gdf_poly, with their spatial index already built (geopandas dataframe)
     RETURN  pt_poly: number of events per polygon (geopandas dataframe)
     '''
-    # spatial join the two geopandas dataframes
-    dfsjoin = gpd.sjoin(gdf_poly, gdf_pt)
+    # spatial join the points to the polygons in a single pass, querying the polygons' prebuilt spatial index
+    dfsjoin = gpd.sjoin(gdf_pt, gdf_index, how='inner')
     # count the number of points per administrative area 
-    pt_count = dfsjoin.groupby(['objectid', 'event_type']).size().reset_index(name='counts')
-    # convert the dataframe from long to wide form so each type of event has a column 
-    pt_count = pd.pivot_table(pt_count, index = 'objectid', columns='event_type')
+    # convert the counts from long to wide form so each type of event has a column 
+    pt_count = dfsjoin.groupby(['objectid', 'event_type']).size().unstack(fill_value=0)
 
     # clean up the column names to match the naming requirements of Carto 
-    pt_count.columns = [x.lower().replace(' ', '_').replace('/', '_') for x in pt_count.columns.droplevel(0)]
+    pt_count.columns = [x.lower().replace(' ', '_').replace('/', '_') for x in pt_count.columns]
     # merge the counts to the original administrative area dataframe
     pt_poly = gdf_poly.merge(pt_count, how='left', on='objectid')
 
@@ -522,32 +543,48 @@ def updateResourceWatch(num_new):
             # replace layer title with new dates
             update_layer(layer, cur_title)
 
+def id_set_where(column, id_list):
+    '''
+    Generate WHERE clauses matching a column against sets of ids
+    INPUT   column: column name where you should search for these values (string)
+            id_list: list of column values to match (list of strings)
+    RETURN  generator of WHERE clauses of the form "column = ANY(ARRAY[...])" (strings)
+    '''
+    # create an empty list to store the quoted ids of the current chunk
+    literals = []
+    # number of characters of SQL text in the current chunk
+    size = 0
+    for id in id_list:
+        # quote the id and escape any quotes inside it
+        literal = "'{}'".format(str(id).replace("'", "''"))
+        # if adding this id would make the query too long, send the current chunk and start a new one
+        if literals and size + len(literal) > MAX_ID_BYTES:
+            yield '{} = ANY(ARRAY[{}])'.format(column, ','.join(literals))
+            literals = []
+            size = 0
+        literals.append(literal)
+        size += len(literal) + 1
+    # send the remaining ids
+    if literals:
+        yield '{} = ANY(ARRAY[{}])'.format(column, ','.join(literals))
+
 def delete_carto_entries(id_list):
     '''
     Delete entries in Carto table based on values in a specified column
     INPUT   id_list: list of column values for which you want to delete entries in table (list of strings)
+    RETURN  number of ids deleted (number)
     '''
-    # generate empty variable to store WHERE clause of SQL query we will send
-    where = None
     # column: column name where you should search for these values 
     column = UID_FIELD
-    # go through each ID in the list to be deleted
-    for delete_id in id_list:
-        # if we already have values in the SQL query, add the new value with an OR before it
-        if where:
-            where += f" OR {column} = '{delete_id}'"
-        # if the SQL query is empty, create the start of the WHERE clause
-        else:
-            where = f"{column} = '{delete_id}'"
-        # if where statement is long or we are on the last id, delete rows
-        # the length of 15000 was chosen arbitrarily - all the IDs to be deleted could not be sent at once, but no
-        # testing was done to optimize this value
-        if len(where) > 15000 or delete_id == id_list[-1]:
-            cartosql.deleteRows(CARTO_TABLE, where=where, user=CARTO_USER,
-                                key=CARTO_KEY)
-            # after we have deleted a set of rows, start over with a blank WHERE clause for the SQL query so we don't
-            # try to delete rows we have already deleted
-            where = None
+    # match the ids as a set with one "= ANY(ARRAY[...])" clause per chunk, rather than chaining OR conditions,
+    # and delete the chunks concurrently
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        futures = [executor.submit(cartosql.deleteRows, CARTO_TABLE, where, user=CARTO_USER, key=CARTO_KEY)
+                   for where in id_set_where(column, id_list)]
+        for future in as_completed(futures):
+            future.result()
+    
+    return len(id_list)
 
 def main():
     logging.basicConfig(stream=sys.stderr, level=logging.INFO)
@@ -565,10 +602,8 @@ def main():
         logging.info("clearing table")
         # if the table exists
         if cartosql.tableExists(CARTO_TABLE, user=CARTO_USER, key=CARTO_KEY):
-            with ThreadPoolExecutor(max_workers=10) as executor:
-                for i in range(0, len(existing_ids), 500):
-                    # loop through the existing ids to remove all rows from the table in chunks of size 500 
-                    executor.submit(delete_carto_entries, existing_ids[i: i + 500])
+            # delete the existing ids in chunks, sending the chunks concurrently
+            delete_carto_entries(existing_ids)
             logging.info('{} rows of old records removed!'.format(len(existing_ids)))
             # delete all the rows
             cartosql.deleteRows(CARTO_TABLE, 'cartodb_id IS NOT NULL', user=CARTO_USER, key=CARTO_KEY)
@@ -584,4 +619,8 @@ def main():
     # Update Resource Watch
     updateResourceWatch(num_new)
 
+    # the upload succeeded, so the cached ACLED pages are no longer needed
+    shutil.rmtree(PAGE_CACHE_DIR.format(date_start=get_date_range()[0].strftime("%Y-%m-%d"),
+                                        date_end=get_date_range()[1].strftime("%Y-%m-%d")), ignore_errors=True)
+
     logging.info('SUCCESS')
\ No newline at end of file
@@ -5,149 +5,40 @@ import sys
 import datetime
 import logging
 import ee
-import time
-import requests
-import json
+from .apiUtils import (session, forEach, getDatasets, getLastUpdate, getLayers, getLayerIDs,
+                       lastUpdateDates, patchLayers, flushTileCaches)
 
-def getLastUpdate(dataset):
-    '''
-    Given a Resource Watch dataset's API ID,
-    this function will get the current 'last update date' from the API
-    and return it as a datetime
-    INPUT   dataset: Resource Watch API dataset ID (string)
-    RETURN  lastUpdateDT: current 'last update date' for the input dataset (datetime)
-    '''
-    # generate the API url for this dataset
-    apiUrl = 'http://api.resourcewatch.org/v1/dataset/{}'.format(dataset)
-    # pull the dataset from the API
-    r = requests.get(apiUrl)
-    # find the 'last update date'
-    lastUpdateString=r.json()['data']['attributes']['dataLastUpdated']
-    # split this date into two pieces at the seconds decimal so that the datetime module can read it:
-    # ex: '2020-03-11T00:00:00.000Z' will become '2020-03-11T00:00:00' (nofrag) and '000Z' (frag)
-    nofrag, frag = lastUpdateString.split('.')
-    # generate a datetime object
-    nofrag_dt = datetime.datetime.strptime(nofrag, "%Y-%m-%dT%H:%M:%S")
-    # add back the microseconds to the datetime
-    lastUpdateDT = nofrag_dt.replace(microsecond=int(frag[:-1])*1000)
-    return lastUpdateDT
-
-def getLayerIDs(dataset):
-    '''
-    Given a Resource Watch dataset's API ID,
-    this function will return a list of all the layer IDs associated with it
-    INPUT   dataset: Resource Watch API dataset ID (string)
-    RETURN  layerIDs: Resource Watch API layer IDs for the input dataset (list of strings)
-    '''
-    # generate the API url for this dataset - this must include the layers
-    apiUrl = 'http://api.resourcewatch.org/v1/dataset/{}?includes=layer'.format(dataset)
-    # pull the dataset from the API
-    r = requests.get(apiUrl)
-    #get a list of all the layers
-    layers = r.json()['data']['attributes']['layer']
-    # create an empty list to store the layer IDs
-    layerIDs =[]
-    # go through each layer and add its ID to the list
-    for layer in layers:
-        # only add layers that have Resource Watch listed as its application
-        if layer['attributes']['application']==['rw']:
-            layerIDs.append(layer['id'])
-    return layerIDs
-
-def flushTileCache(layer_id):
-    """
-    Given the API ID for a GEE layer on Resource Watch,
-    this function will clear the layer cache.
-    If the cache is not cleared, when you view the dataset on Resource Watch, old and new tiles will be mixed together.
-    INPUT   layer_id: Resource Watch API layer ID (string)
-    """
-    # generate the API url for this layer's cache
-    apiUrl = 'http://api.resourcewatch.org/v1/layer/{}/expire-cache'.format(layer_id)
-    # create headers to send with the request to clear the cache
-    headers = {
-    'Content-Type': 'application/json',
-    'Authorization': os.getenv('apiToken')
-    }
+# url to pull the latest information about dataset syncs from a Carto account
+CARTO_SYNC_URL = 'https://{account}.carto.com/api/v1/synchronizations/'
 
-    # clear the cache for the layer
-    # sometimetimes this fails, so we will try multiple times, if it does
-
-    # specify that we are on the first try
-    try_num=1
-    tries = 4
-    while try_num<tries:
-        try:
-            # try to delete the cache
-            r = requests.delete(url = apiUrl, headers = headers, timeout=1000)
-            # if we get a 200, the cache has been deleted
-            # if we get a 504 (gateway timeout) - the tiles are still being deleted, but it worked
-            if r.ok or r.status_code==504:
-                logging.info('[Cache tiles deleted] for {}: status code {}'.format(layer_id, r.status_code))
-                return r.status_code
-            # if we don't get a 200 or 504:
-            else:
-                # if we are not on our last try, wait 60 seconds and try to clear the cache again
-                if try_num < (tries-1):
-                    logging.info('Cache failed to flush: status code {}'.format(r.status_code))
-                    time.sleep(60)
-                    logging.info('Trying again.')
-                # if we are on our last try, log that the cache flush failed
-                else:
-                    logging.error('Cache failed to flush: status code {}'.format(r.status_code))
-                    logging.error('Aborting.')
-            try_num += 1
-        except Exception as e:
-            logging.error('Failed: {}'.format(e))
-
-def lastUpdateDate(dataset, date):
-    '''
-    Given a Resource Watch dataset's API ID and a datetime,
-    this function will update the dataset's 'last update date' on the API with the given datetime
-    INPUT   dataset: Resource Watch API dataset ID (string)
-            date: date to set as the 'last update date' for the input dataset (datetime)
-    '''
-    # generate the API url for this dataset
-    apiUrl = 'http://api.resourcewatch.org/v1/dataset/{0}'.format(dataset)
-    # create headers to send with the request to update the 'last update date'
-    headers = {
-    'Content-Type': 'application/json',
-    'Authorization': os.getenv('apiToken')
-    }
-    # create the json data to send in the request
-    body = {
-        "dataLastUpdated": date.isoformat() # date should be a string in the format 'YYYY-MM-DDTHH:MM:SS'
-    }
-    # send the request
-    try:
-        r = requests.patch(url = apiUrl, json = body, headers = headers)
-        logging.info('[lastUpdated]: SUCCESS, '+ date.isoformat() +' status code '+str(r.status_code))
-        return 0
-    except Exception as e:
-        logging.error('[lastUpdated]: '+str(e))
-
-def create_headers():
-    '''
-    Create headers to perform authorized actions on API
+# time format used by Carto
+CARTO_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
 
-    '''
-    return {
-        'Content-Type': "application/json",
-        'Authorization': "{}".format(os.getenv('apiToken')),
-    }
+# make dictionary associating GEE assets with RW dataset IDs
+GEE_DATASETS = {
+    'HYCOM/sea_temp_salinity': 'e6c0dd9e-3dde-4296-91d8-87ac26ed038f',
+    'HYCOM/sea_water_velocity': 'e050ee5c-0dfa-491d-862c-2274e8597793',
+    'NASA_USDA/HSL/SMAP_soil_moisture': 'e7b9efb2-3836-45ae-8b6a-f8391c7bcd2f',
+    'UCSB-CHG/CHIRPS/PENTAD': '55cb7e8d-a978-4184-b347-4ba64cd88ad2',
+    'JAXA/GPM_L3/GSMaP/v6/operational': '1e8919fc-c1a8-4814-b819-31cdad17651e',
+    'MODIS/006/MCD64A1': '4d3d6f25-6e66-426f-be9b-32777b4755cc'
+}
 
-def pull_layers_from_API(dataset_id):
-    '''
-    Pull dictionary of current layers from API
-    INPUT   dataset_id: Resource Watch API dataset ID (string)
-    RETURN  layer_dict: dictionary of layers (dictionary of strings)
-    '''
-    # generate url to access layer configs for this dataset in back office
-    rw_api_url = 'https://api.resourcewatch.org/v1/dataset/{}/layer'.format(dataset_id)
-    # request data
-    r = requests.get(rw_api_url)
-    # convert response into json and make dictionary of layers
-    layer_dict = json.loads(r.content.decode('utf-8'))['data']
-    return layer_dict
+# make dictionary associating Carto tables on the WRI-RW account with RW dataset IDs
+WRIRW_DATASETS = {'modis_c6_global_7d': 'a9e33aad-eece-4453-8279-31c4b4e0583f',
+                  'df_map_2ylag_1': '25eebe25-aaf2-48fc-ab7b-186d7498f393'}
+
+# make dictionary associating Carto tables on the GFW account (WRI-01) with RW dataset IDs
+GFW_DATASETS = {'gfw_wood_fiber': '83de627f-524b-4162-a10c-384dc3e8107a',
+                'forma_activity': 'e1b40fdd-04f9-43ab-b4f1-d3ceee39fea1',
+                'biodiversity_hotspots': '4458eb12-8572-45d1-bf07-d5a3ee097021'}
+
+# make dictionary associating Carto tables on the RW-NRT account with RW dataset IDs
+RWNRT_DATASETS = {'oil_palm_concessions': '6e05a9e8-ba07-4e6f-8337-31c5362d07fe',
+                  'suomi_viirs_c2_global_7d': '64c948a6-5e34-4ef2-bb69-6a6535967bd5'}
+
+# Carto tables on the RW-NRT account whose layer titles show the date of the data
+RWNRT_LAYER_TITLES = ['suomi_viirs_c2_global_7d']
 
 def get_date_sal_vel(title, new_date):
     '''
@@ -281,6 +172,7 @@ def update_layer(collection_name, layer, new_date):
     INPUT   collection_name: name of asset/table to be updated (string)
             layer: layer that will be updated (string)
             new_date: date of asset to be shown in this layer (datetime)
+    RETURN  payload: new title and layer configuration to send to the API (dictionary)
     '''
     # get current layer titile
     cur_title = layer['attributes']['name']
@@ -302,25 +194,12 @@ def update_layer(collection_name, layer, new_date):
     # replace date in layer's title with new date
     layer['attributes']['name'] = layer['attributes']['name'].replace(old_date_text, new_date_text)
 
-    # send patch to API to replace layers
-    # generate url to patch layer
-    rw_api_url_layer = "https://api.resourcewatch.org/v1/dataset/{dataset_id}/layer/{layer_id}".format(
-        dataset_id=layer['attributes']['dataset'], layer_id=layer['id'])
-    # create payload with new title and layer configuration
-    payload = {
+    # create payload with new title and layer configuration, to send to the API to replace the layer
+    return {
         'application': ['rw'],
         'name': layer['attributes']['name']
     }
-    # patch API with updates
-    r = requests.request('PATCH', rw_api_url_layer, data=json.dumps(payload), headers=create_headers())
-    # check response
-    # if we get a 200, the layers have been replaced
-    # if we get a 504 (gateway timeout) - the layers are still being replaced, but it worked
-    if r.ok or r.status_code==504:
-        logging.info('Layer replaced: {}'.format(layer['id']))
-    else:
-        logging.error('Error replacing layer: {} ({})'.format(layer['id'], r.status_code))
-        
+
 def initialize_ee():
     '''
     Initialize ee module
@@ -334,6 +213,67 @@ def initialize_ee():
     auth = ee.ServiceAccountCredentials(GEE_SERVICE_ACCOUNT, _CREDENTIAL_FILE)
     ee.Initialize(auth)
 
+def get_most_recent_dates(collection_names):
+    '''
+    Get the time stamp of the most recent asset in each of several GEE collections with a single request
+    INPUT   collection_names: names of the GEE collections (list of strings)
+    RETURN  most_recent_dates: end time of the most recent asset, by collection name (dictionary of datetimes)
+    '''
+    # build one dictionary on GEE of the most recent asset time stamp of every collection, so that all of
+    # them are computed by GEE and fetched in a single round trip
+    time_ends = ee.Dictionary({
+        collection_name: ee.ImageCollection(collection_name).sort('system:time_end', False).first().get('system:time_end')
+        for collection_name in collection_names
+    }).getInfo()
+    # get time from each asset in milliseconds since the UNIX epoch, convert to seconds and then to a datetime
+    return {collection_name: datetime.datetime.fromtimestamp(time_ends[collection_name]/1000)
+            for collection_name in collection_names}
+
+def get_carto_syncs(account, api_key):
+    '''
+    Pull the latest information about dataset syncs from a Carto account
+    INPUT   account: Carto account name (string)
+            api_key: Carto API key for the account (string)
+    RETURN  last_syncs: time of the last sync of each table, by table name (dictionary of datetimes)
+    '''
+    r = session.get(CARTO_SYNC_URL.format(account=account), params={'api_key': api_key}, timeout=60)
+    r.raise_for_status()
+    # note about sync info available from Carto:
+    # ran_at = The date time at which the table had its contents synched with the source file.
+    # updated_at = The date time at which the table had its contents modified.
+    # modified_at = The date time at which the table was manually modified, if applicable.
+    return {table['name']: datetime.datetime.strptime(table['ran_at'], CARTO_TIME_FORMAT)
+            for table in r.json()['synchronizations']}
+
+def update_datasets(datasets, latest_dates, layer_titles=(), flush=False):
+    '''
+    Update the layer titles and 'last update dates' of datasets on Resource Watch, sending the requests for all of the
+    datasets at once
+    INPUT   datasets: RW dataset IDs, by GEE collection or Carto table name (dictionary of strings)
+            latest_dates: date of the most recent data, by GEE collection or Carto table name (dictionary of datetimes)
+            layer_titles: GEE collections or Carto tables whose layer titles should show the new date (list of strings)
+            flush: whether to flush the tile cache of the layers of updated datasets (boolean)
+    '''
+    # replace the dates in the layer titles
+    layer_updates = []
+    for name in layer_titles:
+        logging.info('Updating {}'.format(name))
+        layer_updates += [(layer, update_layer(name, layer, latest_dates[name])) for layer in getLayers(datasets[name])]
+    patchLayers(layer_updates)
+    # find the datasets whose timestamp is not correct
+    new_dates = {}
+    for name, dataset_id in datasets.items():
+        # get last update date currently being displayed on RW
+        current_date = getLastUpdate(dataset_id)
+        if current_date != latest_dates[name]:
+            logging.info('Updating ' + name)
+            new_dates[dataset_id] = latest_dates[name]
+    # Update the datasets' last update dates on Resource Watch
+    lastUpdateDates(new_dates)
+    if flush:
+        # flush the tile cache for all layers in the updated datasets so that the old tiles are deleted
+        flushTileCaches([layer_id for dataset_id in new_dates for layer_id in getLayerIDs(dataset_id)])
+
 def main():
     logging.basicConfig(stream=sys.stderr, level=logging.INFO)
     logging.info('STARTING')
@@ -341,168 +281,35 @@ def main():
     # initialize ee module
     initialize_ee()
 
+    # fetch every dataset, with its layers, from the API at once
+    getDatasets(list(GEE_DATASETS.values()) + list(WRIRW_DATASETS.values()) +
+                list(GFW_DATASETS.values()) + list(RWNRT_DATASETS.values()))
+
     '''
     update last update dates on RW for datasets in GEE Catalog
     '''
-    # make dictionary associating GEE assets with RW dataset IDs
-    GEE_DATASETS = {
-        'HYCOM/sea_temp_salinity': 'e6c0dd9e-3dde-4296-91d8-87ac26ed038f',
-        'HYCOM/sea_water_velocity': 'e050ee5c-0dfa-491d-862c-2274e8597793',
-        'NASA_USDA/HSL/SMAP_soil_moisture': 'e7b9efb2-3836-45ae-8b6a-f8391c7bcd2f',
-        'UCSB-CHG/CHIRPS/PENTAD': '55cb7e8d-a978-4184-b347-4ba64cd88ad2',
-        'JAXA/GPM_L3/GSMaP/v6/operational': '1e8919fc-c1a8-4814-b819-31cdad17651e',
-        'MODIS/006/MCD64A1': '4d3d6f25-6e66-426f-be9b-32777b4755cc'
-    }
-    # Check if datasets have been updated
-    for collection_name, dataset_id in GEE_DATASETS.items():
-        # get last update date currently being displayed on RW
-        current_date = getLastUpdate(dataset_id)
-        # load GEE collection and get most recent asset time stamp
-        collection = ee.ImageCollection(collection_name)
-        most_recent_asset = collection.sort('system:time_end', opt_ascending=False).first()
-        # get time from asset in milliseconds since the UNIX epoch and convert to seconds
-        most_recent_date_unix = most_recent_asset.get('system:time_end').getInfo()/1000
-        # convert to datetime
-        most_recent_date = datetime.datetime.fromtimestamp(most_recent_date_unix)
-        # Update the dates on layer legends
-        logging.info('Updating {}'.format(collection_name))
-        # pull dictionary of current layers from API
-        layer_dict = pull_layers_from_API(dataset_id)
-        # go through each layer, pull the definition and update
-        for layer in layer_dict:
-            # replace layer title with new dates
-            update_layer(collection_name, layer, most_recent_date)
-        # if our timestamp is not correct, update it
-        if current_date!=most_recent_date:
-            logging.info('Updating ' + collection_name)
-            # Update dataset's last update date on Resource Watch
-            lastUpdateDate(dataset_id, most_recent_date)
-            # flush the tile cache for all layer in the dataset so that the old tiles are deleted
-            layer_ids = getLayerIDs(dataset_id)
-            for layer_id in layer_ids:
-                flushTileCache(layer_id)
-                
+    # get the most recent asset time stamp of every collection at once
+    latest_dates = get_most_recent_dates(list(GEE_DATASETS))
+    # Update the dates on layer legends and the datasets' last update dates, and flush the tile caches
+    update_datasets(GEE_DATASETS, latest_dates, layer_titles=list(GEE_DATASETS), flush=True)
     logging.info('Success for GEE Catalog data sets')
 
-
     '''
-    update last update dates on RW for datasets on WRI-RW Carto account
+    update last update dates on RW for datasets on the Carto accounts
     '''
-    # make dictionary associating Carto tables with RW dataset IDs
-    WRIRW_DATASETS = {'modis_c6_global_7d': 'a9e33aad-eece-4453-8279-31c4b4e0583f',
-                      'df_map_2ylag_1': '25eebe25-aaf2-48fc-ab7b-186d7498f393'}
-
-    # pull the latest information about dataset syncs from WRI-RW Carto account
-    url = "https://{account}.carto.com/api/v1/synchronizations/?api_key={API_key}".format(
-        account=os.getenv('CARTO_WRI_RW_USER'), API_key=os.getenv('CARTO_WRI_RW_KEY'))
-    r = requests.get(url)
-    json = r.json()
-    sync = json['synchronizations']
-
-    # go through each of the dataset on RW from this account
-    for table_name, id in WRIRW_DATASETS.items():
-        # get the last update date currently showing on RW
-        current_date = getLastUpdate(id)
-        # find the synchronization information from Carto for this table
-        table = next(item for item in sync if item["name"] == table_name)
-        # find when the last sync occurred
-        # note about sync info available from Carto:
-        # ran_at = The date time at which the table had its contents synched with the source file.
-        # updated_at = The date time at which the table had its contents modified.
-        # modified_at = The date time at which the table was manually modified, if applicable.
-        last_sync = table['ran_at']
-        # define the time format used by Carto
-        TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
-        # generate a datetime for the last synchronization of this table
-        last_update_time = datetime.datetime.strptime(last_sync, TIME_FORMAT)
-        # update the last update date on RW, if needed
-        if current_date!=last_update_time:
-            logging.info('Updating ' + table_name)
-            lastUpdateDate(id, last_update_time)
-    logging.info('Success for WRI-RW')
+    # pull the latest information about dataset syncs from the WRI-RW, WRI-01 and RW-NRT Carto accounts at once
+    accounts = [(os.getenv('CARTO_WRI_RW_USER'), os.getenv('CARTO_WRI_RW_KEY')),
+                (os.getenv('CARTO_WRI_01_USER'), os.getenv('CARTO_WRI_01_KEY')),
+                (os.getenv('CARTO_USER'), os.getenv('CARTO_KEY'))]
+    wrirw_syncs, gfw_syncs, rwnrt_syncs = forEach(lambda account: get_carto_syncs(*account), accounts)
 
+    # update the last update date on RW, if needed
+    update_datasets(WRIRW_DATASETS, wrirw_syncs)
+    logging.info('Success for WRI-RW')
 
-    '''
-    update last update dates on RW for datasets on GFW Carto account (WRI-01)
-    '''
-    # make dictionary associating Carto tables with RW dataset IDs
-    GFW_DATASETS = {'gfw_wood_fiber': '83de627f-524b-4162-a10c-384dc3e8107a',
-                    'forma_activity': 'e1b40fdd-04f9-43ab-b4f1-d3ceee39fea1',
-                    'biodiversity_hotspots': '4458eb12-8572-45d1-bf07-d5a3ee097021'}
-
-    # pull the latest information about dataset syncs from WRI-01 Carto account
-    url = "https://{account}.carto.com/api/v1/synchronizations/?api_key={API_key}".format(
-        account=os.getenv('CARTO_WRI_01_USER'), API_key=os.getenv('CARTO_WRI_01_KEY'))
-    r = requests.get(url)
-    json = r.json()
-    sync = json['synchronizations']
-
-    # go through each of the dataset on RW from this account
-    for table_name, id in GFW_DATASETS.items():
-        # get the last update date currently showing on RW
-        current_date = getLastUpdate(id)
-        # find the synchronization information from Carto for this table
-        table = next(item for item in sync if item["name"] == table_name)
-        # find when the last sync occurred
-        # note about sync info available from Carto:
-        # ran_at = The date time at which the table had its contents synched with the source file.
-        # updated_at = The date time at which the table had its contents modified.
-        # modified_at = The date time at which the table was manually modified, if applicable.
-        last_sync = table['ran_at']
-        # define the time format used by Carto
-        TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
-        # generate a datetime for the last synchronization of this table
-        last_update_time = datetime.datetime.strptime(last_sync, TIME_FORMAT)
-        # update the last update date on RW, if needed
-        if current_date!=last_update_time:
-            logging.info('Updating ' + table_name)
-            lastUpdateDate(id, last_update_time)
+    update_datasets(GFW_DATASETS, gfw_syncs)
     logging.info('Success for WRI-01')
 
-
-    '''
-    update last update dates on RW for datasets on RW-NRT Carto account
-    '''
-    # make dictionary associating Carto tables with RW dataset IDs
-    RWNRT_DATASETS = {'oil_palm_concessions': '6e05a9e8-ba07-4e6f-8337-31c5362d07fe',
-                      'suomi_viirs_c2_global_7d': '64c948a6-5e34-4ef2-bb69-6a6535967bd5'}
-
-    # pull the latest information about dataset syncs from RW-NRT Carto account
-    url = "https://{account}.carto.com/api/v1/synchronizations/?api_key={API_key}".format(
-        account=os.getenv('CARTO_USER'), API_key=os.getenv('CARTO_KEY'))
-    r = requests.get(url)
-    # the variable name here is changed from json to json_data to stop interference
-    # of json in the function pull_layers_from_API
-    json_data = r.json()
-    sync = json_data['synchronizations']
-
-    # go through each of the dataset on RW from this account
-    for table_name, id in RWNRT_DATASETS.items():
-        # get the last update date currently showing on RW
-        current_date = getLastUpdate(id)
-        # find the synchronization information from Carto for this table
-        table = next(item for item in sync if item["name"] == table_name)
-        # find when the last sync occurred
-        # note about sync info available from Carto:
-        # ran_at = The date time at which the table had its contents synched with the source file.
-        # updated_at = The date time at which the table had its contents modified.
-        # modified_at = The date time at which the table was manually modified, if applicable.
-        last_sync = table['ran_at']
-        # define the time format used by Carto
-        TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
-        # generate a datetime for the last synchronization of this table
-        last_update_time = datetime.datetime.strptime(last_sync, TIME_FORMAT)
-        # Update the dates on layer legends
-        logging.info('Updating {}'.format(table_name))
-        # pull dictionary of current layers from API
-        layer_dict = pull_layers_from_API(id)
-        if table_name == 'suomi_viirs_c2_global_7d':
-            # go through each layer, pull the definition and update
-            for layer in layer_dict:
-                # replace layer title with new dates
-                update_layer(table_name, layer, last_update_time)
-        # update the last update date on RW, if needed
-        if current_date!=last_update_time:
-            logging.info('Updating ' + table_name)
-            lastUpdateDate(id, last_update_time)
-    logging.info('Success for RW-NRT')
\ No newline at end of file
+    # also update the dates on layer legends
+    update_datasets(RWNRT_DATASETS, rwnrt_syncs, layer_titles=RWNRT_LAYER_TITLES)
+    logging.info('Success for RW-NRT')
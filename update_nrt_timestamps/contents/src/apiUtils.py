@@ -0,0 +1,183 @@
+'''
+Resource Watch API client shared by the near real-time scripts
+Example:
+```
+from apiUtils import getLastUpdate, getLayerIDs, lastUpdateDate, flushTileCaches
+if getLastUpdate(DATASET_ID) != most_recent_date:
+    lastUpdateDate(DATASET_ID, most_recent_date)
+    flushTileCaches(getLayerIDs(DATASET_ID))
+```
+Every request goes through one pooled session and is retried with
+exponential backoff when the API is busy or unreachable. Each dataset,
+with its layers, is fetched from the API once per process and then read
+from memory, and layer updates and cache flushes for many layers are
+sent side by side.
+
+Connectors build their Docker images from their own folder, so copy this
+file next to the connector's `__init__.py` to use it. Requests that change
+the API need the `apiToken` environment variable.
+'''
+import datetime
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+RW_API_URL = 'https://api.resourcewatch.org/v1'
+# requests sent to the API at once
+WORKERS = 8
+# retries on server errors and dropped connections
+MAX_RETRIES = 5
+# base wait in seconds; attempt n waits up to BACKOFF_FACTOR * 2**n
+BACKOFF_FACTOR = 2
+MAX_BACKOFF = 60
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# a 504 (gateway timeout) on a layer update or cache flush means the API is still working on it
+DONE_STATUSES = (504,)
+# seconds to wait for the API to respond
+TIMEOUT = 60
+# seconds to wait for a tile cache flush, which can be slow
+FLUSH_TIMEOUT = 1000
+# format of the dates the API returns
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+session = requests.Session()
+adapter = requests.adapters.HTTPAdapter(pool_connections=WORKERS, pool_maxsize=WORKERS)
+session.mount('https://', adapter)
+
+# datasets fetched from the API by this process, with their layers, by dataset ID
+_datasets = {}
+_lock = threading.Lock()
+
+
+def createHeaders():
+    '''Headers to perform authorized actions on the API'''
+    return {
+        'Content-Type': 'application/json',
+        'Authorization': '{}'.format(os.getenv('apiToken')),
+    }
+
+
+def request(method, path, done_statuses=(), timeout=TIMEOUT, **kwargs):
+    '''
+    Send a request to the API, retrying with exponential backoff on
+    RETRY_STATUSES and dropped connections unless the status is in
+    `done_statuses`; raises once the retries run out
+    `timeout` seconds to wait for each attempt
+    '''
+    url = RW_API_URL + path
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            r = session.request(method, url, timeout=timeout, **kwargs)
+            if r.ok or r.status_code in done_statuses:
+                return r
+            if r.status_code not in RETRY_STATUSES or attempt >= MAX_RETRIES:
+                r.raise_for_status()
+            error = '{} {}: status code {}'.format(method, url, r.status_code)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= MAX_RETRIES:
+                raise
+            error = '{} {}: {}'.format(method, url, e)
+        wait = random.uniform(0, min(MAX_BACKOFF, BACKOFF_FACTOR * 2 ** attempt))
+        logging.warning('{}; retrying in {:.1f}s'.format(error, wait))
+        time.sleep(wait)
+
+
+def forEach(function, items, workers=WORKERS):
+    '''Call `function` on each item side by side, returning the results in order'''
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(function, items))
+
+
+def getDataset(dataset, refresh=False):
+    '''
+    Get a dataset, including its layers, from the API, or from memory if
+    it has already been fetched by this process
+    '''
+    with _lock:
+        if dataset in _datasets and not refresh:
+            return _datasets[dataset]
+    data = request('GET', '/dataset/{}'.format(dataset), params={'includes': 'layer'}).json()['data']
+    with _lock:
+        _datasets[dataset] = data
+    return data
+
+
+def getDatasets(datasets):
+    '''Fetch several datasets from the API side by side, so that later lookups are read from memory'''
+    return forEach(getDataset, datasets)
+
+
+def getLastUpdate(dataset):
+    '''Get a dataset's 'last update date' (datetime)'''
+    return datetime.datetime.strptime(getDataset(dataset)['attributes']['dataLastUpdated'], DATE_FORMAT)
+
+
+def getLayers(dataset):
+    '''Get the layers of a dataset (list of dictionaries)'''
+    return getDataset(dataset)['attributes']['layer']
+
+
+def getLayerIDs(dataset):
+    '''Get the IDs of a dataset's layers that have Resource Watch listed as their application'''
+    return [layer['id'] for layer in getLayers(dataset) if layer['attributes']['application'] == ['rw']]
+
+
+def lastUpdateDate(dataset, date):
+    '''Set a dataset's 'last update date' to `date` (datetime)'''
+    try:
+        r = request('PATCH', '/dataset/{}'.format(dataset), json={'dataLastUpdated': date.isoformat()},
+                    headers=createHeaders())
+        logging.info('[lastUpdated]: SUCCESS, ' + date.isoformat() + ' status code ' + str(r.status_code))
+    except Exception as e:
+        logging.error('[lastUpdated]: {}'.format(e))
+        return
+    # keep the copy in memory up to date
+    with _lock:
+        if dataset in _datasets:
+            _datasets[dataset]['attributes']['dataLastUpdated'] = date.strftime(DATE_FORMAT)
+    return 0
+
+
+def lastUpdateDates(dates):
+    '''Set the 'last update date' of several datasets side by side; `dates` maps dataset IDs to datetimes'''
+    return forEach(lambda item: lastUpdateDate(*item), list(dates.items()))
+
+
+def patchLayer(layer, payload):
+    '''Update a layer with the attributes in `payload` (dictionary)'''
+    try:
+        r = request('PATCH', '/dataset/{}/layer/{}'.format(layer['attributes']['dataset'], layer['id']),
+                    done_statuses=DONE_STATUSES, json=payload, headers=createHeaders())
+        logging.info('Layer replaced: {}'.format(layer['id']))
+        return r.status_code
+    except Exception as e:
+        logging.error('Error replacing layer: {} ({})'.format(layer['id'], e))
+
+
+def patchLayers(updates):
+    '''Update several layers side by side; `updates` list of (layer, payload) pairs'''
+    return forEach(lambda update: patchLayer(*update), updates)
+
+
+def flushTileCache(layer_id):
+    '''
+    Clear the tile cache of a layer, so that old and new tiles are not
+    mixed together when the dataset is viewed on Resource Watch
+    '''
+    try:
+        r = request('DELETE', '/layer/{}/expire-cache'.format(layer_id), done_statuses=DONE_STATUSES,
+                    timeout=FLUSH_TIMEOUT, headers=createHeaders())
+        logging.info('[Cache tiles deleted] for {}: status code {}'.format(layer_id, r.status_code))
+        return r.status_code
+    except Exception as e:
+        logging.error('Cache failed to flush for {}: {}'.format(layer_id, e))
+
+
+def flushTileCaches(layer_ids):
+    '''Clear the tile caches of several layers side by side'''
+    return forEach(flushTileCache, layer_ids)
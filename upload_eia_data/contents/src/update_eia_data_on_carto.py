@@ -6,6 +6,11 @@ import requests
 import os
 from collections import OrderedDict
 import shutil
+import json
+import time
+import random
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import cartosql
 from carto.datasets import DatasetManager
 from carto.auth import APIKeyAuthClient
@@ -13,6 +18,7 @@ import boto3
 from botocore.exceptions import NoCredentialsError
 import zipfile
 from zipfile import ZipFile
+from .countryCrosswalk import CountryCrosswalk
 
 
 logging.basicConfig(stream = sys.stderr, level = logging.INFO)
@@ -33,18 +39,68 @@ CARTO_SCHEMA = OrderedDict([
     ('year', 'numeric'),
     ('unit','text'),
     ('yr_data','numeric'),
-    ('datetime', 'timestamp')])
+    ('datetime', 'timestamp'),
+    ('rw_country_name', 'text'),
+    ('rw_country_code', 'text')])
 
 # name of data directory in Docker container
 DATA_DIR = 'data'
 
-# pull in sheet with information about each EIA dataset and where it is stored on Carto and the RW API
-eia_rw_table = pd.read_csv(
-    'https://raw.githubusercontent.com/resource-watch/nrt-scripts/master/upload_eia_data/EIA_RW_dataset_names_ids.csv').set_index(
-    'Carto Table')
+# name of directory in Docker container to keep files in between runs
+CACHE_DIR = 'cache'
 
-# get list of all current Carto table names
-carto_table_names = cartosql.getTables(user = CARTO_USER, key = CARTO_KEY)
+# url of sheet with information about each EIA dataset and where it is stored on Carto and the RW API
+EIA_RW_TABLE_URL = 'https://raw.githubusercontent.com/resource-watch/nrt-scripts/master/upload_eia_data/EIA_RW_dataset_names_ids.csv'
+
+# urls of the EIA API to find the series in a category and to fetch the data of a series
+CATEGORY_URL = 'https://api.eia.gov/category/'
+SERIES_URL = 'https://api.eia.gov/series/'
+
+# number of EIA series to fetch at once
+FETCH_WORKERS = 8
+
+# number of times to try a request to the EIA API before giving up
+MAX_TRIES = 5
+# base number of seconds to wait between tries; try n waits up to BACKOFF_FACTOR * 2**n seconds
+BACKOFF_FACTOR = 2
+# response statuses from the EIA API that are worth trying again
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# number of seconds to wait for the EIA API to respond
+TIMEOUT = 60
+
+# directory to keep the data for each EIA series in between runs, so series that have not been updated are not
+# fetched again
+SERIES_CACHE_DIR = os.path.join(CACHE_DIR, 'eia_series')
+
+# pooled session for requests to the EIA API, shared by the threads fetching series
+session = requests.Session()
+adapter = requests.adapters.HTTPAdapter(pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS)
+session.mount('https://', adapter)
+
+@functools.lru_cache(maxsize=None)
+def get_eia_rw_table():
+    '''
+    This function pulls in the sheet with information about each EIA dataset, the first time it is needed
+    RETURN  sheet with information about each EIA dataset, indexed by Carto table name (pandas dataframe)
+    '''
+    return pd.read_csv(EIA_RW_TABLE_URL).set_index('Carto Table')
+
+@functools.lru_cache(maxsize=None)
+def get_carto_table_names():
+    '''
+    This function gets the list of all current Carto table names, the first time it is needed
+    RETURN  names of the tables in the Carto account (list of strings)
+    '''
+    return cartosql.getTables(user = CARTO_USER, key = CARTO_KEY)
+
+@functools.lru_cache(maxsize=None)
+def get_crosswalk():
+    '''
+    This function loads the lookup from ISO3 codes to standard Resource Watch country names, the first time it is needed,
+    reusing the copy in the cache directory if it was fetched within the last week
+    RETURN  country name crosswalk (CountryCrosswalk)
+    '''
+    return CountryCrosswalk.load(os.path.join(CACHE_DIR, 'country_crosswalk.json'), CARTO_USER)
 
 def upload_to_aws(local_file, bucket, s3_file):
     '''
@@ -70,6 +126,58 @@ def upload_to_aws(local_file, bucket, s3_file):
         logging.error("Credentials not available")
         return False
 
+def get_json(url, params):
+    '''
+    This function sends a request to the EIA API, trying again with exponential backoff if the request fails in a way
+    that might not happen again
+    INPUT   url: url of the EIA API endpoint (string)
+            params: parameters of the request (dictionary)
+    RETURN  response from the API (json)
+    '''
+    for attempt in range(1, MAX_TRIES + 1):
+        try:
+            r = session.get(url, params = params, timeout = TIMEOUT)
+            r.raise_for_status()
+            return r.json()
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+            status = e.response.status_code if e.response is not None else None
+            if attempt == MAX_TRIES or (status is not None and status not in RETRY_STATUSES):
+                raise
+            # wait a random time so that threads failing together do not try again together
+            wait = random.uniform(0, BACKOFF_FACTOR * 2 ** attempt)
+            # log the status rather than the error, which would include the API key in the url
+            logging.warning('Request to EIA API failed ({}), trying again in {:.1f} seconds'.format(
+                status or type(e).__name__, wait))
+            time.sleep(wait)
+
+def fetch_series(child):
+    '''
+    This function fetches the data for an EIA series, unless the copy in the cache was saved when the series was last
+    updated
+    INPUT   child: information about the series from its category, including 'series_id' and 'updated' (dictionary)
+    RETURN  series: geography, units and data of the series (dictionary)
+    '''
+    cache_file = os.path.join(SERIES_CACHE_DIR, child['series_id'] + '.json')
+    updated = child.get('updated')
+    # use the cached copy of the series if it is up to date
+    if updated:
+        try:
+            with open(cache_file) as f:
+                series = json.load(f)
+            if series['updated'] == updated:
+                return series
+        except (IOError, ValueError, KeyError):
+            pass
+    logging.info('Fetching data for {}'.format(child['series_id']))
+    data = get_json(SERIES_URL, {'api_key': EIA_KEY, 'series_id': child['series_id']})['series'][0]
+    series = {'updated': updated, 'geography': data['geography'], 'units': data['units'], 'data': data['data']}
+    # save the series to the cache, replacing the old copy only once the new one has been fully written
+    tmp = cache_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(series, f)
+    os.replace(tmp, cache_file)
+    return series
+
 def fetch_eia_data(table_name):
     '''
     This function fetches and processes data from the EIA API for a specified Carto table
@@ -77,40 +185,33 @@ def fetch_eia_data(table_name):
     RETURN  all_eia_data: dataframe of processed data for this table (pandas dataframe)
     '''
     # pull the eia catogory id that is included in this table
-    category_id = eia_rw_table.loc[table_name, 'eia_category_id']
-    eia_unit = eia_rw_table.loc[table_name, 'eia_unit']
-
-    # insert the url used to find the series ids of the data 
-    url = 'https://api.eia.gov/category/?api_key={}&category_id={}'.format(EIA_KEY, category_id)
-
-    # fetch the information of all series of data in this category from the API 
-    r = requests.get(url)
-    series = r.json()['category']['childseries']
-
-    # store the names, ids and units of the child series in a list of dictionaries
-    ids = [{'country': ', '.join(child['name'].split(', ')[1:-1]), 'series_id': child['series_id'], 'units': child['units']} for child in series]
-    # subset the dictionary list by EIA unit
-    ids = [id for id in ids if id['units'] == eia_unit]
-
-    # create an empty dataframe to store data 
-    df = pd.DataFrame()
-    # loop through each series id
-    for id in ids:
-        # construct the API call to fetch data from the series
-        data_url = 'https://api.eia.gov/series/?api_key={}&series_id={}'.format(EIA_KEY, id['series_id'])
-        logging.info('Fetching data for {}'.format(id['country']))
-        # extract the data from the response 
-        data = requests.get(data_url).json()['series'][0]
-        # create a dataframe with the column 'year' and 'yr_data' from the data 
-        df_country = pd.DataFrame({'year':[x for [x,y] in data['data']], 'yr_data': [y for [x,y] in data['data']]})
-        # create a new column 'country' to store the country information 
-        df_country['country'] = id['country']
-        # create a new column 'geography' to store the code of the country/region
-        df_country['geography'] = data['geography']
-        # create a new column 'unit' to store the units
-        df_country['unit'] = data['units']
-        # concat the data frame to the larger dataframe created before the loop
-        df = pd.concat([df, df_country], ignore_index=True)
+    category_id = get_eia_rw_table().loc[table_name, 'eia_category_id']
+    eia_unit = get_eia_rw_table().loc[table_name, 'eia_unit']
+
+    # fetch the information of all series of data in this category from the API
+    series = get_json(CATEGORY_URL, {'api_key': EIA_KEY, 'category_id': category_id})['category']['childseries']
+    # only keep the child series in the EIA unit for this table
+    children = [child for child in series if child['units'] == eia_unit]
+
+    # fetch the data for the child series, several at a time
+    os.makedirs(SERIES_CACHE_DIR, exist_ok = True)
+    with ThreadPoolExecutor(max_workers = FETCH_WORKERS) as executor:
+        series_data = list(executor.map(fetch_series, children))
+
+    # collect the values for each column from all of the series, then build the dataframe once
+    columns = OrderedDict((column, []) for column in ['year', 'yr_data', 'country', 'geography', 'unit'])
+    for child, data in zip(children, series_data):
+        n = len(data['data'])
+        # store the year and value of each data point
+        columns['year'].extend(x for [x,y] in data['data'])
+        columns['yr_data'].extend(y for [x,y] in data['data'])
+        # store the country information, taken from the name of the series
+        columns['country'].extend([', '.join(child['name'].split(', ')[1:-1])] * n)
+        # store the code of the country/region
+        columns['geography'].extend([data['geography']] * n)
+        # store the units
+        columns['unit'].extend([data['units']] * n)
+    df = pd.DataFrame(columns)
 
     # save the raw data as a csv file 
     raw_data_file = os.path.join(DATA_DIR, f'{table_name[:-5]}_data.csv')
@@ -156,6 +257,9 @@ def process_eia_data(df, table_name):
     # drop duplicate records
     df.drop_duplicates(inplace = True)
 
+    # add in RW specific country names and ISO codes, based on the code of the country in the 'geography' column
+    df = get_crosswalk().enrich(df, 'geography')
+
     # save processed dataset to csv
     processed_data_file = os.path.join(DATA_DIR, table_name+'.csv')
     df.to_csv(processed_data_file, index=False)
@@ -187,7 +291,7 @@ def main():
         os.mkdir(DATA_DIR)
 
     # process each Carto table for EIA datasets one at a time
-    for table_name, info in eia_rw_table.iterrows():
+    for table_name, info in get_eia_rw_table().iterrows():
         # get the dataset name (table name without the '_edit' at the end of the table_name
         if table_name[-5:] == '_edit':
             dataset_name = table_name[:-5]
@@ -211,7 +315,7 @@ def main():
         logging.info('Uploading processed data to Carto.')
         # check if table exists
         # if table does not exist, create it
-        if not table_name in carto_table_names:
+        if not table_name in get_carto_table_names():
             logging.info(f'Table {table_name} does not exist, creating')
             # Change privacy of table on Carto
             # set up carto authentication using local variables for username (CARTO_USER) and API key (CARTO_KEY)
@@ -230,6 +334,10 @@ def main():
         else:
             logging.info(f'Table {table_name} already exists, clearing rows')
 
+            # add any columns in the Carto schema that this table was created without
+            add_columns = ', '.join(f'ADD COLUMN IF NOT EXISTS {field} {dtype}' for field, dtype in CARTO_SCHEMA.items())
+            cartosql.sendSql(f'ALTER TABLE "{table_name}" {add_columns}', user=CARTO_USER, key=CARTO_KEY)
+
             # delete all the rows
             cartosql.deleteRows(table_name, 'cartodb_id IS NOT NULL', user=CARTO_USER, key=CARTO_KEY)
             # note: we do not delete the entire table because this will cause the dataset visualization on Resource Watch
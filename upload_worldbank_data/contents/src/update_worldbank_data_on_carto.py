@@ -1,9 +1,6 @@
 import logging
 import sys
 import pandas as pd
-import numpy as np
-import datetime
-import requests
 import os
 from collections import OrderedDict
 import urllib.request
@@ -14,6 +11,8 @@ import boto3
 from botocore.exceptions import NoCredentialsError
 from zipfile import ZipFile
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from .countryCrosswalk import CountryCrosswalk
 
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 
@@ -24,16 +23,14 @@ CARTO_KEY = os.getenv('CARTO_WRI_RW_KEY')
 # name of data directory in Docker container
 DATA_DIR = 'data'
 
+# name of directory in Docker container to keep files in between runs
+CACHE_DIR = 'cache'
+
 # pull in sheet with information about each World Bank dataset and where it is stored on Carto and the RW API
 wb_rw_table = pd.read_csv(
     'https://raw.githubusercontent.com/resource-watch/nrt-scripts/master/upload_worldbank_data/WB_RW_dataset_names_ids.csv').set_index(
     'Carto Table')
 
-# pull in sheet with World Bank name to iso3 conversions
-wb_name_to_iso3_conversion = pd.read_csv(
-    'https://raw.githubusercontent.com/resource-watch/nrt-scripts/master/upload_worldbank_data/WB_name_to_ISO3.csv').set_index(
-    'WB_name')
-
 # get list of all current Carto table names
 carto_table_names = cartosql.getTables(user = CARTO_USER, key = CARTO_KEY)
 
@@ -61,56 +58,87 @@ def upload_to_aws(local_file, bucket, s3_file):
         logging.error("Credentials not available")
         return False
 
-def add_iso(name):
+# number of World Bank indicators to download and read at once
+FETCH_WORKERS = 8
+
+# names of the regional and income groups in the World Bank data
+# we only keep country-level data, not larger political bodies
+WB_AGGREGATES = ['Arab World', 'Middle income', 'Europe & Central Asia (IDA & IBRD countries)', 'IDA total',
+                 'Latin America & the Caribbean (IDA & IBRD countries)',
+                 'Middle East & North Africa (IDA & IBRD countries)', 'blank (ID 268)',
+                 'Europe & Central Asia (excluding high income)', 'IBRD only', 'IDA only',
+                 'Early-demographic dividend', 'Latin America & the Caribbean (excluding high income)',
+                 'Middle East & North Africa', 'Middle East & North Africa (excluding high income)',
+                 'Late-demographic dividend', 'Pacific island small states', 'Europe & Central Asia',
+                 'European Union', 'High income', 'IDA & IBRD total', 'IDA blend', 'Caribbean small states',
+                 'Central Europe and the Baltics', 'East Asia & Pacific',
+                 'East Asia & Pacific (excluding high income)', 'Low & middle income',
+                 'Lower middle income', 'Other small states', 'East Asia & Pacific (IDA & IBRD countries)',
+                 'Euro area', 'OECD members', 'North America',
+                 'Middle East & North Africa (excluding high income)', 'Post-demographic dividend',
+                 'Small states', 'South Asia', 'Upper middle income', 'World',
+                 'Heavily indebted poor countries (HIPC)', 'Least developed countries: UN classification',
+                 'blank (ID 267)', 'blank (ID 265)', 'Latin America & Caribbean',
+                 'Latin America & Caribbean (excluding high income)', 'IDA & IBRD total', 'IBRD only',
+                 'Europe & Central Asia', 'Sub-Saharan Africa (excluding high income)', 'Macao SAR China',
+                 'Sub-Saharan Africa', 'Pre-demographic dividend', 'South Asia (IDA & IBRD)',
+                 'Sub-Saharan Africa (IDA & IBRD countries)', 'Upper middle income',
+                 'Fragile and conflict affected situations', 'Low income', 'Not classified']
+
+# load the lookups from World Bank country names to ISO3 codes and from ISO3 codes to standard Resource Watch country
+# names, reusing the copy in the cache directory if it was fetched within the last week
+crosswalk = CountryCrosswalk.load(os.path.join(CACHE_DIR, 'country_crosswalk.json'), CARTO_USER)
+
+def read_wb_csv(raw_data_file):
     '''
-    This function takes a World Bank country name and matches it to the appropriate ISO3 code
-    INPUT   name: World Bank name of country (string)
-    RETURN  ISO3 code for input country (string)
+    This function reads the zipped CSV downloaded from the World Bank for an indicator and reshapes it to one row per
+    country and year
+    INPUT   raw_data_file: location of the zipped CSV for this indicator (string)
+    RETURN  data: dataframe with the country_name, year, and value for each data point (pandas dataframe)
     '''
-    # try to match the country name to the ISO3 code based on loaded conversion table
-    try:
-        return wb_name_to_iso3_conversion.loc[name, "ISO"]
-    # if no match can be found, return None
-    except:
-        return np.nan
-
-# pull in table of standard Resource Watch country names and ISO codes
-sql_statement = 'SELECT iso_a3, name FROM wri_countries_a'
-country_html = requests.get(f'https://{CARTO_USER}.carto.com/api/v2/sql?q={sql_statement}')
-country_info = pd.DataFrame(country_html.json()['rows'])
-
-def add_rw_name(code):
+    with ZipFile(raw_data_file) as zip:
+        # the data are stored in the file starting with 'API_'; the other files in the archive hold metadata
+        data_file = next(name for name in zip.namelist() if name.startswith('API_'))
+        with zip.open(data_file) as f:
+            # the first four lines of the file describe the download, the header is on the fifth line
+            data = pd.read_csv(f, skiprows=4, encoding='utf-8-sig')
+    # there is one column of values per year, named after the year
+    year_columns = [col for col in data.columns if col.isdigit()]
+    # reshape so that each year of data for a country is its own row
+    data = data.melt(id_vars='Country Name', value_vars=year_columns, var_name='year', value_name='value')
+    data.columns = ['country_name', 'year', 'value']
+    data['year'] = data['year'].astype(int)
+    return data
+
+def fetch_indicator(indicator):
     '''
-    This function takes an ISO3 code and matches it to the standard Resource Watch name for the country
-    INPUT   code: ISO3 code for input country (string)
-    RETURN  standard Resource Watch name for input country (string)
+    This function downloads the zipped CSV for a World Bank indicator and reads in its data
+    INPUT   indicator: World Bank indicator code (string)
+    RETURN  raw_data_file: location of the downloaded file (string)
+            data: dataframe of the data for this indicator (pandas dataframe)
     '''
-    # try to find the RW country name for the ISO3 code based on loaded conversion table
-    temp = country_info.loc[country_info['iso_a3'] == code]
-    temp = temp['name'].tolist()
-    if temp != []:
-        return temp[0]
-    else:
-        return None
-
-def add_rw_code(code):
+    # insert the url used to download the data from the source website
+    url = f'http://api.worldbank.org/v2/en/indicator/{indicator}?downloadformat=csv'
+    # download the data from the source
+    raw_data_file = os.path.join(DATA_DIR, f'{indicator}_DS2_en_csv_v2')
+    urllib.request.urlretrieve(url, raw_data_file)
+    logging.info('Downloaded {}'.format(indicator))
+    return raw_data_file, read_wb_csv(raw_data_file)
+
+def fetch_indicators(indicators):
     '''
-    This function takes an ISO3 code and matches it to the standard Resource Watch ISO3 code for the country
-    INPUT   code: ISO3 code for input country (string)
-    RETURN  standard Resource Watch ISO3 code for input country (string)
+    This function downloads and reads the data for a list of World Bank indicators, several at a time
+    INPUT   indicators: World Bank indicator codes (list of strings)
+    RETURN  dictionary of the raw data file and dataframe for each indicator code (dictionary)
     '''
-    # try to find the RW ISO3 code for the ISO3 code based on loaded conversion table
-    temp = country_info.loc[country_info['iso_a3'] == code]
-    temp = temp['iso_a3'].tolist()
-    if temp != []:
-        return temp[0]
-    else:
-        return None
-
-def fetch_wb_data(table):
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        return dict(zip(indicators, executor.map(fetch_indicator, indicators)))
+
+def fetch_wb_data(table, indicator_data):
     '''
-    This function fetches and processes data from the World Bank API for a specified Carto table
-    INPUT   table: name of Carto table we want to fetch and process data for (string)
+    This function processes the data from the World Bank for a specified Carto table
+    INPUT   table: name of Carto table we want to process data for (string)
+            indicator_data: raw data file and dataframe for each World Bank indicator, from fetch_indicators (dictionary)
     RETURN  all_world_bank_data: dataframe of processed data for this table (pandas dataframe)
     '''
     # pull the WB indicators that are included in this table
@@ -120,68 +148,22 @@ def fetch_wb_data(table):
     # pull the list of units associated with each indicator
     units = wb_rw_table.loc[table, 'wb_units'].split(";")
 
-    # pull each of the indicators from the World Bank API one at a time
+    # add the data for each of the indicators as new columns
     for i in range(len(indicators)):
         # get the current indicator
         indicator = indicators[i]
-        # get the name of the column it will go into in Carto
-        value_name = value_names[i]
-        # get the units
-        unit = units[i]
-
-        # fetch data for this indicator (only the first 10,000 entries will be returned)
-        res = requests.get(
-            "http://api.worldbank.org/v2/countries/all/indicators/{}?format=json&per_page=10000".format(indicator))
-        # check how many pages of data there are for this indicator
-        pages = int(res.json()[0]['pages'])
-
-        # pull the data, one page at a time, appending the data to the json variable
-        json = []
-        for page in range(pages):
-            res = requests.get(
-                "http://api.worldbank.org/v2/countries/all/indicators/{}?format=json&per_page=10000&page={}".format(
-                    indicator, page + 1))
-            json = json + res.json()[1]
-
-        # format into dataframe and only keep relevant columns
-        data = pd.io.json.json_normalize(json)
-        data = data[["country.value", "date", "value"]]
-        # rename these columns
-        data.columns = ["country_name", "year", value_name]
+        # get the data for this indicator, only keeping country-level data
+        data = indicator_data[indicator][1]
+        data = data[~data['country_name'].isin(WB_AGGREGATES)]
+        # name the value column after the column it will go into in Carto
+        data = data.rename(columns={'value': value_names[i]})
         # add a units column
-        data['unit' + str(i + 1)] = unit
+        data['unit' + str(i + 1)] = units[i]
         # add indicator code column
         data['indicator_code' + str(i + 1)] = indicator
-        # standardize time column for ISO time
-        data["datetime"] = data.apply(lambda x: datetime.date(int(x['year']), 1, 1).strftime("%Y-%m-%dT%H:%M:%SZ"),
-                                  axis=1)
-
-        # only keep country-level data, not larger political bodies
-        drop_patterns = ['Arab World', 'Middle income', 'Europe & Central Asia (IDA & IBRD countries)', 'IDA total',
-                         'Latin America & the Caribbean (IDA & IBRD countries)',
-                         'Middle East & North Africa (IDA & IBRD countries)', 'blank (ID 268)',
-                         'Europe & Central Asia (excluding high income)', 'IBRD only', 'IDA only',
-                         'Early-demographic dividend', 'Latin America & the Caribbean (excluding high income)',
-                         'Middle East & North Africa', 'Middle East & North Africa (excluding high income)',
-                         'Late-demographic dividend', 'Pacific island small states', 'Europe & Central Asia',
-                         'European Union', 'High income', 'IDA & IBRD total', 'IDA blend', 'Caribbean small states',
-                         'Central Europe and the Baltics', 'East Asia & Pacific',
-                         'East Asia & Pacific (excluding high income)', 'Low & middle income',
-                         'Lower middle income', 'Other small states', 'East Asia & Pacific (IDA & IBRD countries)',
-                         'Euro area', 'OECD members', 'North America',
-                         'Middle East & North Africa (excluding high income)', 'Post-demographic dividend',
-                         'Small states', 'South Asia', 'Upper middle income', 'World',
-                         'Heavily indebted poor countries (HIPC)', 'Least developed countries: UN classification',
-                         'blank (ID 267)', 'blank (ID 265)', 'Latin America & Caribbean',
-                         'Latin America & Caribbean (excluding high income)', 'IDA & IBRD total', 'IBRD only',
-                         'Europe & Central Asia', 'Sub-Saharan Africa (excluding high income)', 'Macao SAR China',
-                         'Sub-Saharan Africa', 'Pre-demographic dividend', 'South Asia (IDA & IBRD)',
-                         'Sub-Saharan Africa (IDA & IBRD countries)', 'Upper middle income',
-                         'Fragile and conflict affected situations', 'Low income', 'Not classified']
-        data = data[~data['country_name'].isin(drop_patterns)]
-
-        # set index to country_name, datetime, and year so that we can use this information to add more columns correctly
-        data = data.set_index(["country_name", "datetime", "year"])
+
+        # set index to country_name and year so that we can use this information to add more columns correctly
+        data = data.set_index(["country_name", "year"])
 
         # if we are processing the first indicator, create the the dataframe with the current data
         if i == 0:
@@ -190,18 +172,20 @@ def fetch_wb_data(table):
         else:
             all_world_bank_data = all_world_bank_data.join(data, how="outer")
 
-    # reset the index for the table so the country_name, datetime, and year return to being columns
+    # reset the index for the table so the country_name and year return to being columns
     all_world_bank_data = all_world_bank_data.reset_index()
 
+    # standardize time column for ISO time
+    all_world_bank_data.insert(1, "datetime", all_world_bank_data["year"].astype(str) + '-01-01T00:00:00Z')
+
     # add ISO3 codes to table, based on the World Bank country names
-    all_world_bank_data.insert(0, "country_code", all_world_bank_data.apply(lambda row: add_iso(row["country_name"]), axis=1))
+    all_world_bank_data.insert(0, "country_code", crosswalk.addIso(all_world_bank_data["country_name"]))
 
     # drop rows which don't have an ISO3 assigned
     all_world_bank_data = all_world_bank_data.loc[pd.notnull(all_world_bank_data["country_code"])]
 
     # add in RW specific country names and ISO codes
-    all_world_bank_data["rw_country_name"] = all_world_bank_data.apply(lambda row: add_rw_name(row["country_code"]), axis=1)
-    all_world_bank_data["rw_country_code"] = all_world_bank_data.apply(lambda row: add_rw_code(row["country_code"]), axis=1)
+    all_world_bank_data = crosswalk.enrich(all_world_bank_data, "country_code")
 
     # make sure all null values are set to None
     all_world_bank_data = all_world_bank_data.where((pd.notnull(all_world_bank_data)), None).reset_index(drop=True)
@@ -233,34 +217,29 @@ def main():
     if not os.path.exists(data_dir):
         os.mkdir(data_dir)
 
+    '''
+    Download data and save to your data directory
+    '''
+    # download and read the CSVs for the World Bank indicators used in all of the tables at once
+    all_indicators = sorted(set(';'.join(wb_rw_table['wb_indicators']).split(';')))
+    indicator_data = fetch_indicators(all_indicators)
+
     # process each Carto table for World Bank datasets one at a time
     for table_name, info in wb_rw_table.iterrows():
         # get the dataset name (table name without the '_edit' at the end of the table_name
         dataset_name = table_name[:-5]
         logging.info('Next table to update: {}'.format(dataset_name))
 
-        '''
-        Download data and save to your data directory
-        '''
         # get a list of World Bank indicators that go into this table
         indicators = info['wb_indicators'].split(";")
-        # create an empty list to store the raw data files associated with each indicator to go on S3
-        raw_data_files = []
-        # pull the CSVs for each indicator
-        for indicator in indicators:
-            # insert the url used to download the data from the source website
-            url = f'http://api.worldbank.org/v2/en/indicator/{indicator}?downloadformat=csv'
-            # download the data from the source
-            raw_data_file = os.path.join(data_dir, f'{indicator}_DS2_en_csv_v2')
-            urllib.request.urlretrieve(url, raw_data_file)
-            # add the name of the raw data file to the list of raw data files to go on S3
-            raw_data_files.append(raw_data_file)
+        # get the list of raw data files associated with each indicator to go on S3
+        raw_data_files = [indicator_data[indicator][0] for indicator in indicators]
 
         '''
         Process data
         '''
-        # fetch and process World Bank data for this table
-        all_world_bank_data = fetch_wb_data(table_name)
+        # process World Bank data for this table
+        all_world_bank_data = fetch_wb_data(table_name, indicator_data)
         # save processed dataset to csv
         processed_data_file = os.path.join(data_dir, dataset_name + '_edit.csv')
         all_world_bank_data.to_csv(processed_data_file, index=False)
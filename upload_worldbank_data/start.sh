@@ -5,4 +5,4 @@ NAME=$(basename $(pwd))
 LOG=${LOG:-udp://localhost}
 
 docker build -t $NAME --build-arg NAME=$NAME .
-docker run --log-driver=syslog --log-opt syslog-address=$LOG --log-opt tag=$NAME --env-file .env --rm $NAME python main.py
\ No newline at end of file
+docker run --log-driver=syslog --log-opt syslog-address=$LOG --log-opt tag=$NAME -v $(pwd)/cache:/opt/$NAME/cache --env-file .env --rm $NAME python main.py
\ No newline at end of file
@@ -0,0 +1,101 @@
+'''
+Upload of large geometries to CARTO through the COPY endpoint
+Example:
+```
+from cartoCopy import route_by_size, copy_to_carto
+small_gdf, large_gdf = route_by_size(gdf, max_vertices=MAX_VERTICES)
+small_gdf.apply(insert_carto, args=(table, schema, session,), axis=1)
+if not large_gdf.empty:
+    copy_to_carto(large_gdf, table, schema, session)
+```
+Geometries with many vertices are too large to send as GeoJSON inside SQL
+text, so route_by_size splits them off by their vertex count and
+copy_to_carto streams them to CARTO as CSV with hex-encoded WKB geometries.
+
+Connectors build their Docker images from their own folder, so copy this
+file next to the connector's `__init__.py` to use it. It needs pygeos
+alongside geopandas, since geopandas 0.9 has no vectorized coordinate count
+of its own.
+'''
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pygeos
+import shapely.wkb
+
+CARTO_COPY_URL = 'https://{}.carto.com/api/v2/sql/copyfrom'
+CARTO_USER = os.getenv('CARTO_USER')
+CARTO_KEY = os.getenv('CARTO_KEY')
+
+# geometries with more vertices than this are routed to the COPY endpoint
+MAX_VERTICES = 10000
+# maximum attempts to make
+N_TRIES = 5
+# sleep time between each attempt
+RETRY_WAIT_TIME = 6
+
+
+def estimate_size(gdf):
+    '''
+    Estimate the size of each geometry in a geopandas dataframe from its number of vertices
+    INPUT   gdf: features to upload (geopandas dataframe)
+    RETURN  number of vertices of each geometry (numpy array)
+    '''
+    return pygeos.get_num_coordinates(pygeos.from_shapely(np.asarray(gdf.geometry.values)))
+
+def route_by_size(gdf, max_vertices=MAX_VERTICES, simplify_tolerance=0):
+    '''
+    Simplify geometries if simplify_tolerance is set, and split features by the size of their geometry
+    INPUT   gdf: features to upload (geopandas dataframe)
+            max_vertices: number of vertices above which a geometry is sent through COPY (integer)
+            simplify_tolerance: tolerance, in degrees, for topology-preserving simplification; 0 to skip (float)
+    RETURN  small_gdf: features small enough to insert as GeoJSON in SQL (geopandas dataframe)
+            large_gdf: features to stream to Carto with COPY (geopandas dataframe)
+    '''
+    if simplify_tolerance:
+        gdf = gdf.assign(geometry=gdf.geometry.simplify(simplify_tolerance, preserve_topology=True))
+    is_large = estimate_size(gdf) > max_vertices
+    return gdf[~is_large], gdf[is_large]
+
+def copy_to_carto(gdf, table, schema, session, user=CARTO_USER, key=CARTO_KEY):
+    '''
+    Stream features to the Carto table through the COPY endpoint, sending geometries as hex-encoded WKB rather than
+    GeoJSON inside SQL text, so large geometries don't hit request-size limits
+    INPUT   gdf: the geopandas dataframe of data we want to upload, with columns ordered as in the schema (geopandas dataframe)
+            table: name of the Carto table (string)
+            schema: fields and corresponding data types of the Carto table (dictionary)
+            session: the request session initiated to send requests to Carto
+            user: Carto account name (string)
+            key: Carto API key (string)
+    '''
+    def csv_lines():
+        # format each row as a line of CSV; unquoted empty values are read as NULL
+        for row in gdf.itertuples(index=False, name=None):
+            values = []
+            for value, dtype in zip(row, schema.values()):
+                if value is None or (dtype != 'geometry' and pd.isnull(value)):
+                    values.append('')
+                elif dtype == 'geometry':
+                    values.append(shapely.wkb.dumps(value, hex=True, srid=4326))
+                else:
+                    values.append('"{}"'.format(str(value).replace('"', '""')))
+            yield (','.join(values) + '\n').encode('utf-8')
+
+    sql = 'COPY "{}" ({}) FROM STDIN WITH (FORMAT csv)'.format(table, ', '.join(schema.keys()))
+    for i in range(N_TRIES):
+        try:
+            # stream the rows to the carto API, generating the CSV again on each attempt
+            r = session.post(CARTO_COPY_URL.format(user), params={'api_key': key, 'q': sql}, data=csv_lines())
+            r.raise_for_status()
+        except Exception as e: # if there's an exception do this
+            logging.warning('Attempt #{} to copy {} large geometries unsuccessful. Trying again after {} seconds'.format(i, len(gdf), RETRY_WAIT_TIME))
+            logging.debug('Exception encountered during copy attempt: '+ str(e))
+            if i == N_TRIES - 1:
+                logging.error('Copy of large geometries has failed after {} attempts'.format(N_TRIES))
+                raise
+            time.sleep(RETRY_WAIT_TIME)
+        else: # if no exception do this
+            break
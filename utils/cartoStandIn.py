@@ -0,0 +1,200 @@
+'''
+Local stand-in for the CARTO SQL API, for benchmarking cartoUploads offline
+Serves the SQL endpoint (GET/POST) and the COPY FROM endpoint, counting the
+rows it receives instead of writing them anywhere.
+Example:
+```
+python cartoStandIn.py 100000
+```
+or, from another script:
+```
+import cartoUploads
+from cartoStandIn import StandInServer
+with StandInServer() as server:
+    cartoUploads.CARTO_URL = server.url
+    cartoUploads.copyRows('mytable', fields, dtypes, rows)
+    print(server.stats)
+```
+'''
+from __future__ import print_function
+import json
+import logging
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+# matches the start of each row in an INSERT ... VALUES statement
+VALUES_RE = re.compile(r'(?:VALUES\s*|\),\s*)\(')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    '''Handles SQL API and COPY FROM requests'''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    def _readBody(self):
+        '''Read request body, decoding chunked transfer encoding'''
+        if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+            length = int(self.headers.get('Content-Length') or 0)
+            return [self.rfile.read(length)]
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+            if size == 0:
+                # consume trailer
+                while self.rfile.readline().strip():
+                    pass
+                return chunks
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def _respond(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, sql, nrows, nbytes, copy=False):
+        server = self.server
+        time.sleep(server.latency)
+        with server.lock:
+            server.stats['requests'] += 1
+            server.stats['rows'] += nrows
+            server.stats['bytes'] += nbytes
+            if copy:
+                server.stats['copies'] += 1
+            server.statements.append(sql)
+        self._respond(200, {'rows': [], 'time': server.latency,
+                            'total_rows': nrows})
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        sql = params.get('q', [''])[0]
+        self._handle(sql, 0, len(self.path))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        chunks = self._readBody()
+        nbytes = sum(len(c) for c in chunks)
+        if url.path.endswith('/copyfrom'):
+            sql = parse_qs(url.query).get('q', [''])[0]
+            nrows = sum(c.count(b'\n') for c in chunks)
+            self._handle(sql, nrows, nbytes, copy=True)
+        else:
+            sql = json.loads(b''.join(chunks).decode('utf-8')).get('q', '')
+            nrows = len(VALUES_RE.findall(sql)) if sql.startswith('INSERT') else 0
+            self._handle(sql, nrows, nbytes)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandInServer(object):
+    '''
+    Threaded local server mimicking the CARTO SQL API
+    `latency` seconds to sleep per request, to simulate round trips
+    `url` is a drop-in replacement for cartoUploads.CARTO_URL
+    `stats` counts requests, rows, bytes and COPY requests received
+    '''
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        self.httpd = _ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.latency = latency
+        self.httpd.lock = threading.Lock()
+        self.httpd.statements = []
+        self.httpd.stats = {'requests': 0, 'rows': 0, 'bytes': 0, 'copies': 0}
+        self.url = 'http://{}:{}/{{}}/api/v2/sql'.format(
+            host, self.httpd.server_address[1])
+        self.thread = None
+
+    @property
+    def stats(self):
+        return dict(self.httpd.stats)
+
+    @property
+    def statements(self):
+        return list(self.httpd.statements)
+
+    def reset(self):
+        with self.httpd.lock:
+            for k in self.httpd.stats:
+                self.httpd.stats[k] = 0
+            del self.httpd.statements[:]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def syntheticRows(n):
+    '''Generate `n` rows shaped like a typical point event table'''
+    start = datetime(2020, 1, 1)
+    for i in range(n):
+        yield [
+            'uid_{}'.format(i),
+            {'type': 'Point', 'coordinates': [i % 360 - 180, i % 180 - 90]},
+            (start + timedelta(hours=i)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            "Event #{}, it's \"quoted\"".format(i),
+            i * 0.5,
+        ]
+
+
+def benchmark(n=100000, latency=0.0):
+    '''
+    Time cartoUploads.insertRows against insertRowsConcurrent and copyRows
+    '''
+    import cartoUploads
+    fields = ['uid', 'the_geom', 'datetime', 'notes', 'value']
+    dtypes = ['text', 'geometry', 'timestamp', 'text', 'numeric']
+    results = {}
+    with StandInServer(latency=latency) as server:
+        cartoUploads.CARTO_URL = server.url
+        for name, fn in (('insertRows', cartoUploads.insertRows),
+                         ('concurrent', cartoUploads.insertRowsConcurrent),
+                         ('copyRows', cartoUploads.copyRows)):
+            rows = syntheticRows(n)
+            if name == 'insertRows':
+                rows = list(rows)
+            server.reset()
+            start = time.time()
+            fn('benchmark', fields, dtypes, rows, user='standin', key='')
+            elapsed = time.time() - start
+            results[name] = dict(server.stats, seconds=elapsed)
+            print('{:<12} {:>8} rows {:>5} requests {:>12} bytes {:8.2f} s'.format(
+                name, server.stats['rows'], server.stats['requests'],
+                server.stats['bytes'], elapsed))
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    benchmark(n, latency)
@@ -8,6 +8,14 @@ import cartosql
 r = cartosql.get('select * from mytable', user=CARTO_USER, key=CARTO_KEY)
 data = r.json()
 ```
+All requests share one pooled keep-alive session per process, are retried
+with jittered exponential backoff on 429/5xx responses, and are limited to
+`MAX_CONCURRENT` in-flight requests per CARTO account. INSERT and COPY
+requests are only retried on 429 or when the connection failed before the
+request was sent, so that a retry can't load the same rows twice:
+```
+cartosql.configureSession(pool_size=20, max_concurrent=16)
+```
 Read more at:
 http://carto.com/docs/carto-engine/sql-api/making-calls/
 '''
@@ -17,12 +25,127 @@ import requests
 import os
 import logging
 import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+from urllib3.exceptions import NewConnectionError
 
 CARTO_URL = 'https://{}.carto.com/api/v2/sql'
 CARTO_USER = os.environ.get('CARTO_USER')
 CARTO_KEY = os.environ.get('CARTO_KEY')
 STRICT = True
 
+# connections kept alive in the shared session's pool
+POOL_SIZE = int(os.environ.get('CARTO_POOL_SIZE', 10))
+# maximum requests in flight per CARTO account
+MAX_CONCURRENT = int(os.environ.get('CARTO_MAX_CONCURRENT', 8))
+# retries on rate limiting, server errors and dropped connections
+MAX_RETRIES = 5
+# base wait in seconds; attempt n waits up to BACKOFF_FACTOR * 2**n
+BACKOFF_FACTOR = 1
+MAX_BACKOFF = 60
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# statements that may have been applied when a request fails after being sent
+NON_IDEMPOTENT = ('INSERT', 'COPY')
+# maximum bytes of id literals per id-set statement
+MAX_ID_BYTES = 100000
+
+_session = None
+_limiters = {}
+_lock = threading.Lock()
+
+
+def configureSession(pool_size=None, max_concurrent=None):
+    '''
+    Set connection pool size and per-account concurrency, replacing the
+    shared session so new settings take effect
+    '''
+    global _session, POOL_SIZE, MAX_CONCURRENT
+    with _lock:
+        if pool_size:
+            POOL_SIZE = pool_size
+        if max_concurrent:
+            MAX_CONCURRENT = max_concurrent
+            _limiters.clear()
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def getSession():
+    '''Return the process-wide pooled keep-alive session'''
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def _limiter(user):
+    '''Semaphore bounding concurrent requests for a CARTO account'''
+    with _lock:
+        if user not in _limiters:
+            _limiters[user] = threading.BoundedSemaphore(MAX_CONCURRENT)
+        return _limiters[user]
+
+
+def _backoff(attempt, r=None):
+    '''Seconds to wait before retry `attempt`, honoring Retry-After'''
+    if r is not None and r.headers.get('Retry-After', '').isdigit():
+        return min(MAX_BACKOFF, int(r.headers['Retry-After']))
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF_FACTOR * 2 ** attempt))
+
+
+def _idempotent(sql):
+    '''Whether sql can be sent again without risk of applying it twice'''
+    return not sql.lstrip().upper().startswith(NON_IDEMPOTENT)
+
+
+def _unsent(e):
+    '''Whether a connection error was raised before the request was sent'''
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _request(method, url, user, retries=None, body=None, idempotent=True,
+             **kwargs):
+    '''
+    Send request through the shared session within the account's
+    concurrency limit, retrying 429/5xx responses and connection errors
+    `body` optional callable returning a fresh request body per attempt
+    `idempotent` False to retry only on 429 and on connection errors
+      raised before the request was sent
+    '''
+    retries = MAX_RETRIES if retries is None else retries
+    session = getSession()
+    for attempt in range(retries + 1):
+        if body is not None:
+            kwargs['data'] = body()
+        try:
+            with _limiter(user):
+                r = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= retries or not (idempotent or _unsent(e)):
+                raise
+            wait = _backoff(attempt)
+            logging.warning('{}; retrying in {:.1f}s'.format(e, wait))
+        else:
+            if r.status_code not in RETRY_STATUSES or attempt >= retries \
+                    or not (idempotent or r.status_code == 429):
+                return r
+            wait = _backoff(attempt, r)
+            logging.warning('Status {}; retrying in {:.1f}s'.format(
+                r.status_code, wait))
+        time.sleep(wait)
+
 def sendSql(sql, user=CARTO_USER, key=CARTO_KEY, f='', post=True):
     '''Send arbitrary sql and return response object or False'''
     url = CARTO_URL.format(user)
@@ -34,9 +157,10 @@ def sendSql(sql, user=CARTO_USER, key=CARTO_KEY, f='', post=True):
         payload['format'] = f
     logging.debug((url, payload))
     if post:
-        r = requests.post(url, json=payload)
+        r = _request('POST', url, user, idempotent=_idempotent(sql),
+                     json=payload)
     else:
-        r = requests.get(url, params=payload)
+        r = _request('GET', url, user, params=payload)
     if not r.ok:
         logging.error(r.text)
         if STRICT:
@@ -160,6 +284,16 @@ def _insertRows(table, fields, dtypes, rows, user=CARTO_USER, key=CARTO_KEY):
     return post(sql, user, key)
 
 
+def _blocks(rows, blocksize):
+    '''Yield successive lists of `blocksize` rows from any iterable'''
+    rows = iter(rows)
+    while True:
+        block = list(islice(rows, blocksize))
+        if not block:
+            return
+        yield block
+
+
 def insertRows(table, fields, dtypes, rows, user=CARTO_USER,
                key=CARTO_KEY, blocksize=1000):
     '''
@@ -170,29 +304,279 @@ def insertRows(table, fields, dtypes, rows, user=CARTO_USER,
     Automatically breaks into multiple requests at `blocksize` rows
     '''
     # iterate in blocks
-    while len(rows):
-        if not _insertRows(table, fields, dtypes, rows[:blocksize], user, key):
+    for block in _blocks(rows, blocksize):
+        if not _insertRows(table, fields, dtypes, block, user, key):
             return False
-        rows = rows[blocksize:]
     return True
 
+
+def _runBlock(index, fn, block, *args):
+    '''Send one block, returning its result summary instead of raising'''
+    result = {'block': index, 'rows': len(block), 'ok': False, 'error': None}
+    try:
+        result['ok'] = bool(fn(block, *args))
+        if not result['ok']:
+            result['error'] = 'request failed'
+    except Exception as e:
+        result['error'] = str(e)
+    if result['error']:
+        logging.error('Block {} ({} rows) failed: {}'.format(
+            index, len(block), result['error']))
+    return result
+
+
+def _runBlocks(fn, blocks, workers, *args):
+    '''
+    Call fn(block, *args) for each block keeping up to `workers` in flight
+    Return list of per-block results ordered by block
+    '''
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for i, block in enumerate(blocks):
+            if len(pending) >= workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                results.extend(f.result() for f in done)
+            pending.add(executor.submit(_runBlock, i, fn, block, *args))
+        results.extend(f.result() for f in wait(pending)[0])
+    results.sort(key=lambda r: r['block'])
+    failed = [r['block'] for r in results if not r['ok']]
+    if failed:
+        logging.error('{} of {} blocks failed: {}'.format(
+            len(failed), len(results), failed))
+    return results
+
+
+def insertRowsConcurrent(table, fields, dtypes, rows, user=CARTO_USER,
+                         key=CARTO_KEY, blocksize=1000, workers=None):
+    '''
+    Insert rows into table keeping up to `workers` blocks in flight
+    `rows` any iterable of lists containing the data to be inserted,
+      consumed lazily so at most `workers` blocks are held in memory
+    `fields` field names for the columns in `rows`
+    `dtypes` field types for the columns in `rows`
+    `workers` defaults to MAX_CONCURRENT
+    Failed blocks don't stop the others
+    Return list of per-block results ordered by block, each a dict of
+      block index, rows, ok and error message
+    '''
+    def insert(block):
+        return _insertRows(table, fields, dtypes, block, user, key)
+    return _runBlocks(insert, _blocks(rows, blocksize),
+                      workers or MAX_CONCURRENT)
+
 # Alias insertRows
 blockInsertRows = insertRows
 
 
+def _geojsonCoords(coords, depth):
+    '''Format nested GeoJSON coordinates as WKT coordinate text'''
+    if depth == 0:
+        return ' '.join(str(c) for c in coords)
+    return ','.join(
+        '({})'.format(_geojsonCoords(c, depth - 1)) if depth > 1
+        else _geojsonCoords(c, 0)
+        for c in coords)
+
+
+_GEOJSON_DEPTHS = {
+    'Point': 0,
+    'MultiPoint': 1,
+    'LineString': 1,
+    'MultiLineString': 2,
+    'Polygon': 2,
+    'MultiPolygon': 3,
+}
+
+
+def _geojsonToWKT(geom):
+    '''Convert GeoJSON geometry obj to WKT'''
+    gtype = geom['type']
+    if gtype == 'GeometryCollection':
+        return 'GEOMETRYCOLLECTION({})'.format(
+            ','.join(_geojsonToWKT(g) for g in geom['geometries']))
+    depth = _GEOJSON_DEPTHS[gtype]
+    if not geom['coordinates']:
+        return '{} EMPTY'.format(gtype.upper())
+    return '{}({})'.format(gtype.upper(),
+                           _geojsonCoords(geom['coordinates'], depth))
+
+
+def _copyValue(value, dtype):
+    '''
+    Format value for a CSV COPY stream based on field type
+    TYPE         Formatted
+    None      -> empty, unquoted (NULL)
+    geometry  -> string as is (WKT, EWKT or hex WKB);
+                 obj converted from GeoJSON to EWKT
+    else      -> double quoted, quotes doubled
+    '''
+    if value is None:
+        return ''
+    if dtype == 'geometry' and not isinstance(value, str):
+        value = 'SRID=4326;{}'.format(_geojsonToWKT(value))
+    return '"{}"'.format(str(value).replace('"', '""'))
+
+
+def _dumpCsv(rows, dtypes, blocksize=1000):
+    '''
+    Generator that escapes rows of data to CSV lines
+    Yields utf-8 encoded chunks of `blocksize` rows so the full
+    payload is never held in memory
+    '''
+    lines = []
+    for row in rows:
+        lines.append(','.join(
+            _copyValue(row[i], dtypes[i])
+            for i in range(len(dtypes))))
+        if len(lines) >= blocksize:
+            lines.append('')
+            yield '\n'.join(lines).encode('utf-8')
+            lines = []
+    if lines:
+        lines.append('')
+        yield '\n'.join(lines).encode('utf-8')
+
+
+def copyRows(table, fields, dtypes, rows, user=CARTO_USER, key=CARTO_KEY,
+             blocksize=1000):
+    '''
+    Bulk load rows into table via the COPY FROM endpoint
+    `rows` any iterable of lists containing the data to be inserted,
+      may be a generator
+    `fields` field names for the columns in `rows`
+    `dtypes` field types for the columns in `rows`
+    Rows are streamed as CSV in a single request; geometry strings must be
+    WKT, EWKT or hex WKB rather than SQL expressions
+    Only list or tuple `rows` are retried, since a generator can't be
+    replayed, and only on 429 or connections that failed before sending
+    Return response object or False
+    '''
+    url = '{}/copyfrom'.format(CARTO_URL.format(user))
+    sql = 'COPY "{}" ({}) FROM STDIN WITH (FORMAT csv, HEADER false)'.format(
+        table, ', '.join(fields))
+    params = {
+        'api_key': key,
+        'q': sql,
+    }
+    logging.debug((url, sql))
+    retries = None if isinstance(rows, (list, tuple)) else 0
+    r = _request('POST', url, user, retries=retries, idempotent=False,
+                 params=params,
+                 body=lambda: _dumpCsv(rows, tuple(dtypes), blocksize),
+                 headers={'Content-Type': 'application/octet-stream'})
+    if not r.ok:
+        logging.error(r.text)
+        if STRICT:
+            raise Exception(r.text)
+        return False
+    return r
+
+
 def deleteRows(table, where, user=CARTO_USER, key=CARTO_KEY):
     '''Delete rows from table'''
     sql = 'DELETE FROM "{}" WHERE {}'.format(table, where)
-    return post(sql)
+    return post(sql, user, key)
+
+
+def _idChunks(ids, dtype='', max_bytes=None):
+    '''
+    Yield lists of SQL literals for `ids` whose joined length stays under
+    `max_bytes`; ids are escaped by `dtype` if given, else used as is
+    '''
+    max_bytes = max_bytes or MAX_ID_BYTES
+    chunk = []
+    size = 0
+    for i in ids:
+        literal = _escapeValue(i, dtype) if dtype else str(i)
+        if chunk and size + len(literal) + 1 > max_bytes:
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(literal)
+        size += len(literal) + 1
+    if chunk:
+        yield chunk
+
+
+def _anyWhere(id_field, literals):
+    '''WHERE clause matching `id_field` against an array of literals'''
+    return '{} = ANY(ARRAY[{}])'.format(id_field, ','.join(literals))
+
+
+def _mapIDChunks(fn, ids, dtype, max_bytes, workers):
+    '''Call fn(where) for each id chunk concurrently, in chunk order'''
+    workers = workers or MAX_CONCURRENT
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fn, _idChunks(ids, dtype, max_bytes)))
 
 
 def deleteRowsByIDs(table, ids, id_field='cartodb_id', dtype='',
-                    user=CARTO_USER, key=CARTO_KEY):
-    '''Delete rows from table by IDs'''
-    if dtype:
-        ids = [_escapeValue(i, dtype) for i in ids]
-    where = '{} in ({})'.format(id_field, ','.join(ids))
-    return deleteRows(table, where, user, key)
+                    user=CARTO_USER, key=CARTO_KEY, max_bytes=None,
+                    workers=None):
+    '''
+    Delete rows from table by IDs
+    `ids` are escaped by `dtype` if given, else must already be SQL literals
+    Sends one `= ANY(ARRAY[...])` statement per `max_bytes` of ids,
+    up to `workers` at a time
+    Return list of response objects, one per chunk, as getRowsByIDs
+    '''
+    def delete(literals):
+        return deleteRows(table, _anyWhere(id_field, literals), user, key)
+    return _mapIDChunks(delete, ids, dtype, max_bytes, workers)
+
+
+def deleteRowsByIDsCount(table, ids, id_field='cartodb_id', dtype='',
+                         user=CARTO_USER, key=CARTO_KEY, max_bytes=None,
+                         workers=None):
+    '''
+    Delete rows from table by IDs, as deleteRowsByIDs
+    Return number of rows deleted, across all chunks
+    '''
+    responses = deleteRowsByIDs(table, ids, id_field, dtype, user, key,
+                                max_bytes, workers)
+    return sum(r.json().get('total_rows', 0) for r in responses if r)
+
+
+def getRowsByIDs(table, ids, fields='*', id_field='cartodb_id', dtype='',
+                 user=CARTO_USER, key=CARTO_KEY, f='', max_bytes=None,
+                 workers=None):
+    '''
+    Select fields from table by IDs
+    `ids` are escaped by `dtype` if given, else must already be SQL literals
+    Sends one `= ANY(ARRAY[...])` query per `max_bytes` of ids,
+    up to `workers` at a time
+    Return list of response objects, one per chunk
+    '''
+    def select(literals):
+        return getFields(fields, table, where=_anyWhere(id_field, literals),
+                         user=user, key=key, f=f, post=True)
+    return _mapIDChunks(select, ids, dtype, max_bytes, workers)
+
+
+def _upsertRows(table, fields, dtypes, rows, id_field, user=CARTO_USER,
+                key=CARTO_KEY):
+    values = _dumpRows(rows, tuple(dtypes))
+    updates = ['{0} = EXCLUDED.{0}'.format(f) for f in fields if f != id_field]
+    sql = 'INSERT INTO "{}" ({}) VALUES {} ON CONFLICT ({}) DO {}'.format(
+        table, ', '.join(fields), values, id_field,
+        'UPDATE SET {}'.format(', '.join(updates)) if updates else 'NOTHING')
+    return post(sql, user, key)
+
+
+def upsertRows(table, fields, dtypes, rows, id_field, user=CARTO_USER,
+               key=CARTO_KEY, blocksize=1000, workers=None):
+    '''
+    Insert rows into table, updating rows whose `id_field` already exists
+    `id_field` must have a unique index, e.g. from createIndex(unique=True)
+    `rows` any iterable of lists containing the data to be upserted
+    Blocks of `blocksize` rows are sent up to `workers` at a time
+    Return list of per-block results ordered by block
+    '''
+    def upsert(block):
+        return _upsertRows(table, fields, dtypes, block, id_field, user, key)
+    return _runBlocks(upsert, _blocks(rows, blocksize),
+                      workers or MAX_CONCURRENT)
 
 
 def dropTable(table, user=CARTO_USER, key=CARTO_KEY):
@@ -0,0 +1,127 @@
+'''
+Crosswalk from World Bank country names to ISO3 codes to Resource Watch country names
+Example:
+```
+from countryCrosswalk import CountryCrosswalk
+crosswalk = CountryCrosswalk.load('cache/country_crosswalk.json', carto_user=CARTO_USER)
+df['country_code'] = crosswalk.addIso(df['country_name'])
+df = crosswalk.enrich(df, 'country_code')
+```
+The World Bank names come from WB_name_to_ISO3.csv and the Resource Watch
+names from the wri_countries_a table on Carto. Both are fetched once and
+kept in a local JSON file, which is reused until it is older than `ttl`
+seconds. If they cannot be fetched, an expired copy is used instead.
+
+Connectors build their Docker images from their own folder, so copy this
+file next to the connector's scripts to use it, and mount the cache
+folder as a volume so it survives between runs.
+'''
+import json
+import logging
+import os
+import time
+
+import pandas as pd
+import requests
+
+# sheet with World Bank name to ISO3 conversions
+WB_NAME_TO_ISO3_URL = 'https://raw.githubusercontent.com/resource-watch/nrt-scripts/master/upload_worldbank_data/WB_name_to_ISO3.csv'
+# table of standard Resource Watch country names and ISO codes
+RW_COUNTRIES_SQL = 'SELECT iso_a3, name FROM wri_countries_a'
+CARTO_URL = 'https://{}.carto.com/api/v2/sql'
+# seconds to reuse the cached crosswalk before fetching it again
+CACHE_TTL = 7 * 24 * 3600
+TIMEOUT = 60
+
+
+def fetchWbNames(url=WB_NAME_TO_ISO3_URL):
+    '''Fetch the World Bank name to ISO3 code lookup'''
+    wb_names = pd.read_csv(url)
+    return dict(zip(wb_names['WB_name'], wb_names['ISO']))
+
+
+def fetchRwNames(carto_user):
+    '''Fetch the ISO3 code to Resource Watch name lookup, keeping the first name listed for each code'''
+    r = requests.get(CARTO_URL.format(carto_user), params={'q': RW_COUNTRIES_SQL}, timeout=TIMEOUT)
+    r.raise_for_status()
+    rw_names = {}
+    for row in r.json()['rows']:
+        rw_names.setdefault(row['iso_a3'], row['name'])
+    return rw_names
+
+
+class CountryCrosswalk(object):
+    '''
+    Lookups from World Bank country name to ISO3 code (`wb_name_to_iso3`)
+    and from ISO3 code to Resource Watch country name (`rw_country_names`)
+    The add* methods take a pandas Series and return a Series of the same
+    length, with NaN where there is no match
+    '''
+    def __init__(self, wb_name_to_iso3, rw_country_names):
+        self.wb_name_to_iso3 = wb_name_to_iso3
+        self.rw_country_names = rw_country_names
+        self.rw_country_codes = list(rw_country_names)
+
+    @classmethod
+    def fetch(cls, carto_user, wb_names_url=WB_NAME_TO_ISO3_URL):
+        '''Build the crosswalk from its sources'''
+        return cls(fetchWbNames(wb_names_url), fetchRwNames(carto_user))
+
+    @classmethod
+    def load(cls, cache_path, carto_user, ttl=CACHE_TTL, wb_names_url=WB_NAME_TO_ISO3_URL):
+        '''
+        Load the crosswalk saved in `cache_path`, fetching and saving it
+        again if it is missing or older than `ttl` seconds
+        '''
+        cached = None
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            pass
+        if cached and time.time() - cached['created'] < ttl:
+            return cls(cached['wb_name_to_iso3'], cached['rw_country_names'])
+        try:
+            crosswalk = cls.fetch(carto_user, wb_names_url)
+        except Exception as e:
+            if not cached:
+                raise
+            logging.warning('Unable to refresh country crosswalk, using copy from {}: {}'.format(
+                time.ctime(cached['created']), e))
+            return cls(cached['wb_name_to_iso3'], cached['rw_country_names'])
+        crosswalk.save(cache_path)
+        return crosswalk
+
+    def save(self, cache_path):
+        '''Write the crosswalk to `cache_path` atomically'''
+        if os.path.dirname(cache_path):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp = cache_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'created': time.time(),
+                       'wb_name_to_iso3': self.wb_name_to_iso3,
+                       'rw_country_names': self.rw_country_names}, f)
+        os.replace(tmp, cache_path)
+
+    def addIso(self, names):
+        '''ISO3 code for each World Bank country name'''
+        return names.map(self.wb_name_to_iso3)
+
+    def addRwName(self, codes):
+        '''Resource Watch country name for each ISO3 code'''
+        return codes.map(self.rw_country_names)
+
+    def addRwCode(self, codes):
+        '''ISO3 code where it is one of the Resource Watch codes'''
+        return codes.where(codes.isin(self.rw_country_codes))
+
+    def enrich(self, df, code_column='country_code'):
+        '''
+        Return a copy of `df` with rw_country_name and rw_country_code
+        columns for the ISO3 codes in `code_column`, None where unmatched
+        '''
+        codes = df[code_column]
+        rw_name = self.addRwName(codes).astype(object)
+        rw_code = self.addRwCode(codes).astype(object)
+        return df.assign(rw_country_name=rw_name.where(rw_name.notnull(), None),
+                         rw_country_code=rw_code.where(rw_code.notnull(), None))
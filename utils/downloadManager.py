@@ -0,0 +1,303 @@
+'''
+Concurrent file downloader with a persistent content-addressed cache
+Example:
+```
+from downloadManager import DownloadManager
+downloads = DownloadManager('cache', workers=8)
+files = downloads.fetchAll([(url, 'data/' + url.split('/')[-1]) for url in urls])
+```
+Each file is downloaded once into `cache_dir/objects/<sha256>` and linked
+to its destination. Later requests for a cached url are conditional
+(If-None-Match / If-Modified-Since), so an unchanged file costs a 304
+instead of a download; with `revalidate=False` no request is made at all.
+Interrupted downloads are kept in `cache_dir/partial` and resumed with a
+Range request on the next attempt or run. Sizes are checked against
+Content-Length, and against a sha256 digest when one is given.
+
+Connectors build their Docker images from their own folder, so copy this
+file next to the connector's `__init__.py` to use it, and mount the cache
+folder as a volume so it survives between runs.
+'''
+from __future__ import unicode_literals
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# files downloaded at once
+WORKERS = 8
+# retries on server errors and dropped connections
+MAX_RETRIES = 5
+# base wait in seconds; attempt n waits up to BACKOFF_FACTOR * 2**n
+BACKOFF_FACTOR = 2
+MAX_BACKOFF = 120
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# seconds to wait for the server to respond or send more data
+TIMEOUT = 60
+CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadError(Exception):
+    '''Raised when one or more files could not be downloaded'''
+    def __init__(self, failures):
+        self.failures = failures
+        super(DownloadError, self).__init__('Unable to retrieve {} file(s): {}'.format(
+            len(failures), ', '.join(sorted(failures))))
+
+
+def _sha256(path):
+    '''Hash an existing file'''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h
+
+
+def _link(src, dst):
+    '''Hard link `src` to `dst`, falling back to a symlink across filesystems'''
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        os.symlink(os.path.abspath(src), dst)
+
+
+class DownloadManager(object):
+    '''
+    Downloads urls concurrently through a pooled session, keeping every
+    file in a content-addressed cache in `cache_dir`
+    `revalidate` send conditional requests for cached urls; set False for
+    files that never change once published
+    '''
+    def __init__(self, cache_dir='cache', workers=WORKERS, retries=MAX_RETRIES,
+                 timeout=TIMEOUT, revalidate=True):
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.retries = retries
+        self.timeout = timeout
+        self.revalidate = revalidate
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.partial_dir = os.path.join(cache_dir, 'partial')
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        for d in (self.objects_dir, self.partial_dir):
+            os.makedirs(d, exist_ok=True)
+        self.index = self._loadIndex()
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.stats = {'downloaded': 0, 'resumed': 0, 'not_modified': 0,
+                      'cached': 0, 'bytes': 0}
+
+    def _loadIndex(self):
+        '''Read the url index, dropping entries whose object is missing'''
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        return {url: entry for url, entry in index.items()
+                if os.path.exists(self._objectPath(entry['sha256']))}
+
+    def _saveIndex(self):
+        '''Write the url index atomically'''
+        with self.lock:
+            data = json.dumps(self.index)
+        tmp = '{}.{}.tmp'.format(self.index_path, threading.get_ident())
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, self.index_path)
+
+    def _count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def _objectPath(self, digest):
+        return os.path.join(self.objects_dir, digest)
+
+    def _partialPath(self, url):
+        return os.path.join(self.partial_dir, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def _backoff(self, attempt, r=None):
+        '''Seconds to wait before retry `attempt`, honoring Retry-After'''
+        if r is not None and r.headers.get('Retry-After', '').isdigit():
+            return int(r.headers['Retry-After'])
+        return random.uniform(0, min(MAX_BACKOFF, BACKOFF_FACTOR * 2 ** attempt))
+
+    def _get(self, url, entry, part):
+        '''
+        Send one GET for `url`, conditional on the cached `entry` and
+        resuming from the `part` file if it holds a partial download
+        Returns the cache entry for the url, or raises
+        '''
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        # only resume partial downloads that can be checked against the current
+        # version of the file, so that old and new bytes are never mixed
+        validator = None
+        if os.path.exists(part) and os.path.exists(part + '.json'):
+            with open(part + '.json') as f:
+                validator = json.load(f).get('validator')
+        offset = os.path.getsize(part) if validator else 0
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            headers['If-Range'] = validator
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+            if r.status_code == 304 and entry:
+                self._count('not_modified')
+                return entry
+            if r.status_code == 416:
+                # the partial file is no longer valid, start over
+                os.remove(part)
+                raise IOError('Cannot resume download of {}'.format(url))
+            r.raise_for_status()
+            if r.status_code == 206:
+                h = _sha256(part)
+                mode = 'ab'
+                self._count('resumed')
+            else:
+                h = hashlib.sha256()
+                mode = 'wb'
+                offset = 0
+            etag = r.headers.get('ETag')
+            last_modified = r.headers.get('Last-Modified')
+            # remember how to validate a resumed download of this partial file
+            with open(part + '.json', 'w') as f:
+                json.dump({'validator': etag or last_modified}, f)
+            expected = None
+            if 'Content-Length' in r.headers and 'Content-Encoding' not in r.headers:
+                expected = offset + int(r.headers['Content-Length'])
+            with open(part, mode) as f:
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+                    h.update(chunk)
+                    self._count('bytes', len(chunk))
+        size = os.path.getsize(part)
+        if expected is not None and size != expected:
+            raise IOError('Incomplete download of {}: {} of {} bytes'.format(url, size, expected))
+        self._count('downloaded')
+        return {'sha256': h.hexdigest(), 'size': size,
+                'etag': etag, 'last_modified': last_modified}
+
+    def fetch(self, url, dest=None, sha256=None):
+        '''
+        Download `url` into the cache, link it to `dest` and return the
+        path of the file; `sha256` optional expected hex digest
+        '''
+        part = self._partialPath(url)
+        with self.lock:
+            entry = self.index.get(url)
+        if entry and not self.revalidate and (sha256 is None or entry['sha256'] == sha256):
+            self._count('cached')
+        else:
+            for attempt in range(self.retries + 1):
+                try:
+                    new_entry = self._get(url, entry, part)
+                    if sha256 and new_entry['sha256'] != sha256:
+                        # the partial file is corrupt, start over
+                        os.remove(part)
+                        raise IOError('Checksum mismatch for {}'.format(url))
+                    break
+                except (requests.ConnectionError, requests.Timeout, IOError) as e:
+                    r = getattr(e, 'response', None)
+                    if attempt >= self.retries or (
+                            r is not None and r.status_code not in RETRY_STATUSES):
+                        raise
+                    wait = self._backoff(attempt, r)
+                    logging.warning('{}; retrying in {:.1f}s'.format(e, wait))
+                    time.sleep(wait)
+            if new_entry is not entry:
+                obj = self._objectPath(new_entry['sha256'])
+                if os.path.exists(obj):
+                    os.remove(part)
+                else:
+                    os.replace(part, obj)
+                if os.path.exists(part + '.json'):
+                    os.remove(part + '.json')
+                entry = new_entry
+                with self.lock:
+                    self.index[url] = dict(entry, accessed=time.time())
+                self._saveIndex()
+        with self.lock:
+            self.index[url]['accessed'] = time.time()
+        obj = self._objectPath(entry['sha256'])
+        if os.path.getsize(obj) != entry['size']:
+            raise IOError('Cached copy of {} is corrupt'.format(url))
+        if dest is None:
+            return obj
+        _link(obj, dest)
+        return dest
+
+    def fetchAll(self, jobs, workers=None):
+        '''
+        Download (url, dest) or (url, dest, sha256) jobs concurrently
+        Returns the paths in the order of `jobs`; raises DownloadError
+        naming every url that failed once all jobs have finished
+        '''
+        jobs = [tuple(job) for job in jobs]
+        failures = {}
+
+        def run(job):
+            try:
+                return self.fetch(*job)
+            except Exception as e:
+                logging.error('Unable to retrieve data from {}: {}'.format(job[0], e))
+                failures[job[0]] = e
+
+        with ThreadPoolExecutor(max_workers=workers or self.workers) as pool:
+            paths = list(pool.map(run, jobs))
+        self._saveIndex()
+        logging.info('Downloads: {}'.format(self.stats))
+        if failures:
+            raise DownloadError(failures)
+        return paths
+
+    def forget(self, urls):
+        '''
+        Remove `urls` from the cache once they are no longer needed, along
+        with their files unless another cached url has the same contents
+        '''
+        with self.lock:
+            digests = set(self.index.pop(url)['sha256'] for url in urls if url in self.index)
+            keep = set(entry['sha256'] for entry in self.index.values())
+        for digest in digests - keep:
+            if os.path.exists(self._objectPath(digest)):
+                os.remove(self._objectPath(digest))
+        self._saveIndex()
+        return len(digests)
+
+    def prune(self, max_age):
+        '''
+        Remove cached files that have not been requested for `max_age`
+        seconds, along with abandoned partial downloads
+        '''
+        cutoff = time.time() - max_age
+        with self.lock:
+            stale = [url for url, entry in self.index.items()
+                     if entry.get('accessed', 0) < cutoff]
+            for url in stale:
+                del self.index[url]
+            keep = set(entry['sha256'] for entry in self.index.values())
+        for digest in os.listdir(self.objects_dir):
+            if digest not in keep:
+                os.remove(self._objectPath(digest))
+        for name in os.listdir(self.partial_dir):
+            path = os.path.join(self.partial_dir, name)
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        self._saveIndex()
+        return len(stale)
@@ -1,14 +1,19 @@
 import ee
-import time
-from datetime import datetime
 from google.cloud import storage 
 import os
+import base64
+import calendar
+import logging
+import google_crc32c
 import rasterio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .geeTaskScheduler import TaskScheduler, TASK_FINISHED_STATES, TIMEOUT_ABANDON
 
-
-TASK_FINISHED_STATES = (ee.batch.Task.State.COMPLETED,
-                        ee.batch.Task.State.FAILED,
-                        ee.batch.Task.State.CANCELLED)
+# files read or uploaded to GCS at once
+UPLOAD_WORKERS = 8
+# files are uploaded to GCS in resumable chunks of this many bytes (a multiple of 256 KB)
+CHUNK_SIZE = 8 * 1024 * 1024
 
 
 class getJsonEnv():
@@ -27,6 +32,121 @@ class getJsonEnv():
     
 
 
+def readHeader(image):
+    """Reads the metadata of an image without reading its data"""
+    with rasterio.open(image) as src:
+        return {'dtype': src.meta['dtype'], 'driver': src.meta['driver'], 'nodata': src.meta['nodata'],
+                'nBands': src.meta['count'], 'crs': src.crs.to_string()}
+
+
+def checkHeaders(images, nBands=None, compatible=True, workers=UPLOAD_WORKERS):
+    """
+    Checks the images are GeoTIFFs, reading their headers side by side
+    compatible: also check they can be composed into one image of the image collection
+    Returns the metadata of the first image
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        metadata = list(pool.map(readHeader, images))
+    for image, item in zip(images, metadata):
+        assert item['driver'] == 'GTiff', "Driver is not supported: {0}".format(item['driver'])
+        if nBands is not None:
+            assert item['nBands'] == nBands, "Nbands incorrect in {0}, expected: {1}, {2} provided".format(image, nBands, item['nBands'])
+    for key in ('dtype', 'driver', 'nodata', 'nBands', 'crs') if compatible else ():
+        values = set(item[key] for item in metadata)
+        assert len(values) == 1, "Images list {0} values aren't compatibles. Expected: 1, {1} provided".format(key, len(values))
+    return metadata[0]
+
+
+def crc32c(path):
+    """Base64 encoded CRC32C checksum of a file, as GCS reports it for blobs"""
+    checksum = google_crc32c.Checksum()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode('utf-8')
+
+
+def stageFile(bucket, source, blobName, public=True):
+    """
+    Uploads a file to GCS in resumable chunks, unless a blob with the same size and CRC32C is already there
+    Returns the gs:// uri of the blob
+    """
+    blob = bucket.get_blob(blobName)
+    if blob is not None and blob.size == os.path.getsize(source) and blob.crc32c == crc32c(source):
+        logging.info('{0} is already on GCS, skipping upload'.format(blobName))
+    else:
+        blob = bucket.blob(blobName, chunk_size=CHUNK_SIZE)
+        blob.upload_from_filename(source)
+        logging.info('Uploaded {0} to GCS'.format(blobName))
+    if public:
+        blob.make_public()
+    return 'gs://{0}/{1}'.format(bucket.name, blobName)
+
+
+def threadBucket(bucket, local):
+    """
+    The same bucket through a storage client of the calling thread's own, as a client's
+    HTTP session is not safe to share between threads. Clients are kept in `local`
+    """
+    buckets = local.__dict__.setdefault('buckets', {})
+    key = (id(bucket.client), bucket.name)
+    if key not in buckets:
+        client = storage.Client(project=bucket.client.project, credentials=bucket.client._credentials)
+        buckets[key] = client.bucket(bucket.name)
+    return buckets[key]
+
+
+def stageFiles(jobs, workers=UPLOAD_WORKERS):
+    """
+    Uploads (bucket, source, blobName) jobs to GCS side by side, each worker
+    with its own storage client for the bucket
+    Returns the gs:// uris, in the order of the jobs
+    """
+    local = threading.local()
+    def stage(bucket, source, blobName, public=True):
+        return stageFile(threadBucket(bucket, local), source, blobName, public)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda job: stage(*job), jobs))
+
+
+def ingestAssets(bucket, files, assets, dates, gcsPrefix, scheduler=None, clean=True, workers=UPLOAD_WORKERS):
+    """
+    Uploads files to GEE assets in a single pass: the files are staged on GCS side by side,
+    then all of their ingestions are run together by the scheduler
+    bucket: GCS bucket to stage the files in
+    assets: full GEE asset ids, one for each file
+    dates: datetime for each file, set as the start time of its asset
+    clean: remove the staged files from GCS once they have been ingested; the files of failed
+           ingestions are kept so that trying again does not upload them again
+    Returns the ScheduledTask for each asset
+    """
+    scheduler = scheduler or TaskScheduler()
+    checkHeaders(files, compatible=False, workers=workers)
+    blobNames = ['{0}/{1}'.format(gcsPrefix, os.path.basename(f)) for f in files]
+    uris = stageFiles([(bucket, f, blobName, False) for f, blobName in zip(files, blobNames)], workers)
+    tasks = []
+    for uri, asset, date in zip(uris, assets, dates):
+        request = {
+            'id': asset.lstrip('/'),
+            'properties': {'system:time_start': calendar.timegm(date.utctimetuple()) * 1000},
+            'tilesets': [{'sources': [{'primaryPath': uri}]}],
+        }
+        tasks.append(scheduler.submit(lambda request=request: startIngestion(request), name=asset))
+    scheduler.run()
+    if clean:
+        for blobName, task in zip(blobNames, tasks):
+            if task.succeeded:
+                bucket.delete_blob(blobName)
+    return tasks
+
+
+def startIngestion(request):
+    """Starts the ingestion of an image from GCS into GEE, returning its task id"""
+    task_id = ee.data.newTaskId()[0]
+    ee.data.startIngestion(task_id, request, True)
+    return task_id
+
+
 class assetManagement(object):
     ## Connects to bucket, upload the image and once it is ready transfers it to GEE associated collection.
     """ 
@@ -57,22 +177,7 @@ class assetManagement(object):
     
     def checksImages(self):
         """Checks the images that we will compose have the same n bands as they are going to become one image and part of the image collection"""
-        metadata=[]
-        for image in self.meta['sources']:
-            with rasterio.open(image) as src:
-                metaData=src.meta
-                
-                assert metaData['driver'] == 'GTiff', "Driver is not supported: {0}".format(metaData['driver'])
-                assert metaData['count'] == len(self.meta['bandNames']), "Nbands incorrect, expected: {0}, {1} provided".format(metaData['count'],len(self.meta['bandNames']))
-                
-                metadata.append({'dtype': metaData['dtype'], 'driver': metaData['driver'], 'nodata': metaData['nodata'], 'nBands': metaData['count'],'crs': src.crs.to_string()})
-        
-        assert len(set([item['dtype'] for item in metadata])) == 1, "Images list dtypes aren't compatibles. Expected: 1, {1} provided".format(metaData['count'],len(set([item['dtype'] for item in metadata])))
-        assert len(set([item['driver'] for item in metadata])) == 1, "Images list drivers aren't compatibles. Expected: 1, 1 provided".format(metaData['count'],len(set([item['driver'] for item in metadata])))
-        assert len(set([item['nodata'] for item in metadata])) == 1, "Images list nodata values aren't compatibles. Expected: 1, {1} provided".format(metaData['count'],len(set([item['nodata'] for item in metadata])))
-        assert len(set([item['nBands'] for item in metadata])) == 1, "Images list nBands number aren't compatibles. Expected: 1, {1} provided".format(metaData['count'],len(set([item['nBands'] for item in metadata])))
-        assert len(set([item['crs'] for item in metadata])) == 1, "Images list crs aren't compatibles. Expected: 1, {1} provided".format(metaData['count'],len(set([item['crs'] for item in metadata])))       
-        return metadata[0]
+        return checkHeaders(self.meta['sources'], len(self.meta['bandNames']))
                     
     
     def setUpCredentials(self):
@@ -93,14 +198,14 @@ class assetManagement(object):
             ee.data.setAssetAcl(self.meta['collectionAsset'],aclSet)
        
     
-    def uploadGCS(self, imageName):
-        """Upload the image to google cloud storage"""
+    def stageJob(self, imageName):
+        """The (bucket, source, blobName) job to upload the image to google cloud storage"""
         imageIndex = self.imageNames.index(imageName)
-        blob = self.gcsBucket.blob('{0}/{1}'.format(self.meta['collectionAsset'],imageName))
-        blob.upload_from_filename(self.meta['sources'][imageIndex])
-        blob.make_public()
-        
-        return {'primaryPath': 'gs://{gcsBucket}/{collectionName}/{imageNa}'.format(gcsBucket=self.meta['gcsBucket'],collectionName=self.meta['collectionAsset'],imageNa=imageName)}
+        return (self.gcsBucket, self.meta['sources'][imageIndex], '{0}/{1}'.format(self.meta['collectionAsset'], imageName))
+
+    def uploadGCS(self, imageName):
+        """Upload the image to google cloud storage, unless it is already there"""
+        return {'primaryPath': stageFile(*self.stageJob(imageName))}
         
     def transferGEE(self):
         """Transfers the images from google cloud storage to gee asset"""
@@ -120,31 +225,26 @@ class assetManagement(object):
         return task_id
     
     def taskStatus(self, task_id, timeout=90, log_progress=True):
-        """Waits for the specified task to finish, or a timeout to occur. (thanks to gee cli)"""
-        start = time.time()
-        elapsed = 0
-        last_check = 0
-        while True:
-            elapsed = time.time() - start
-            status = ee.data.getTaskStatus(task_id)[0]
-            state = status['state']
-            if state in TASK_FINISHED_STATES:
-              error_message = status.get('error_message', None)
-              print('Task %s ended at state: %s after %.2f seconds'
-                    % (task_id, state, elapsed))
-              if error_message:
-                raise ValueError(error_message)
-              return
-            if log_progress and elapsed - last_check >= 30:
-              print('[{:%H:%M:%S}] Current state for task {}: {}'
-                    .format(datetime.now(), task_id, state))
-              last_check = elapsed
-            remaining = timeout - elapsed
-            if remaining > 0:
-              time.sleep(min(10, remaining))
-            else:
-              break
-        print('Wait for task %s timed out after %.2f seconds' % (task_id, elapsed))
+        """Waits for the specified task to finish, or a timeout to occur."""
+        scheduler = TaskScheduler(timeout=timeout, on_timeout=TIMEOUT_ABANDON)
+        task = scheduler.watch(task_id)
+        scheduler.run()
+        print('Task %s ended at state: %s after %.2f seconds'
+              % (task_id, task.state, task.elapsed))
+        if task.state in TASK_FINISHED_STATES and task.error_message:
+            raise ValueError(task.error_message)
+
+    def submit(self, scheduler, callback=None, uris=None):
+        """
+        Adds the transfer of the images to GEE to the scheduler, first checking them and
+        uploading them to GCS side by side unless `uris` lists where they have been uploaded
+        """
+        if uris is None:
+            self.checksImages()
+            self.setUpGeeAsset()
+            uris = stageFiles([self.stageJob(imageName) for imageName in self.imageNames])
+        self.sources = [{'primaryPath': uri} for uri in uris]
+        return scheduler.submit(self.transferGEE, name=self.meta['assetName'], callback=callback)
 
     def execute(self):
         #Checks if the images are correct
@@ -155,7 +255,7 @@ class assetManagement(object):
         self.setUpGeeAsset()
         
         #Uploads file/s to GCS
-        self.sources = list(map(self.uploadGCS, self.imageNames))
+        self.sources = [{'primaryPath': uri} for uri in stageFiles([self.stageJob(imageName) for imageName in self.imageNames])]
         
         #Transfers it from GCS to GEE
         task_id = self.transferGEE()
@@ -163,4 +263,22 @@ class assetManagement(object):
         print('TaskID: {0}'.format(task_id))
         print('Status: {0}'.format(ee.data.getTaskStatus(task_id)[0]))
         self.taskStatus(task_id)
-        
\ No newline at end of file
+
+
+def executeAll(imageObjects, max_in_flight=10, timeout=3600, callback=None):
+    """
+    Uploads several images in a single pass: the files of every image are uploaded to GCS side by side,
+    then all of the images are transferred to GEE together
+    Returns the ScheduledTask for each image, with the state its transfer ended in
+    """
+    scheduler = TaskScheduler(max_in_flight=max_in_flight, timeout=timeout, callback=callback)
+    managers = [assetManagement(imageObject) for imageObject in imageObjects]
+    jobs = []
+    for manager in managers:
+        manager.checksImages()
+        manager.setUpGeeAsset()
+        jobs.append([manager.stageJob(imageName) for imageName in manager.imageNames])
+    uris = iter(stageFiles([job for managerJobs in jobs for job in managerJobs]))
+    for manager, managerJobs in zip(managers, jobs):
+        manager.submit(scheduler, uris=[next(uris) for job in managerJobs])
+    return scheduler.run()
@@ -0,0 +1,122 @@
+'''
+Convert global 0-360 longitude rasters to -180-180 cloud optimized GeoTIFFs
+Example:
+```
+from rasterConvert import convert
+# one tif per band, read from the file in a single pass
+tifs = convert('NETCDF:"forecast.nc":NO2', [([1], 'no2_00.tif'), ([2], 'no2_06.tif')])
+```
+Google Earth Engine needs longitudes from -180 to 180, and many global
+model outputs run from 0 to 360. Rather than writing each band to a
+temporary tif with gdal_translate and warping it again with gdalwarp
+(CENTER_LONG 0), the bands are read once, the eastern half of the columns
+is moved in front of the western half in place, and each output is
+written straight to a tiled, compressed GeoTIFF with internal overviews.
+
+Connectors build their Docker images from their own folder, so copy this
+file next to the connector's `__init__.py` to use it; it needs rasterio.
+'''
+import math
+from collections import OrderedDict
+import numpy as np
+import rasterio as rio
+from rasterio.enums import Resampling
+from rasterio.shutil import copy as rio_copy
+
+# creation options for cloud optimized GeoTIFFs
+COG_OPTIONS = {'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'deflate'}
+# overview levels built into each GeoTIFF
+COG_OVERVIEWS = [2, 4]
+
+
+def _rotateColumns(data, split):
+    '''
+    Move the columns from `split` on in front of the columns before it,
+    along the last axis of `data`, in place
+    Only the smaller of the two parts is copied; the larger one is moved
+    in blocks that never overlap their destination.
+    '''
+    width = data.shape[-1]
+    east = width - split
+    if split <= east:
+        tmp = data[..., :split].copy()
+        for start in range(0, east, split):
+            stop = min(start + split, east)
+            data[..., start:stop] = data[..., start + split:stop + split]
+        data[..., east:] = tmp
+    else:
+        tmp = data[..., split:].copy()
+        for stop in range(width, east, -east):
+            start = max(stop - east, east)
+            data[..., start:stop] = data[..., start - east:stop - east]
+        data[..., :east] = tmp
+
+
+def rollLongitudes(data, transform):
+    '''
+    Shift a global raster from 0-360 to -180-180 longitude in place
+    `data` has longitude along its last axis; returns the new transform
+    Rasters that already start west of the prime meridian are left as is.
+    '''
+    west, xres = transform.c, transform.a
+    if west < -xres:
+        return transform
+    # columns whose centers are east of 180 move to the western edge
+    split = int(math.ceil((180.0 - west) / xres - 0.5))
+    _rotateColumns(data, split)
+    return rio.Affine(xres, transform.b, west + split * xres - 360.0,
+                      transform.d, transform.e, transform.f)
+
+
+def writeCog(tif, data, profile):
+    '''
+    Write a 2D or 3D (band, row, column) array to a tiled, compressed
+    GeoTIFF with internal overviews
+    `profile` must include dtype, crs, transform and nodata
+    '''
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    profile = dict(profile, **COG_OPTIONS)
+    profile.update(driver='GTiff', count=data.shape[0], height=data.shape[1], width=data.shape[2])
+    # build the tif with overviews in memory, then copy it out with the overviews ahead of the data
+    with rio.MemoryFile() as memfile:
+        with memfile.open(**profile) as mem:
+            mem.write(data.astype(profile['dtype'], copy=False))
+            mem.build_overviews(COG_OVERVIEWS, Resampling.average)
+        rio_copy(memfile.name, tif, driver='GTiff', copy_src_overviews=True, **COG_OPTIONS)
+    return tif
+
+
+def readBands(sources, crs='EPSG:4326', nodata=None):
+    '''
+    Read (path, band) pairs into one (band, row, column) array, opening
+    each path once; every source must be on the same grid
+    Returns the array and the profile to write it with, using `crs`, and
+    `nodata` unless it is None, in which case the first source's is kept.
+    '''
+    data = None
+    for path in OrderedDict.fromkeys(path for path, band in sources):
+        with rio.open(path) as src:
+            for i, (src_path, band) in enumerate(sources):
+                if src_path != path:
+                    continue
+                if data is None:
+                    data = np.empty((len(sources), src.height, src.width), dtype=src.dtypes[band - 1])
+                    profile = {'dtype': src.dtypes[band - 1], 'crs': crs, 'transform': src.transform,
+                               'nodata': src.nodata if nodata is None else nodata}
+                src.read(band, out=data[i])
+    return data, profile
+
+
+def convert(src_path, outputs, crs='EPSG:4326', nodata=None):
+    '''
+    Convert bands of a 0-360 longitude raster to -180-180 GeoTIFFs,
+    reading every band needed from `src_path` in one pass
+    `outputs` list of (bands, tif) pairs; each tif gets the listed bands
+    Returns the tif file names, in the order of `outputs`
+    '''
+    bands = sorted(set(band for out_bands, tif in outputs for band in out_bands))
+    data, profile = readBands([(src_path, band) for band in bands], crs, nodata)
+    profile['transform'] = rollLongitudes(data, profile['transform'])
+    return [writeCog(tif, data[[bands.index(band) for band in out_bands]], profile)
+            for out_bands, tif in outputs]